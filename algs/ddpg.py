@@ -1,18 +1,68 @@
 import random, collections
+import logging
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
 
 
+class RunningMeanStd(nn.Module):
+    """
+    Running mean and variance of the flat observation, used to normalize the state inside the networks.
+    The statistics are updated by batches with the parallel variant of Welford's algorithm,
+    so statistics of different workers can be merged in the same way.
+    """
+
+    def __init__(self, shape, epsilon=1e-4, clip=10.0) -> None:
+        super().__init__()
+        self.clip = clip
+        self.register_buffer('mean', torch.zeros(shape, dtype=torch.float64))
+        self.register_buffer('var', torch.ones(shape, dtype=torch.float64))
+        # a tiny initial count avoids the division by zero before the first update
+        self.register_buffer('count', torch.tensor(epsilon, dtype=torch.float64))
+
+    @torch.no_grad()
+    def update(self, x):
+        """Update the statistics with a batch of observations, shape: batch_size*state_dim"""
+        x = torch.as_tensor(np.asarray(x), dtype=torch.float64).to(self.mean.device).view(-1, self.mean.shape[0])
+        self.merge(x.mean(dim=0), x.var(dim=0, unbiased=False), x.shape[0])
+
+    @torch.no_grad()
+    def merge(self, mean, var=None, count=None):
+        """Merge the statistics (mean, var, count) of another batch or worker, mean can also be a RunningMeanStd"""
+        if isinstance(mean, RunningMeanStd):
+            mean, var, count = mean.mean, mean.var, mean.count
+        mean = torch.as_tensor(mean, dtype=torch.float64).to(self.mean.device)
+        var = torch.as_tensor(var, dtype=torch.float64).to(self.mean.device)
+        count = torch.as_tensor(count, dtype=torch.float64).to(self.mean.device)
+        total = self.count + count
+        delta = mean - self.mean
+        m2 = self.var * self.count + var * count + delta ** 2 * self.count * count / total
+        self.mean += delta * count / total
+        self.var.copy_(m2 / total)
+        self.count.copy_(total)
+
+    def get_stats(self):
+        """Return mean, std and count as numpy arrays"""
+        return self.mean.cpu().numpy(), np.sqrt(self.var.cpu().numpy()), float(self.count)
+
+    def forward(self, x):
+        x_ = (x - self.mean.to(x.dtype)) / torch.sqrt(self.var.to(x.dtype) + 1e-8)
+        return torch.clamp(x_, -self.clip, self.clip)
+
+
 class ReplayBuffer:
     """经验回放池"""
 
-    def __init__(self, capacity) -> None:
+    def __init__(self, capacity, obs_rms=None, rms_batch=64) -> None:
         self.buffer = collections.deque(maxlen=capacity)  # 队列，先进先出
         self.change_buffer = collections.deque(maxlen=capacity//10)
         self.tmp_buffer = collections.deque(maxlen=10)
         self.number = 0
+        # the observation statistics are updated every rms_batch inserted states
+        self.obs_rms = obs_rms
+        self.rms_batch = rms_batch
+        self.rms_states = []
         # self.all_buffer = np.zeros((1000000, 66), dtype=np.float32)
         # with open('./out/replay_buffer_test.txt', 'w') as f:
         #     pass
@@ -31,6 +81,12 @@ class ReplayBuffer:
         if abs(info['lane_changing_reward']) > 0.1:
             for buf in self.tmp_buffer:
                 self.change_buffer.append(buf)
+        # the statistics are frozen once the buffer is full, so the normalization doesn't drift under the networks
+        if self.obs_rms is not None and len(self.buffer) < self.buffer.maxlen:
+            self.rms_states.append(state)
+            if len(self.rms_states) >= self.rms_batch:
+                self.obs_rms.update(np.concatenate(self.rms_states, axis=0))
+                self.rms_states.clear()
         self.buffer.append((state, action, reward, next_state, truncated, done))
         reward_com = info["Comfort"]
 
@@ -234,11 +290,21 @@ class Split_ReplayBuffer:
                len(self.large_steering), len(self.large_th_br), len(self.low_efficiency_buffer), len(self.normal_buffer)
 
     def running_mean_std(self):
-        d_size, o_size, c_size, l_size, n_size = self.all_size()
-        uniform_size = min(d_size//8, o_size, c_size, l_size, n_size)
-
-        mean = 0
-        std = 0
+        """Mean and std of the states in all split buffers, the statistics of each buffer are merged in parallel"""
+        rms = None
+        for buffer in (self.dangerous_buffer, self.off_center_buffer, self.low_efficiency_buffer, self.on_curve_buffer,
+                       self.large_steering, self.large_th_br, self.normal_buffer):
+            if len(buffer) == 0:
+                continue
+            states = np.concatenate([transition[0] for transition in buffer], axis=0)
+            if rms is None:
+                rms = RunningMeanStd(states.shape[1], epsilon=0)
+                rms.update(states)
+            else:
+                rms.merge(states.mean(axis=0), states.var(axis=0), states.shape[0])
+        if rms is None:
+            return 0, 0
+        mean, std, _ = rms.get_stats()
         return mean, std
 
     def _compress(self, state):
@@ -396,12 +462,14 @@ class veh_lane_encoder(torch.nn.Module):
 
 
 class PolicyNet_multi(torch.nn.Module):
-    def __init__(self, state_dim, action_bound, train=True) -> None:
+    def __init__(self, state_dim, action_bound, train=True, obs_rms=None) -> None:
         # the action bound and state_dim here are dicts
         super().__init__()
         self.state_dim = state_dim
         self.action_bound = action_bound
         self.train = train
+        # optional RunningMeanStd shared with the other networks, normalizes the state
+        self.obs_rms = obs_rms
         self.left_encoder = veh_lane_encoder(self.state_dim)
         self.center_encoder = veh_lane_encoder(self.state_dim)
         self.right_encoder = veh_lane_encoder(self.state_dim)
@@ -418,6 +486,8 @@ class PolicyNet_multi(torch.nn.Module):
 
     def forward(self, state):
         # state: (waypoints + 2 * conventional_vehicle0 * 3
+        if self.obs_rms is not None:
+            state = self.obs_rms(state)
         one_state_dim = self.state_dim['waypoints'] + self.state_dim['conventional_vehicle'] * 2
         left_enc = self.left_encoder(state[:, :one_state_dim])
         center_enc = self.center_encoder(state[:, one_state_dim:2*one_state_dim])
@@ -444,11 +514,12 @@ class PolicyNet_multi(torch.nn.Module):
 
 
 class QValueNet_multi(torch.nn.Module):
-    def __init__(self, state_dim, action_dim) -> None:
+    def __init__(self, state_dim, action_dim, obs_rms=None) -> None:
         # parameter state_dim here is a dict
         super().__init__()
         self.state_dim = state_dim
         self.action_dim = action_dim
+        self.obs_rms = obs_rms
         self.left_encoder = veh_lane_encoder(self.state_dim)
         self.center_encoder = veh_lane_encoder(self.state_dim)
         self.right_encoder = veh_lane_encoder(self.state_dim)
@@ -463,6 +534,8 @@ class QValueNet_multi(torch.nn.Module):
         # torch.nn.init.xavier_normal_(self.fc_out.weight.data)
 
     def forward(self, state, action):
+        if self.obs_rms is not None:
+            state = self.obs_rms(state)
         one_state_dim = self.state_dim['waypoints'] + self.state_dim['conventional_vehicle'] * 2
         left_enc = self.left_encoder(state[:, :one_state_dim])
         center_enc = self.center_encoder(state[:, one_state_dim:2*one_state_dim])
@@ -571,7 +644,7 @@ class LaneEncoder(torch.nn.Module):
 
 class DDPG:
     def __init__(self, state_dim, action_dim, action_bound, gamma, tau, sigma, theta, epsilon,
-                 buffer_size, batch_size, actor_lr, critic_lr, clip_grad, device) -> None:
+                 buffer_size, batch_size, actor_lr, critic_lr, clip_grad, device, obs_norm=False) -> None:
         self.learn_time = 0
         self.replace_a = 0
         self.replace_c = 0
@@ -583,19 +656,22 @@ class DDPG:
         self.buffer_size, self.batch_size, self.device = buffer_size, batch_size, device
         self.actor_lr, self.critic_lr = actor_lr, critic_lr
         self.clip_grad = clip_grad
+        # running statistics of the flat state, shared by all networks and updated by the replay buffer
+        one_state_dim = self.s_dim['waypoints'] + self.s_dim['conventional_vehicle'] * 2
+        self.obs_rms = RunningMeanStd(3 * one_state_dim + self.s_dim['ego_vehicle']).to(self.device) if obs_norm else None
         # adjust different types of replay buffer
         #self.replay_buffer = Split_ReplayBuffer(buffer_size)
-        self.replay_buffer = ReplayBuffer(buffer_size)
+        self.replay_buffer = ReplayBuffer(buffer_size, self.obs_rms)
         # self.replay_buffer = offline_replay_buffer()
         """self.memory=torch.tensor((buffer_size,self.s_dim*2+self.a_dim+1+1),
             dtype=torch.float32).to(self.device)"""
         self.pointer = 0  # serve as updating the memory data
         self.train = True
-        self.actor = PolicyNet_multi(self.s_dim, self.a_bound).to(self.device)
-        self.actor_target = PolicyNet_multi(self.s_dim, self.a_bound).to(self.device)
+        self.actor = PolicyNet_multi(self.s_dim, self.a_bound, obs_rms=self.obs_rms).to(self.device)
+        self.actor_target = PolicyNet_multi(self.s_dim, self.a_bound, obs_rms=self.obs_rms).to(self.device)
         self.actor_target.load_state_dict(self.actor.state_dict())
-        self.critic = QValueNet_multi(self.s_dim, self.a_dim).to(self.device)
-        self.critic_target = QValueNet_multi(self.s_dim, self.a_dim).to(self.device)
+        self.critic = QValueNet_multi(self.s_dim, self.a_dim, obs_rms=self.obs_rms).to(self.device)
+        self.critic_target = QValueNet_multi(self.s_dim, self.a_dim, obs_rms=self.obs_rms).to(self.device)
         # self.actor = PolicyNet(self.s_dim, self.a_bound).to(self.device)
         # self.actor_target = PolicyNet(self.s_dim, self.a_bound).to(self.device)
         # self.actor_target.load_state_dict(self.actor.state_dict())
@@ -739,16 +815,33 @@ class DDPG:
             'actor_optimizer': self.actor_optimizer.state_dict(),
             'critic_optimizer': self.critic_optimizer.state_dict()
         }
+        if self.obs_rms is not None:
+            state['obs_rms'] = self.obs_rms.state_dict()
         torch.save(state, file)
 
     def load_net(self, state):
+        # the networks only work with the inputs they were trained on
+        if 'obs_rms' in state and self.obs_rms is None:
+            raise ValueError('the checkpoint was trained with observation normalization, create DDPG with obs_norm=True')
+        if 'obs_rms' not in state and self.obs_rms is not None:
+            logging.warning('the checkpoint was trained on raw observations, observation normalization is turned off')
+            self._set_obs_rms(None)
         self.critic.load_state_dict(state['critic'])
         self.critic_target.load_state_dict(state['critic_target'])
         self.actor.load_state_dict(state['actor'])
         self.actor_target.load_state_dict(state['actor_target'])
+        if self.obs_rms is not None:
+            self.obs_rms.load_state_dict(state['obs_rms'])
         self.actor_optimizer.load_state_dict(state['actor_optimizer'])
         self.critic_optimizer.load_state_dict(state['critic_optimizer'])
 
+    def _set_obs_rms(self, obs_rms):
+        """Share obs_rms with the networks and the replay buffer, None turns off observation normalization"""
+        self.obs_rms = obs_rms
+        self.replay_buffer.obs_rms = obs_rms
+        for net in (self.actor, self.actor_target, self.critic, self.critic_target):
+            net.obs_rms = obs_rms
+
 
 class OrnsteinUhlenbeckActionNoise:
     def __init__(self, sigma, theta=0.001, mu=np.array([0.0]), dt=1e-2, x0=None):
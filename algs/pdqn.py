@@ -12,6 +12,8 @@ class ReplayBuffer:
         self.buffer = collections.deque(maxlen=capacity)  # 队列，先进先出
         self.change_buffer = collections.deque(maxlen=capacity//10)
         self.tmp_buffer = collections.deque(maxlen=10)
+        # step infos of the transitions in self.buffer, used to relabel their rewards offline
+        self.info_buffer = collections.deque(maxlen=capacity)
         self.number = 0
 
     def add(self, state, action, action_param, reward, next_state, truncated, done, info):
@@ -32,6 +34,7 @@ class ReplayBuffer:
         #     for buf in self.tmp_buffer:
         #         self.change_buffer.append(buf)
         self.buffer.append((state, action, action_param, reward, next_state, truncated, done))
+        self.info_buffer.append(info)
         reward_com = info["Comfort"]
         reward_eff = info["velocity"]
 
@@ -59,6 +62,17 @@ class ReplayBuffer:
     def size(self):
         return len(self.buffer)
 
+    def relabel(self, rewards):
+        """Replace the rewards of all transitions in self.buffer, in insertion order,
+        e.g. rewards=relabel(collect_kinematics(self.info_buffer)) from gym_carla.env.util.reward.
+        The change buffer is rebuilt from the relabeled lane change transitions."""
+        self.buffer = collections.deque([(state, action, action_param, reward, next_state, truncated, done)
+                                         for (state, action, action_param, _, next_state, truncated, done), reward
+                                         in zip(self.buffer, rewards)], maxlen=self.buffer.maxlen)
+        self.change_buffer = collections.deque([transition for transition in self.buffer
+                                                if transition[1] == 0 or transition[1] == 2],
+                                               maxlen=self.change_buffer.maxlen)
+
     def _compress(self, state):
         # print('state: ', state)
         state_left_wps = np.array(state['left_waypoints'], dtype=np.float32).reshape((1, -1))
@@ -0,0 +1,27 @@
+import logging
+from gym_carla.env.settings import ARGS
+from gym_carla.env.carla_env import CarlaEnv
+from process import start_process, kill_process
+
+
+def main():
+    """Fill the scenario bank with settled traffic snapshots, then train with --scenario_bank to restore them"""
+    args = ARGS.parse_args()
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)
+
+    env = CarlaEnv(args)
+    try:
+        env.generate_scenarios(args.generate_scenarios)
+    finally:
+        env.__del__()
+        logging.info('\nDone.')
+
+
+if __name__ == '__main__':
+    try:
+        start_process()
+        main()
+    finally:
+        kill_process()
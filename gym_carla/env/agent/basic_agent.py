@@ -1,6 +1,7 @@
 import carla
 from shapely.geometry import Polygon
 from gym_carla.env.agent.pid_controller import VehiclePIDController
+from gym_carla.env.util.spatial import get_vehicle_index, MAX_VEHICLE_EXTENT
 from gym_carla.env.util.misc import get_speed,is_within_distance,get_trafficlight_trigger_location,compute_distance
 
 class BasicAgent(object):
@@ -223,19 +224,22 @@ class BasicAgent(object):
         Method to check if there is a vehicle in front of the agent blocking its path.
 
             :param vehicle_list (list of carla.Vehicle): list contatining vehicle objects.
-                If None, all vehicle in the scene are used
+                If None, the vehicles within reach of max_distance are queried from the vehicle index
             :param max_distance: max freespace to check for obstacles.
                 If None, the base threshold value is used
         """
         if self._ignore_vehicles:
             return (False, None, -1)
 
-        if not vehicle_list:
-            vehicle_list = self._world.get_actors().filter("*vehicle*")
-
         if not max_distance:
             max_distance = self._base_vehicle_threshold
 
+        if vehicle_list is None:
+            # the distance is measured between the vehicle ends, widen the radius by the vehicle extents
+            vehicle_list = get_vehicle_index(self._world).query_radius(
+                self._vehicle.get_location(), max_distance + self._vehicle.bounding_box.extent.x + MAX_VEHICLE_EXTENT,
+                self._vehicle.id)
+
         ego_transform = self._vehicle.get_transform()
         ego_wpt = self._map.get_waypoint(self._vehicle.get_location())
 
@@ -168,9 +168,10 @@ class Basic_Lanechanging_Agent(object):
         self.left_wps = info_dict['left_wps']
         self.center_wps = info_dict['center_wps']
         self.right_wps = info_dict['right_wps']
-        self.left_rear_wps = info_dict['left_rear_wps']
-        self.center_rear_wps = info_dict['center_rear_wps']
-        self.right_rear_wps = info_dict['right_rear_wps']
+        # the rear windows are only passed when the local planner computes them
+        self.left_rear_wps = info_dict.get('left_rear_wps', [])
+        self.center_rear_wps = info_dict.get('center_rear_wps', [])
+        self.right_rear_wps = info_dict.get('right_rear_wps', [])
         self.distance_to_left_front=info_dict['vehs_info'].distance_to_front_vehicles[0]
         self.distance_to_center_front=info_dict['vehs_info'].distance_to_front_vehicles[1]
         self.distance_to_right_front=info_dict['vehs_info'].distance_to_front_vehicles[2]
@@ -210,8 +211,8 @@ class Basic_Lanechanging_Agent(object):
         """Execute one step of navigation."""
         hazard_detected = False
         # Retrieve all relevant actors
+        # the vehicle obstacles come from the local planner gap distances
         actor_list = self._world.get_actors()
-        vehicle_list = actor_list.filter("*vehicle*")
         lights_list = actor_list.filter("*traffic_light*")
 
         vehicle_speed = get_speed(self._vehicle) / 3.6
@@ -3,6 +3,7 @@ import numpy as np
 from shapely.geometry import Polygon
 from gym_carla.env.util.misc import get_speed,positive
 from gym_carla.env.agent.basic_agent import BasicAgent
+from gym_carla.env.util.spatial import get_vehicle_index
 from gym_carla.env.agent.behavior_types import Cautious,Normal,Aggressive
 from gym_carla.env.agent.local_planner import RoadOption
 
@@ -199,9 +200,7 @@ class BehaviorAgent(BasicAgent):
             :return distance: distance to nearby vehicle
         """
 
-        vehicle_list = self._world.get_actors().filter("*vehicle*")
-        def dist(v): return v.get_location().distance(waypoint.transform.location)
-        vehicle_list = [v for v in vehicle_list if dist(v) < 45 and v.id != self._vehicle.id]
+        vehicle_list = get_vehicle_index(self._world).query_radius(waypoint.transform.location, 45, self._vehicle.id)
 
         if self._direction == RoadOption.CHANGELANELEFT:
             vehicle_state, vehicle, distance = self._vehicle_obstacle_detected(
@@ -35,6 +35,8 @@ class GlobalPlanner:
 
         # code for simulation road generation
         self._route = []
+        # [start, end) index of each closed lane loop in self._route
+        self._loops = []
         self._topology = []
 
         # generate circuit topology
@@ -51,6 +53,10 @@ class GlobalPlanner:
     def get_route(self, ego_waypoint):
         return self._compute_next_waypoints(ego_waypoint, len(self._route))
 
+    def get_route_loops(self):
+        """Return the route waypoints split by the closed lane loops, one waypoint list per loop"""
+        return [self._route[start:end] for start, end in self._loops]
+
     def get_spawn_points(self):
         """Vehicle can only be spawned on specific roads, return transforms"""
         spawn_points = []
@@ -80,6 +86,7 @@ class GlobalPlanner:
         # print(len(self._route))
 
     def _build(self,begin):
+        start = len(self._route)
         self._route.append(begin['entry'])
         for wp in begin['path']:
             self._route.append(wp)
@@ -101,6 +108,7 @@ class GlobalPlanner:
                 if seg['entry'].id == indicator.id:
                     iter = seg
                     break
+        self._loops.append((start, len(self._route)))
 
     def _compute_next_waypoints(self, cur_wp, k=1):
         """
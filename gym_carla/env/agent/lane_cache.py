@@ -0,0 +1,123 @@
+import numpy as np
+from types import SimpleNamespace
+from gym_carla.env.settings import DISTURB_ROADS
+from gym_carla.env.util.misc import get_lane_center, test_waypoint
+
+
+class LaneAssignmentCache:
+    """
+    Lane membership of the companion vehicles, cached by actor id.
+
+    Most vehicles stay in their lane for hundreds of ticks, so the map projections
+    (get_waypoint and get_lane_center) of a vehicle are only recomputed when
+        the vehicle moved laterally more than lateral_threshold from its cached lane center offset,
+        the vehicle crossed a road boundary of the route (or moved more than max_travel without a route frame),
+        the cached entry is older than max_age ticks.
+    """
+
+    def __init__(self, carla_map, route_frame=None, lateral_threshold=0.5, max_travel=10.0, max_age=20,
+                 projection=None):
+        """
+        :param carla_map: carla.Map used by the projections
+        :param route_frame: optional RouteFrame, its sample roads detect the road boundary crossings
+        :param lateral_threshold: lateral motion which invalidates an entry, meters
+        :param max_travel: longitudinal motion which invalidates an entry without a route frame, meters
+        :param max_age: number of ticks after which an entry is invalid
+        :param projection: optional ProjectionService, answers the projections inside its indexed area
+        """
+        self._map = carla_map
+        self.projection = projection
+        self.route_frame = route_frame
+        self.lateral_threshold = lateral_threshold
+        self.max_travel = max_travel
+        self.max_age = max_age
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'entries': len(self._entries)}
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    def clear(self):
+        self._entries.clear()
+
+    def assign(self, vehicle, frame):
+        """
+        Lane membership of a vehicle in the world frame
+        :return: (waypoint lane id, whether the vehicle is within its lane center, whether its waypoint is on the route)
+        """
+        location = vehicle.get_location()
+        point = np.array([location.x, location.y])
+        entry = self._entries.get(vehicle.id)
+        if entry is not None and self._valid(entry, point, frame):
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = self._compute(location, point, frame)
+            self._entries[vehicle.id] = entry
+        lateral = np.dot(point - entry['center'], entry['right'])
+        # the lane center is the projection of the vehicle, its distance is the lateral offset
+        on_lane = bool(abs(lateral) <= entry['half_width'] + 0.1)
+        return entry['lane_id'], on_lane, entry['on_route']
+
+    def _valid(self, entry, point, frame):
+        if frame - entry['frame'] > self.max_age:
+            return False
+        delta = point - entry['center']
+        if abs(np.dot(delta, entry['right']) - entry['lateral']) > self.lateral_threshold:
+            return False
+        if self.route_frame is not None:
+            road = self.route_frame.road_id[self.route_frame.nearest(point)[0]]
+            return road == entry['route_road']
+        return abs(np.dot(delta, entry['forward'])) <= self.max_travel
+
+    def _compute(self, location, point, frame):
+        if self.projection is not None:
+            entry = self._compute_projection(point, frame)
+            if entry is not None:
+                return entry
+        waypoint = self._map.get_waypoint(location)
+        lane_center = get_lane_center(self._map, location)
+        center = lane_center.transform.location
+        yaw = np.radians(lane_center.transform.rotation.yaw)
+        forward = np.array([np.cos(yaw), np.sin(yaw)])
+        right = np.array([-forward[1], forward[0]])
+        entry = {'frame': frame, 'center': np.array([center.x, center.y]), 'forward': forward, 'right': right,
+                 'half_width': lane_center.lane_width / 2, 'lane_id': waypoint.lane_id,
+                 'on_route': test_waypoint(waypoint)}
+        entry['lateral'] = np.dot(point - entry['center'], right)
+        if self.route_frame is not None:
+            entry['route_road'] = self.route_frame.road_id[self.route_frame.nearest(point)[0]]
+        return entry
+
+    def _compute_projection(self, point, frame):
+        """The same entry as _compute from the client side projection, None if the point is outside the indexed area"""
+        projection = self.projection
+        idx, _, _, inside = projection.query(point, ('driving',))
+        center_idx, along, _, center_inside = projection.query(point)
+        if not (inside[0] and center_inside[0]) or projection.road_id[center_idx[0]] in DISTURB_ROADS:
+            # get_lane_center has a special projection on these roads
+            return None
+        center_idx = center_idx[0]
+        yaw = projection.yaw[center_idx]
+        forward = np.array([np.cos(yaw), np.sin(yaw)])
+        right = np.array([-forward[1], forward[0]])
+        waypoint = SimpleNamespace(road_id=int(projection.road_id[idx[0]]), lane_id=int(projection.lane_id[idx[0]]))
+        entry = {'frame': frame, 'center': projection.xyz[center_idx, :2] + along[0] * forward, 'forward': forward,
+                 'right': right, 'half_width': projection.width[center_idx] / 2, 'lane_id': waypoint.lane_id,
+                 'on_route': test_waypoint(waypoint)}
+        entry['lateral'] = np.dot(point - entry['center'], right)
+        if self.route_frame is not None:
+            entry['route_road'] = self.route_frame.road_id[self.route_frame.nearest(point)[0]]
+        return entry
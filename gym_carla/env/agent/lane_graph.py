@@ -0,0 +1,243 @@
+import os
+import math
+import logging
+import carla
+import numpy as np
+from scipy.spatial import cKDTree
+from gym_carla.env.settings import ROADS, LANE_GRAPH_PATH
+
+# index values of the adjacency arrays besides node indexes
+NO_LANE = -1
+UNKNOWN = -2
+
+
+class LaneGraph:
+    """
+    Compiled lane graph of the chosen route.
+
+    Every node is a lane sample: the first nodes are the RouteFrame samples in the same order, followed by the
+    samples of the lanes beside them (the other direction, shoulders, sidewalks) reached with get_left_lane()
+    and get_right_lane(). The left, right, successor and predecessor arrays hold the index of the adjacent node,
+    NO_LANE if there is no such lane and UNKNOWN if the lane is outside the graph, so the topology navigation
+    is array indexing instead of chained map queries. A waypoint is matched to its node by a binary search over
+    the s of the nodes of its lane. The arrays are serialized to a npz file and reloaded
+    as long as the map, sampling resolution and route are the same.
+    """
+
+    FIELDS = ('xyz', 'road_id', 'lane_id', 's', 'width', 'lane_type', 'left', 'right', 'successor', 'predecessor')
+
+    def __init__(self, carla_map, route_waypoints, resolution, arrays):
+        """
+        :param carla_map: carla.Map, used to get the waypoints of the nodes
+        :param route_waypoints: RouteFrame.waypoints, the waypoints of the first nodes
+        :param resolution: sampling resolution of the route, meters
+        :param arrays: dict of the FIELDS arrays
+        """
+        self._map = carla_map
+        self._route_waypoints = route_waypoints
+        self.resolution = resolution
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+        # s and node index of the nodes of every (road id, lane id), sorted by s
+        self._lanes = {}
+        for key in set(zip(self.road_id.tolist(), self.lane_id.tolist())):
+            nodes = np.flatnonzero((self.road_id == key[0]) & (self.lane_id == key[1]))
+            nodes = nodes[np.argsort(self.s[nodes], kind='stable')]
+            self._lanes[key] = (self.s[nodes], nodes)
+        self._waypoints = {}
+
+    def __len__(self):
+        return len(self.s)
+
+    @classmethod
+    def build(cls, carla_map, route_waypoints, resolution, max_side_lanes=6):
+        """Compile the lane graph from the map, the route waypoints are the first nodes"""
+        num_route = len(route_waypoints)
+        waypoints = list(route_waypoints)
+        left = [UNKNOWN] * num_route
+        right = [UNKNOWN] * num_route
+        route_tree = cKDTree([[wp.transform.location.x, wp.transform.location.y] for wp in route_waypoints])
+        route_lanes = {(wp.road_id, wp.lane_id) for wp in route_waypoints}
+        side_nodes = {}
+
+        def match(wp, tree, nodes):
+            loc = wp.transform.location
+            for dis, i in zip(*tree.query([loc.x, loc.y], k=min(8, len(nodes)), distance_upper_bound=resolution)):
+                if np.isfinite(dis) and nodes[i].road_id == wp.road_id and nodes[i].lane_id == wp.lane_id:
+                    return int(i)
+            return UNKNOWN
+
+        for i, route_wp in enumerate(route_waypoints):
+            for pointers, backs, get_lane in ((left, right, lambda wp: wp.get_left_lane()),
+                                              (right, left, lambda wp: wp.get_right_lane())):
+                node, wp = i, route_wp
+                for _ in range(max_side_lanes):
+                    wp = get_lane(wp)
+                    if wp is None:
+                        pointers[node] = NO_LANE
+                        break
+                    if (wp.road_id, wp.lane_id) in route_lanes:
+                        # the neighbour route lane has its own nodes
+                        pointers[node] = match(wp, route_tree, route_waypoints)
+                        break
+                    key = (wp.road_id, wp.lane_id, round(wp.s, 1))
+                    if key not in side_nodes:
+                        side_nodes[key] = len(waypoints)
+                        waypoints.append(wp)
+                        left.append(UNKNOWN)
+                        right.append(UNKNOWN)
+                    pointers[node] = side_nodes[key]
+                    backs[side_nodes[key]] = node
+                    node = side_nodes[key]
+
+        tree = cKDTree([[wp.transform.location.x, wp.transform.location.y] for wp in waypoints])
+        successor = [UNKNOWN] * len(waypoints)
+        predecessor = [UNKNOWN] * len(waypoints)
+        for i, wp in enumerate(waypoints):
+            for pointers, next_wps in ((successor, wp.next(resolution)), (predecessor, wp.previous(resolution))):
+                if len(next_wps) == 0:
+                    pointers[i] = NO_LANE
+                    continue
+                next_wp = next_wps[0]
+                for candidate in next_wps:
+                    if candidate.road_id in ROADS:
+                        next_wp = candidate
+                pointers[i] = match(next_wp, tree, waypoints)
+        arrays = {'xyz': np.array([[wp.transform.location.x, wp.transform.location.y, wp.transform.location.z]
+                                   for wp in waypoints]),
+                  'road_id': np.array([wp.road_id for wp in waypoints], dtype=np.int64),
+                  'lane_id': np.array([wp.lane_id for wp in waypoints], dtype=np.int64),
+                  's': np.array([wp.s for wp in waypoints]),
+                  'width': np.array([wp.lane_width for wp in waypoints]),
+                  'lane_type': np.array([int(wp.lane_type) for wp in waypoints], dtype=np.int64),
+                  'left': np.array(left, dtype=np.int64), 'right': np.array(right, dtype=np.int64),
+                  'successor': np.array(successor, dtype=np.int64),
+                  'predecessor': np.array(predecessor, dtype=np.int64)}
+        graph = cls(carla_map, route_waypoints, resolution, arrays)
+        graph._waypoints = dict(enumerate(waypoints))
+        return graph
+
+    def save(self, path):
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        np.savez(path, map_name=self._map.name, resolution=self.resolution, num_route=len(self._route_waypoints),
+                 **{field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def load(cls, carla_map, route_waypoints, resolution, path):
+        """Load a saved lane graph, None if it doesn't exist or was compiled for another map or route"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                arrays = {field: data[field] for field in cls.FIELDS}
+                same = (str(data['map_name']) == carla_map.name and float(data['resolution']) == resolution and
+                        int(data['num_route']) == len(route_waypoints))
+        except (OSError, ValueError, KeyError):
+            logging.warning('lane graph %s broken, ignore it', path)
+            return None
+        route_xyz = np.array([[wp.transform.location.x, wp.transform.location.y, wp.transform.location.z]
+                              for wp in route_waypoints])
+        if not same or not np.allclose(arrays['xyz'][:len(route_waypoints)], route_xyz, atol=0.01):
+            return None
+        return cls(carla_map, route_waypoints, resolution, arrays)
+
+    def node(self, waypoint):
+        """Index of the node on the lane of waypoint nearest to it, UNKNOWN if the lane is outside the graph"""
+        lane = self._lanes.get((waypoint.road_id, waypoint.lane_id))
+        if lane is None:
+            return UNKNOWN
+        s, nodes = lane
+        i = int(np.searchsorted(s, waypoint.s))
+        i = min((k for k in (i - 1, i) if 0 <= k < len(s)), key=lambda k: abs(s[k] - waypoint.s))
+        return int(nodes[i]) if abs(s[i] - waypoint.s) <= self.resolution else UNKNOWN
+
+    def waypoint(self, node):
+        """carla.Waypoint of a node, the waypoints of a loaded graph are queried once on first use"""
+        if node < len(self._route_waypoints):
+            return self._route_waypoints[node]
+        if node not in self._waypoints:
+            self._waypoints[node] = self._map.get_waypoint_xodr(int(self.road_id[node]), int(self.lane_id[node]),
+                                                                float(self.s[node]))
+        return self._waypoints[node]
+
+    def _walk(self, waypoint, offset):
+        """Nodes of the lanes crossed from waypoint to the lane offset lanes to its right, ending at a negative
+        NO_LANE or UNKNOWN if the walk stops early"""
+        node = self.node(waypoint)
+        if node < 0:
+            return [node]
+        pointers = self.right if offset > 0 else self.left
+        nodes = []
+        for _ in range(abs(offset)):
+            node = int(pointers[node])
+            nodes.append(node)
+            if node < 0:
+                break
+        return nodes
+
+    def _chain(self, waypoint, offset):
+        """Fallback for the lanes outside the graph, chain get_right_lane() / get_left_lane() abs(offset) times"""
+        for _ in range(abs(offset)):
+            waypoint = waypoint.get_right_lane() if offset > 0 else waypoint.get_left_lane()
+            if waypoint is None:
+                return None
+        return waypoint
+
+    def lateral(self, waypoint, offset, exact=False):
+        """
+        Waypoint offset lanes to the right of waypoint (negative means left), None if there is no such lane.
+        The lane is resolved through the adjacency arrays and the waypoint of its node is returned, so it is up to
+        half a resolution away along the lane from the s of waypoint. exact gets the waypoint at the same s with one
+        map.get_waypoint_xodr call instead, the same as chaining waypoint.get_right_lane() / get_left_lane()
+        """
+        if offset == 0:
+            return waypoint
+        node = self._walk(waypoint, offset)[-1]
+        if node == NO_LANE:
+            return None
+        if node == UNKNOWN:
+            return self._chain(waypoint, offset)
+        if exact:
+            lane_wp = self._map.get_waypoint_xodr(int(self.road_id[node]), int(self.lane_id[node]), waypoint.s)
+            if lane_wp is not None:
+                return lane_wp
+        return self.waypoint(node)
+
+    def lateral_location(self, waypoint, offset):
+        """
+        Center location and width of the lane offset lanes to the right of waypoint (negative means left) at the
+        same s, summed from the lane widths of the crossed nodes, None if there is no such lane
+        """
+        if offset == 0:
+            return waypoint.transform.location, waypoint.lane_width
+        nodes = self._walk(waypoint, offset)
+        if nodes[-1] == NO_LANE:
+            return None
+        if nodes[-1] == UNKNOWN:
+            lane_wp = self._chain(waypoint, offset)
+            return None if lane_wp is None else (lane_wp.transform.location, lane_wp.lane_width)
+        distance = waypoint.lane_width / 2 + self.width[nodes[:-1]].sum() + self.width[nodes[-1]] / 2
+        distance = float(distance) if offset > 0 else -float(distance)
+        location = waypoint.transform.location
+        yaw = math.radians(waypoint.transform.rotation.yaw)
+        return (carla.Location(x=location.x - distance * math.sin(yaw), y=location.y + distance * math.cos(yaw),
+                               z=location.z), float(self.width[nodes[-1]]))
+
+    def left_lane(self, waypoint):
+        return self.lateral(waypoint, -1)
+
+    def right_lane(self, waypoint):
+        return self.lateral(waypoint, 1)
+
+
+def get_lane_graph(carla_map, route_waypoints, resolution, path=LANE_GRAPH_PATH):
+    """Load the lane graph of the route, compile and save it if there is no valid saved one"""
+    path = path.format(os.path.basename(carla_map.name))
+    graph = LaneGraph.load(carla_map, route_waypoints, resolution, path)
+    if graph is None:
+        graph = LaneGraph.build(carla_map, route_waypoints, resolution)
+        graph.save(path)
+        logging.info('lane graph of %d nodes saved to %s', len(graph), path)
+    return graph
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class LanePolylineStore:
+    """
+    Lane polylines of the chosen route indexed by arc length, built once from the RouteFrame samples.
+
+    Every lane loop of the route keeps dense arrays of x, y, z, yaw (radians), lane width and arc length s
+    of its samples, together with the carla waypoints of the samples. A look-ahead or look-behind window
+    of the local planner is then a slice of these arrays around the ego s-coordinate,
+    instead of a chain of waypoint.next()/previous() calls on the map.
+    """
+
+    def __init__(self, route_frame, max_offset=0.5):
+        """
+        :param route_frame: RouteFrame of the chosen route
+        :param max_offset: extra lateral distance beyond half lane width still treated as on the route, meters
+        """
+        self.frame = route_frame
+        self.max_offset = max_offset
+        self.num_lanes = route_frame.num_lanes
+        self.lanes = []
+        for start, size in zip(route_frame.loop_start, route_frame.loop_size):
+            sl = slice(start, start + size)
+            self.lanes.append({'x': route_frame.xyz[sl, 0], 'y': route_frame.xyz[sl, 1], 'z': route_frame.xyz[sl, 2],
+                               'yaw': route_frame.yaw[sl], 'width': route_frame.width[sl], 's': route_frame.s[sl]})
+
+    def locate(self, point, lane=None):
+        """
+        Lane loop index and arc length of a world point, lane is its nearest lane loop if not given
+        :return: (lane, s), None if the point is off the route
+        """
+        s, d, idx = self.frame._project(np.asarray(point, dtype=np.float64).reshape((1, -1)), lane)
+        if lane is None and abs(d[0]) > self.frame.width[idx[0]] / 2 + self.max_offset:
+            return None
+        return int(self.frame.lane[idx[0]]), float(s[0])
+
+    def indexes(self, lane, s, count, spacing, direction=True, offsets=None):
+        """
+        Route sample indexes of a window on a lane loop
+        :param s: arc length of the window anchor, the anchor itself is excluded
+        :param count: number of samples
+        :param spacing: arc length between two samples, meters
+        :param direction: True -- in front of the anchor, False -- behind the anchor
+        :param offsets: optional sample offsets in multiples of spacing, replace the count uniform samples
+        """
+        lane_s = self.lanes[lane]['s']
+        length = self.frame.loop_length[lane]
+        steps = (np.arange(1, count + 1) if offsets is None else np.asarray(offsets)) * spacing
+        targets = np.mod(s + steps if direction else s - steps, length)
+        # nearest sample of every target arc length, the loop wraps around
+        right = np.searchsorted(lane_s, targets) % len(lane_s)
+        left = (right - 1) % len(lane_s)
+        right_dis = np.mod(lane_s[right] - targets, length)
+        left_dis = np.mod(targets - lane_s[left], length)
+        return np.where(left_dis <= right_dis, left, right) + self.frame.loop_start[lane]
+
+    def window(self, lane, s, count, spacing, direction=True, offsets=None):
+        """Carla waypoints of a window on a lane loop, the same order as a waypoint.next()/previous() chain"""
+        waypoints = self.frame.waypoints
+        return [waypoints[i] for i in self.indexes(lane, s, count, spacing, direction, offsets)]
+
+    def neighbour(self, lane, offset):
+        """Index of the lane loop offset lanes to the right of lane (negative means left), None if there is none"""
+        neighbour = lane + offset
+        return neighbour if 0 <= neighbour < self.num_lanes else None
@@ -1,15 +1,108 @@
 import carla
 import copy
+import time
 import logging
+import numpy as np
+from bisect import bisect_left, bisect_right
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import Polygon
 from gym_carla.env.agent.global_planner import RoadOption
-from gym_carla.env.util.wrapper import WaypointWrapper,VehicleWrapper
+from gym_carla.env.util.wrapper import LazyWaypointWrapper,LazyVehicleWrapper
+from gym_carla.env.util.spatial import get_vehicle_index
 from gym_carla.env.settings import ROADS, STRAIGHT, CURVE, JUNCTION, DOUBLE_DIRECTION, DISTURB_ROADS
 from gym_carla.env.util.misc import get_lane_center, get_speed, vector, compute_magnitude_angle, \
     is_within_distance_ahead, is_within_distance_rear, draw_waypoints, compute_distance, is_within_distance, test_waypoint,\
     get_trafficlight_trigger_location
 
+# thread pools shared by the local planners of the process keyed by worker count, the planner is recreated on every reset
+_EXECUTORS = {}
+# stop line indexes keyed by (map name, world id), the traffic lights live as long as the world
+_STOP_LINE_INDEXES = {}
+# predecessor locations of waypoints keyed by (map name, sampling resolution), then by waypoint id,
+# only the lane store and lane grid windows reuse their waypoints across steps
+_PREDECESSORS = {}
+_PREDECESSOR_CACHE_SIZE = 100000
+# the front windows are read by index up to here (basic_lanechanging_agent target waypoints, CarlaEnv._truncated),
+# so their first samples are always one sampling resolution apart
+DENSE_FRONT_SAMPLES = 15
+# outputs of run_step, the consumers declare the ones they read every step, the others are computed on first access
+FEATURES = ('front_waypoints', 'rear_waypoints', 'lights', 'vehicles')
+# window names of the left, center and right lanes, True -- front windows, False -- rear windows
+_WINDOWS = {True: ('left_front_wps', 'center_front_wps', 'right_front_wps'),
+            False: ('left_rear_wps', 'center_rear_wps', 'right_rear_wps')}
+
+
+def lookahead_offsets(profile, buffer_size):
+    """
+    Sample offsets of the front waypoint windows, in multiples of the sampling resolution
+    :param profile: '' for uniform windows, otherwise comma separated step:until pairs, e.g. '1:15,5:50'
+        places a sample every step up to 15, then every 5 steps up to 50
+    :param buffer_size: length of the look-ahead, the samples used by the observation (every buffer_size//10 steps)
+        and the first DENSE_FRONT_SAMPLES samples are always included
+    """
+    if not profile:
+        return np.arange(1, buffer_size + 1)
+    offsets = set(range(1, min(DENSE_FRONT_SAMPLES, buffer_size) + 1))
+    offsets.update(range(max(buffer_size // 10, 1), buffer_size + 1, max(buffer_size // 10, 1)))
+    start = 0
+    for pair in profile.split(','):
+        step, until = (int(value) for value in pair.split(':'))
+        offsets.update(range(start + step, min(until, buffer_size) + 1, step))
+        start = until
+    return np.array(sorted(offsets))
+
+
+def _get_executor(num_workers):
+    """The shared thread pool with num_workers threads, created on the first request of this worker count"""
+    if num_workers not in _EXECUTORS:
+        _EXECUTORS[num_workers] = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='local_planner')
+    return _EXECUTORS[num_workers]
+
+
+def get_stop_line_index(world, carla_map):
+    key = (carla_map.name, world.id)
+    if key not in _STOP_LINE_INDEXES:
+        _STOP_LINE_INDEXES[key] = StopLineIndex(world)
+    return _STOP_LINE_INDEXES[key]
+
+
+class StopLineIndex:
+    """
+    Stop lines of all traffic lights of the world, built once from get_stop_waypoints:
+        (road_id, lane_id) -> list of (s, light id, stop location) sorted by s
+    A lookup is a binary search on s, no actor is enumerated per step.
+    """
+
+    def __init__(self, world):
+        self.lights = {}
+        self.stop_waypoints = {}
+        self._lines = {}
+        for light in world.get_actors().filter('*traffic_light*'):
+            self.lights[light.id] = light
+            self.stop_waypoints[light.id] = light.get_stop_waypoints()
+            for wp in self.stop_waypoints[light.id]:
+                self._lines.setdefault((wp.road_id, wp.lane_id), []).append((wp.s, light.id, wp.transform.location))
+        for lines in self._lines.values():
+            lines.sort(key=lambda line: line[0])
+        self._s = {key: [line[0] for line in lines] for key, lines in self._lines.items()}
+
+    def query(self, road_id, lane_id, s, location, max_distance):
+        """The traffic light with the closest stop line on the lane within max_distance of location, None if there is none"""
+        lines = self._lines.get((road_id, lane_id))
+        if not lines:
+            return None
+        # the arc length between two points on a lane is at least their distance, search a wider s range for curves
+        keys = self._s[(road_id, lane_id)]
+        lo, hi = bisect_left(keys, s - 2 * max_distance), bisect_right(keys, s + 2 * max_distance)
+        light, min_distance = None, max_distance
+        for _, light_id, stop_location in lines[lo:hi]:
+            distance = stop_location.distance(location)
+            if distance <= min_distance:
+                light, min_distance = self.lights[light_id], distance
+        return light
+
+
 class LocalPlanner:
     def __init__(self, vehicle, 
             opt_dict = {'sampling_resolution': 4.0,
@@ -36,21 +129,119 @@ class LocalPlanner:
 
         self.vehicle_proximity = opt_dict['vehicle_proximity']
         self.traffic_light_proximity = opt_dict['traffic_light_proximity']
-
-        self.waypoints_info=None
-        self.lights_info=None
-        self.vehicles_info=None
+        self._stop_lines = get_stop_line_index(self._world, self._map)
+        self._predecessors = _PREDECESSORS.setdefault((self._map.name, self._sampling_radius), {})
+
+        # outputs computed by run_step and on first access, cleared every step
+        features = opt_dict.get('features')
+        self.features = set(FEATURES if features is None else features)
+        if not self.features <= set(FEATURES):
+            raise ValueError('unknown local planner features: %s' % (self.features - set(FEATURES)))
+        self._outputs = {}
+
+        # the six lane chains are independent map queries, the carla client releases the GIL while running them,
+        # so they run concurrently on a persistent thread pool, 0 workers runs them sequentially
+        self._num_workers = opt_dict.get('num_workers', 0)
+        self._executor = _get_executor(self._num_workers) if self._num_workers > 0 else None
+        # lane polyline store of the route, the waypoint windows are sliced from it instead of chained on the map
+        self._lane_store = opt_dict.get('lane_store')
+        # keep the waypoint windows of the last step and advance them by the distance travelled,
+        # the grids are rebuilt when ego vehicle changes road or lane
+        self._reuse_windows = opt_dict.get('reuse_windows', False)
+        self._lane_grids = {}
+        self._grid_key = None
+        # lane waypoints (left, center, right) the windows of the current step are chained from,
+        # None if the windows come from the lane store or the lane grids
+        self._window_origins = None
+        # lane membership cache of the other vehicles, shared across episodes
+        self._lane_cache = opt_dict.get('lane_cache')
+        # compiled lane graph of the route, replaces the get_left_lane/get_right_lane queries
+        self._lane_graph = opt_dict.get('lane_graph')
+        # sample offsets of the front windows in multiples of sampling resolution, dense near ego and sparse far ahead,
+        # only these samples are generated, the rear windows stay uniform
+        self.front_offsets = np.asarray(opt_dict.get('front_offsets', np.arange(1, self._buffer_size + 1)))
+        self._uniform_front = np.array_equal(self.front_offsets, np.arange(1, self._buffer_size + 1))
+        # run_step latency of the recent steps, seconds
+        self.step_latency = deque(maxlen=100)
 
         self._waypoints_queue.append((self._current_waypoint, RoadOption.LANEFOLLOW))
         # self._waypoints_queue.append( (self._current_waypoint.next(self._sampling_radius)[0], RoadOption.LANEFOLLOW))
         # self._compute_next_waypoints(k=200)
 
     def run_step(self):
-        self.waypoints_info = self._get_waypoints()
-        self.lights_info=self._get_traffic_lights()
-        self.vehicles_info=self._get_vehicles()
-    
-        return WaypointWrapper(self.waypoints_info), self.lights_info, VehicleWrapper(self.vehicles_info)
+        """
+        Compute the declared features of the current step, return (waypoint wrapper, traffic light, vehicle wrapper).
+        The wrappers compute the undeclared windows and vehicles on first access,
+        the traffic light is None if it is not declared, read lights_info to get it.
+        """
+        start = time.perf_counter()
+        # a new dict every step, the wrappers of the past steps keep their own outputs
+        outputs = self._outputs = {}
+        directions = [direction for direction, feature in ((True, 'front_waypoints'), (False, 'rear_waypoints'))
+                      if feature in self.features]
+        if directions:
+            outputs.update(self._get_waypoints(directions))
+        if 'vehicles' in self.features:
+            outputs['vehicles'] = self._get_vehicles()
+        lights_info = self.lights_info if 'lights' in self.features else None
+        self.step_latency.append(time.perf_counter() - start)
+
+        return LazyWaypointWrapper(self, outputs), lights_info, LazyVehicleWrapper(self, outputs)
+
+    def declared_windows(self):
+        """Names of the waypoint windows computed by run_step"""
+        return [key for direction, feature in ((True, 'front_waypoints'), (False, 'rear_waypoints'))
+                if feature in self.features for key in _WINDOWS[direction]]
+
+    def _check_step(self, key, outputs):
+        if outputs is not self._outputs:
+            raise RuntimeError('%s of a past local planner step was not computed during that step, '
+                               'declare it in the features' % key)
+
+    def get_window(self, key, outputs=None):
+        """
+        Waypoint window by name, e.g. center_front_wps, computed on first access
+        :param outputs: outputs of the step returned by run_step, None for the current step
+        """
+        outputs = self._outputs if outputs is None else outputs
+        if key not in outputs:
+            self._check_step(key, outputs)
+            outputs.update(self._get_waypoints([key in _WINDOWS[True]]))
+        return outputs[key]
+
+    def get_vehicles(self, outputs=None):
+        """
+        Neighbour vehicles and gap distances, computed on first access
+        :param outputs: outputs of the step returned by run_step, None for the current step
+        """
+        outputs = self._outputs if outputs is None else outputs
+        if 'vehicles' not in outputs:
+            self._check_step('vehicles', outputs)
+            outputs['vehicles'] = self._get_vehicles()
+        return outputs['vehicles']
+
+    @property
+    def waypoints_info(self):
+        return {key: self.get_window(key) for keys in _WINDOWS.values() for key in keys}
+
+    @property
+    def lights_info(self):
+        if 'lights' not in self._outputs:
+            self._outputs['lights'] = self._get_traffic_lights()
+        return self._outputs['lights']
+
+    @property
+    def vehicles_info(self):
+        return self.get_vehicles()
+
+    def _window_heads(self, direction):
+        """First sample of the left, center and right windows ([] for a missing lane), without building whole windows"""
+        keys = _WINDOWS[direction]
+        if self._reuse_windows or all(key in self._outputs for key in keys):
+            return [self.get_window(key)[:1] for key in keys]
+        # the second rear sample is the predecessor of the first one, the reference of the rear gap distances
+        heads = self._get_waypoints([direction], np.array([1]) if direction else np.array([1, 2]))
+        return [heads[key] for key in keys]
 
     # def _get_traffic_lights(self):
     #     lights_list = self._world.get_actors().filter("*traffic_light*")
@@ -105,63 +296,62 @@ class LocalPlanner:
             - traffic_light is the object itself or None if there is no
             red traffic light affecting us
         """
-        lights_list=self._world.get_actors().filter("*traffic_light*")
         ego_vehicle_location = self._vehicle.get_location()
         ego_vehicle_waypoint = self._map.get_waypoint(ego_vehicle_location)
-        
-        sel_traffic_light = None
 
         if ego_vehicle_waypoint.is_junction:
             # It is too late. Do not block the intersection! Keep going!
-            return sel_traffic_light
+            return None
+
+        return self._stop_lines.query(ego_vehicle_waypoint.road_id, ego_vehicle_waypoint.lane_id, ego_vehicle_waypoint.s,
+                                      ego_vehicle_location, self.traffic_light_proximity)
+
+    def get_stop_waypoints(self, traffic_light):
+        """Stop waypoints of a traffic light from the stop line index"""
+        wps = self._stop_lines.stop_waypoints.get(traffic_light.id)
+        return wps if wps is not None else traffic_light.get_stop_waypoints()
 
-        for traffic_light in lights_list:
-            wps=traffic_light.get_stop_waypoints()
-            for wp in wps:
-                if wp.road_id==ego_vehicle_waypoint.road_id:
-                    if wp.lane_id==ego_vehicle_waypoint.lane_id and \
-                            wp.transform.location.distance(ego_vehicle_location)<=self.traffic_light_proximity:
-                        sel_traffic_light=traffic_light
-                        return sel_traffic_light
+    def get_latency(self):
+        """Mean run_step latency of the recent steps, seconds"""
+        if not self.step_latency:
+            return 0.0
+        return sum(self.step_latency) / len(self.step_latency)
 
-        return sel_traffic_light         
+    def _map_calls(self, func, args_list):
+        """Run func on each args tuple, concurrently if the thread pool is enabled, results keep the order of args_list"""
+        if self._executor is None:
+            return [func(*args) for args in args_list]
+        futures = [self._executor.submit(func, *args) for args in args_list]
+        return [future.result() for future in futures]
 
     def _get_vehicles(self):
         # retrieve relevant elements for safe navigation, i.e.: other vehicles
-        def caculate_dis(wps,dis_list,veh):
-            if len(wps)==0:
-                dis_list.append(0)
-            else:
-                if veh:
-                    pre_wps=wps[0].previous(self._sampling_radius)
-                    pre_wp=None
-                    if len(pre_wps)==1:
-                        pre_wp=pre_wps[0]
-                    elif len(pre_wps)!=0:
-                        for i, wp in enumerate(pre_wps):
-                            if wp.road_id in ROADS:
-                                pre_wp = wp
-                        
-                    dis_list.append(pre_wp.transform.location.distance(veh.get_location()))
-                else:
-                    dis_list.append(self.vehicle_proximity)
-
-        vehicle_list=self._world.get_actors().filter("*vehicle*")
-        left_front_veh=self._get_vehicles_one_lane(vehicle_list,True,-1)
-        left_rear_veh=self._get_vehicles_one_lane(vehicle_list,False,-1)
-        center_front_veh=self._get_vehicles_one_lane(vehicle_list,True,0)
-        center_rear_veh=self._get_vehicles_one_lane(vehicle_list,False,0)
-        right_front_veh=self._get_vehicles_one_lane(vehicle_list,True,1)
-        right_rear_veh=self._get_vehicles_one_lane(vehicle_list,False,1)
-
-        distance_to_front_vehicles=[]
-        distance_to_rear_vehicles=[]
-        caculate_dis(self.waypoints_info['left_front_wps'],distance_to_front_vehicles,left_front_veh)
-        caculate_dis(self.waypoints_info['center_front_wps'],distance_to_front_vehicles,center_front_veh)
-        caculate_dis(self.waypoints_info['right_front_wps'],distance_to_front_vehicles,right_front_veh)
-        caculate_dis(self.waypoints_info['left_rear_wps'],distance_to_rear_vehicles,left_rear_veh)
-        caculate_dis(self.waypoints_info['center_rear_wps'],distance_to_rear_vehicles,center_rear_veh)
-        caculate_dis(self.waypoints_info['right_rear_wps'],distance_to_rear_vehicles,right_rear_veh)
+        # vehicles farther than vehicle_proximity can't be selected in any lane
+        vehicle_list=get_vehicle_index(self._world).query_radius(self._vehicle.get_location(), self.vehicle_proximity + 1.0,
+                                                                 self._vehicle.id)
+        assignments = None
+        if self._lane_cache is not None:
+            # the lane membership of each vehicle is shared by the six lane searches
+            frame = self._world.get_snapshot().frame
+            assignments = {vehicle.id: self._lane_cache.assign(vehicle, frame) for vehicle in vehicle_list}
+        left_front_veh, left_rear_veh, center_front_veh, center_rear_veh, right_front_veh, right_rear_veh = \
+            self._map_calls(self._get_vehicles_one_lane,
+                            [(vehicle_list, True, -1, assignments), (vehicle_list, False, -1, assignments),
+                             (vehicle_list, True, 0, assignments), (vehicle_list, False, 0, assignments),
+                             (vehicle_list, True, 1, assignments), (vehicle_list, False, 1, assignments)])
+
+        # the gap distances only need the first sample of each window
+        left_front_wps, center_front_wps, right_front_wps = self._window_heads(True)
+        left_rear_wps, center_rear_wps, right_rear_wps = self._window_heads(False)
+        distances=self._caculate_dis([(left_front_wps, left_front_veh),
+                                      (center_front_wps, center_front_veh),
+                                      (right_front_wps, right_front_veh),
+                                      (left_rear_wps, left_rear_veh),
+                                      (center_rear_wps, center_rear_veh),
+                                      (right_rear_wps, right_rear_veh)],
+                                     self._window_origins)
+        distance_to_front_vehicles=distances[:3]
+        distance_to_rear_vehicles=distances[3:]
 
         return {'left_front_veh':left_front_veh,
                 'left_rear_veh':left_rear_veh,
@@ -172,7 +362,58 @@ class LocalPlanner:
                 'dis_to_front_vehs':distance_to_front_vehicles,
                 'dis_to_rear_vehs':distance_to_rear_vehicles}
     
-    def _get_vehicles_one_lane(self,vehicle_list,direction=True,lane_offset=0):
+    def _caculate_dis(self, slots, origins=None):
+        """
+        Gap distances of the neighbour vehicle slots, measured from the predecessor of the first window waypoint.
+        The windows chained from a lane waypoint already hold the predecessor: it is the lane waypoint for a front
+        window and the second sample for a rear window, only the other windows look it up in the predecessor table.
+        :param slots: list of (waypoint window, vehicle or None), the left, center, right front then rear windows
+        :param origins: lane waypoints (left, center, right) the windows are chained from, None if not chained
+        :return: list of distances, 0 if the lane doesn't exist, vehicle_proximity if there is no vehicle
+        """
+        distances = np.zeros(len(slots))
+        refs, targets, index = [], [], []
+        for i, (wps, veh) in enumerate(slots):
+            if len(wps) == 0:
+                continue
+            if veh:
+                loc = veh.get_location()
+                if origins is not None and i < 3:
+                    ref = origins[i].transform.location
+                    refs.append((ref.x, ref.y, ref.z))
+                elif origins is not None and len(wps) > 1:
+                    ref = wps[1].transform.location
+                    refs.append((ref.x, ref.y, ref.z))
+                else:
+                    refs.append(self._predecessor(wps[0]))
+                targets.append((loc.x, loc.y, loc.z))
+                index.append(i)
+            else:
+                distances[i] = self.vehicle_proximity
+        if index:
+            distances[index] = np.linalg.norm(np.array(refs) - np.array(targets), axis=1)
+        return distances.tolist()
+
+    def _predecessor(self, waypoint):
+        """Location (x, y, z) of the waypoint sampling_resolution behind waypoint on the route, cached by waypoint id"""
+        location = self._predecessors.get(waypoint.id)
+        if location is None:
+            pre_wps = waypoint.previous(self._sampling_radius)
+            pre_wp = waypoint
+            if len(pre_wps) == 1:
+                pre_wp = pre_wps[0]
+            else:
+                for wp in pre_wps:
+                    if wp.road_id in ROADS:
+                        pre_wp = wp
+            loc = pre_wp.transform.location
+            location = (loc.x, loc.y, loc.z)
+            if len(self._predecessors) >= _PREDECESSOR_CACHE_SIZE:
+                self._predecessors.clear()
+            self._predecessors[waypoint.id] = location
+        return location
+
+    def _get_vehicles_one_lane(self,vehicle_list,direction=True,lane_offset=0,assignments=None):
         """
         Check if a given vehicle is an obstacle in our way. To this end we take
         into account the road and lane the target vehicle is on and run a
@@ -188,11 +429,12 @@ class LocalPlanner:
                             False--detec vehicles at the back of ego vehicle
         :param lane_offset: the lane relative to current ego vehicle's lane,
             minus value means left, positive value means right
+        :param assignments: optional dict of vehicle id -> (lane id, on lane, on route) from the lane assignment cache
         """
         
         ego_vehicle_location = self._vehicle.get_location()
         ego_vehicle_transform = self._vehicle.get_transform()
-        ego_vehicle_lane_center = get_lane_center(self._map, ego_vehicle_location)
+        ego_vehicle_lane_center = get_lane_center(self._map, ego_vehicle_location, self._lane_graph)
         if not test_waypoint(ego_vehicle_lane_center):
             return None
         
@@ -207,17 +449,22 @@ class LocalPlanner:
             if target_vehicle.id == self._vehicle.id:
                 continue
 
-            # if the object is not in our lane it's not an obstacle
-            target_vehicle_waypoint = self._map.get_waypoint(target_vehicle.get_location())
-            # check whether in the same road
-            target_lane_center = get_lane_center(self._map, target_vehicle.get_location())
-            if target_lane_center.transform.location.distance(target_vehicle.get_location()) > target_lane_center.lane_width / 2 + 0.1:
-                continue
-            if not test_waypoint(target_vehicle_waypoint):
-                continue
-            # check whether in the specific lane
-            if target_vehicle_waypoint.lane_id != lane_id:
-                continue
+            if assignments is not None:
+                target_lane_id, on_lane, on_route = assignments[target_vehicle.id]
+                if not on_lane or not on_route or target_lane_id != lane_id:
+                    continue
+            else:
+                # if the object is not in our lane it's not an obstacle
+                target_vehicle_waypoint = self._map.get_waypoint(target_vehicle.get_location())
+                # check whether in the same road
+                target_lane_center = get_lane_center(self._map, target_vehicle.get_location(), self._lane_graph)
+                if target_lane_center.transform.location.distance(target_vehicle.get_location()) > target_lane_center.lane_width / 2 + 0.1:
+                    continue
+                if not test_waypoint(target_vehicle_waypoint):
+                    continue
+                # check whether in the specific lane
+                if target_vehicle_waypoint.lane_id != lane_id:
+                    continue
             # if target_vehicle_waypoint.road_id != ego_vehicle_waypoint.road_id or \
             #         target_vehicle_waypoint.lane_id != ego_vehicle_waypoint.lane_id:
             #     continue
@@ -238,59 +485,165 @@ class LocalPlanner:
 
         return vehicle
 
-    def _get_waypoints(self):
-        left_front_wps=None
-        left_rear_wps=None
-        center_front_wps=None
-        center_rear_wps=None
-        right_front_wps=None
-        right_rear_wps=None
+    def _get_waypoints(self, directions=(True, False), offsets=None):
+        """
+        Waypoint windows of the left, center and right lanes
+        :param directions: True -- the front windows, False -- the rear windows
+        :param offsets: optional sample offsets of the windows, replace the front offsets and the uniform rear windows
+        :return: dict of window name -> waypoint list, the lane grids (reuse_windows) always return all six windows
+        """
+        if self._lane_store is not None:
+            waypoints = self._get_waypoints_from_store(directions, offsets)
+            if waypoints is not None:
+                self._window_origins = None
+                return waypoints
 
-        lane_center = get_lane_center(self._map, self._vehicle.get_location())
+        lane_center = get_lane_center(self._map, self._vehicle.get_location(), self._lane_graph)
         lane_id = lane_center.lane_id
         left = None
         center = lane_center
         right = None
+        left_lane, right_lane = lambda wp: wp.get_left_lane(), lambda wp: wp.get_right_lane()
+        if self._lane_graph is not None:
+            left_lane, right_lane = self._lane_graph.left_lane, self._lane_graph.right_lane
         if lane_id == -1:
-            right = center.get_right_lane()
+            right = right_lane(center)
         elif lane_id == -2:
-            left = center.get_left_lane()
-            right = center.get_right_lane()
+            left = left_lane(center)
+            right = right_lane(center)
         elif lane_id == -3:
-            left = center.get_left_lane()
+            left = left_lane(center)
         else:
             lane_center=None
             #logging.error("WAYPOINTS GET BUG")
 
-        left_front_wps=self._get_waypoints_one_lane(left,True)
-        left_rear_wps=self._get_waypoints_one_lane(left,False)
-        center_front_wps=self._get_waypoints_one_lane(center,True)
-        center_rear_wps=self._get_waypoints_one_lane(center,False)
-        right_front_wps=self._get_waypoints_one_lane(right,True)
-        right_rear_wps=self._get_waypoints_one_lane(right,False)
-
-        return {'left_front_wps':list(left_front_wps),
-                'left_rear_wps':list(left_rear_wps),
-                'center_front_wps':list(center_front_wps),
-                'center_rear_wps':list(center_rear_wps),
-                'right_front_wps':list(right_front_wps),
-                'right_rear_wps':list(right_rear_wps)}
-
-    def _get_waypoints_one_lane(self, waypoint=None, direction=True):
+        if self._reuse_windows:
+            # the lane grids of the last step are only valid on the same road and lane
+            key = (center.road_id, center.lane_id)
+            if key != self._grid_key:
+                self._lane_grids = {}
+                self._grid_key = key
+            (left_front_wps, left_rear_wps), (center_front_wps, center_rear_wps), (right_front_wps, right_rear_wps) = \
+                self._map_calls(self._advance_lane_grid, [('left', left), ('center', center), ('right', right)])
+            self._window_origins = None
+            return {'left_front_wps':list(left_front_wps),
+                    'left_rear_wps':list(left_rear_wps),
+                    'center_front_wps':list(center_front_wps),
+                    'center_rear_wps':list(center_rear_wps),
+                    'right_front_wps':list(right_front_wps),
+                    'right_rear_wps':list(right_rear_wps)}
+
+        self._window_origins = (left, center, right)
+        args_list, keys = [], []
+        for direction in directions:
+            window_offsets = offsets
+            if window_offsets is None and direction and not self._uniform_front:
+                window_offsets = self.front_offsets
+            for key, waypoint in zip(_WINDOWS[direction], (left, center, right)):
+                args_list.append((waypoint, direction, window_offsets))
+                keys.append(key)
+        return {key: list(wps) for key, wps in zip(keys, self._map_calls(self._get_waypoints_one_lane, args_list))}
+
+    def _get_waypoints_from_store(self, directions=(True, False), offsets=None):
+        """Slice the waypoint windows out of the lane polyline store, None if ego vehicle is off the route"""
+        location = self._vehicle.get_location()
+        point = (location.x, location.y)
+        located = self._lane_store.locate(point)
+        if located is None:
+            return None
+        lane, _ = located
+        waypoints = {}
+        for i, offset in enumerate((-1, 0, 1)):
+            neighbour = self._lane_store.neighbour(lane, offset)
+            s = None if neighbour is None else self._lane_store.locate(point, neighbour)[1]
+            for direction in directions:
+                window_offsets = offsets if offsets is not None or not direction else self.front_offsets
+                waypoints[_WINDOWS[direction][i]] = [] if neighbour is None else self._lane_store.window(
+                    neighbour, s, self._buffer_size, self._sampling_radius, direction, window_offsets)
+        return waypoints
+
+    def _advance_lane_grid(self, name, waypoint):
+        """
+        Advance the waypoint grid of one lane to the current ego position and return its (front, rear) windows.
+        The grid keeps the samples of the last step in driving order, the samples passed by ego vehicle move
+        from the front window to the rear window, only the newly needed samples are queried from the map.
+        The windows are quantized to the grid: they are anchored at the grid sample closest to ego position
+        instead of ego position itself, so every sample is up to half a sampling resolution away from the sample
+        of a waypoint.next()/previous() chain started at ego position (the grid is rebuilt beyond one resolution).
+        :param name: lane name, left, center or right
+        :param waypoint: the waypoint of ego position on this lane
+        """
+        if waypoint is None:
+            self._lane_grids.pop(name, None)
+            return [], []
+        grid = self._lane_grids.get(name)
+        if grid is not None:
+            # the sample closest to ego position takes the place of the anchor waypoint
+            location = waypoint.transform.location
+            distances = [wp.transform.location.distance(location) for wp in grid]
+            anchor = min(range(len(grid)), key=distances.__getitem__)
+            if distances[anchor] > self._sampling_radius:
+                # ego vehicle left the grid, e.g. after a long step
+                grid = None
+        if grid is None:
+            front = self._get_waypoints_one_lane(waypoint, True)
+            rear = self._get_waypoints_one_lane(waypoint, False)
+            self._lane_grids[name] = deque(rear[::-1] + [waypoint] + front)
+            if not self._uniform_front:
+                front = [front[i - 1] for i in self.front_offsets if i <= len(front)]
+            return front, rear
+
+        for _ in range(anchor - self._buffer_size):
+            grid.popleft()
+        anchor = min(anchor, self._buffer_size)
+        anchor += self._extend_lane_grid(grid, False, self._buffer_size - anchor)
+        self._extend_lane_grid(grid, True, self._buffer_size - (len(grid) - anchor - 1))
+        while len(grid) - anchor - 1 > self._buffer_size:
+            grid.pop()
+        samples = list(grid)
+        front = samples[anchor + 1:]
+        if not self._uniform_front:
+            front = [front[i - 1] for i in self.front_offsets if i <= len(front)]
+        return front, samples[:anchor][::-1]
+
+    def _extend_lane_grid(self, grid, direction, k):
+        """Append k samples to the front (direction is True) or the back of a lane grid, return the number appended"""
+        count = 0
+        for _ in range(k):
+            if direction:
+                next_waypoints = list(grid[-1].next(self._sampling_radius))
+            else:
+                next_waypoints = list(grid[0].previous(self._sampling_radius))
+            if len(next_waypoints) == 0:
+                break
+            next_waypoint = next_waypoints[0]
+            for wp in next_waypoints:
+                if wp.road_id in ROADS:
+                    next_waypoint = wp
+            if direction:
+                grid.append(next_waypoint)
+            else:
+                grid.appendleft(next_waypoint)
+            count += 1
+        return count
+
+    def _get_waypoints_one_lane(self, waypoint=None, direction=True, offsets=None):
         """Get the  waypoint list according to ego vehicle's current location,
         direction = True: caculated waypoints in front of current location,
-        direction = False: caculated waypoints at the back of current location"""
+        direction = False: caculated waypoints at the back of current location
+        offsets: increasing sample offsets in multiples of sampling resolution, None for every offset up to buffer size"""
         _waypoints_queue = deque(maxlen=600)
         if waypoint is not None:
             _waypoints_queue.append(waypoint)
             available_entries = _waypoints_queue.maxlen - len(self._waypoints_queue)
             k = min(available_entries, self._buffer_size)
-            for _ in range(k):
+            steps = [1] * k if offsets is None else np.diff(offsets[offsets <= k], prepend=0)
+            for step in steps:
                 last_waypoint = _waypoints_queue[-1]
                 if direction:
-                    next_waypoints = list(last_waypoint.next(self._sampling_radius))
+                    next_waypoints = list(last_waypoint.next(self._sampling_radius * step))
                 else:
-                    next_waypoints = list(last_waypoint.previous(self._sampling_radius))
+                    next_waypoints = list(last_waypoint.previous(self._sampling_radius * step))
 
                 if len(next_waypoints) == 0:
                     break
@@ -452,6 +805,7 @@ class LocalPlanner:
 
     def set_sampling_redius(self, sampling_resolution):
         self._sampling_radius = sampling_resolution
+        self._predecessors = _PREDECESSORS.setdefault((self._map.name, self._sampling_radius), {})
 
     def set_min_distance(self, min_distance):
         self._min_distance = min_distance
@@ -0,0 +1,110 @@
+import carla
+import numpy as np
+from scipy.spatial import cKDTree
+
+# lane types indexed by the projection service
+LANE_TYPES = {'driving': carla.LaneType.Driving, 'shoulder': carla.LaneType.Shoulder, 'sidewalk': carla.LaneType.Sidewalk}
+
+
+class ProjectionService:
+    """
+    Client side batch map projection of the chosen route.
+
+    The driving, shoulder and sidewalk lanes beside every route waypoint are sampled once and indexed by a KD-tree,
+    a batch of points is then projected onto its nearest lane sample without calling the carla server.
+    Points outside the indexed area (farther than half a lane width aside or a sample step along the lane
+    from their nearest sample) fall back to map.get_waypoint.
+    """
+
+    def __init__(self, carla_map, route_waypoints, max_side_lanes=6):
+        """
+        :param carla_map: carla.Map, used to sample the lanes and by the fallback
+        :param route_waypoints: driving lane waypoints of the route, e.g. RouteFrame.waypoints
+        :param max_side_lanes: max number of lanes sampled on each side of a route waypoint
+        """
+        self._map = carla_map
+        names = {value: key for key, value in LANE_TYPES.items()}
+        samples, seen = [], set()
+        for route_wp in route_waypoints:
+            side_wps = [route_wp]
+            for get_lane in (lambda wp: wp.get_left_lane(), lambda wp: wp.get_right_lane()):
+                wp = route_wp
+                for _ in range(max_side_lanes):
+                    wp = get_lane(wp)
+                    if wp is None or wp.lane_type not in names:
+                        break
+                    side_wps.append(wp)
+            for wp in side_wps:
+                key = (wp.road_id, wp.lane_id, round(wp.s, 1))
+                if key in seen:
+                    continue
+                seen.add(key)
+                loc = wp.transform.location
+                samples.append((loc.x, loc.y, loc.z, np.radians(wp.transform.rotation.yaw), wp.lane_width,
+                                wp.road_id, wp.lane_id, wp.s, list(LANE_TYPES).index(names[wp.lane_type])))
+        samples = np.array(samples, dtype=np.float64).reshape((-1, 9))
+        self.xyz = samples[:, :3]
+        self.yaw = samples[:, 3]
+        self.width = samples[:, 4]
+        self.road_id = samples[:, 5].astype(np.int64)
+        self.lane_id = samples[:, 6].astype(np.int64)
+        self.s = samples[:, 7]
+        self.lane_type = samples[:, 8].astype(np.int64)
+        # max along lane distance between two neighbour samples of a lane
+        self.spacing = np.median(np.linalg.norm(np.diff(np.array(
+            [[wp.transform.location.x, wp.transform.location.y] for wp in route_waypoints]), axis=0), axis=1)) \
+            if len(route_waypoints) > 1 else 1.0
+        self._trees = {}
+        self.fallbacks = 0
+
+    def __len__(self):
+        return len(self.s)
+
+    def _tree(self, lane_types):
+        key = tuple(sorted(lane_types))
+        if key not in self._trees:
+            index = np.flatnonzero(np.isin(self.lane_type, [list(LANE_TYPES).index(name) for name in key]))
+            self._trees[key] = (cKDTree(self.xyz[index, :2]), index)
+        return self._trees[key]
+
+    def query(self, points, lane_types=('driving', 'shoulder', 'sidewalk')):
+        """
+        Project points onto the nearest indexed lane sample of the given lane types
+        :return: sample index, along lane offset, lateral offset (positive means right) and inside mask arrays
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, np.shape(points)[-1]))[:, :2]
+        tree, index = self._tree(lane_types)
+        idx = index[tree.query(points)[1]]
+        delta = points - self.xyz[idx, :2]
+        cos, sin = np.cos(self.yaw[idx]), np.sin(self.yaw[idx])
+        along = delta[:, 0] * cos + delta[:, 1] * sin
+        lateral = -delta[:, 0] * sin + delta[:, 1] * cos
+        inside = (np.abs(lateral) <= self.width[idx] / 2) & (np.abs(along) <= self.spacing)
+        return idx, along, lateral, inside
+
+    def project(self, points, lane_types=('driving', 'shoulder', 'sidewalk')):
+        """
+        Batch version of map.get_waypoint(location, project_to_road=True, lane_type=...)
+        :param points: array like (N, 2) or (N, 3) of world locations
+        :param lane_types: names of the lane types in LANE_TYPES to project onto
+        :return: road_id, lane_id, s, lateral offset arrays of shape (N,)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, np.shape(points)[-1]))
+        idx, along, lateral, inside = self.query(points, lane_types)
+        road_id, lane_id = self.road_id[idx].copy(), self.lane_id[idx].copy()
+        # the road s-coordinate grows along the lane direction on the right lanes (negative lane id)
+        s = self.s[idx] + np.where(lane_id < 0, along, -along)
+        lane_type = carla.LaneType.NONE
+        for name in lane_types:
+            lane_type = lane_type | LANE_TYPES[name]
+        for i in np.flatnonzero(~inside):
+            # outside the indexed area, ask the server
+            z = points[i, 2] if points.shape[1] > 2 else 0.0
+            location = carla.Location(x=points[i, 0], y=points[i, 1], z=z)
+            wp = self._map.get_waypoint(location, project_to_road=True, lane_type=lane_type)
+            self.fallbacks += 1
+            road_id[i], lane_id[i], s[i] = wp.road_id, wp.lane_id, wp.s
+            yaw = np.radians(wp.transform.rotation.yaw)
+            lateral[i] = -(points[i, 0] - wp.transform.location.x) * np.sin(yaw) + \
+                (points[i, 1] - wp.transform.location.y) * np.cos(yaw)
+        return road_id, lane_id, s, lateral
@@ -0,0 +1,120 @@
+import math
+import numpy as np
+from collections import Counter
+from scipy.spatial import cKDTree
+
+
+class RouteFrame:
+    """
+    Frenet (s, d) coordinate engine of the chosen route.
+
+    The route generated by GlobalPlanner is made of several closed lane loops. For each loop,
+    the waypoint samples are stored in arrays and the arc length s of every sample is precomputed,
+    so that world positions can be converted to (s, d, lane) in bulk without calling the carla server:
+        s: arc length along the lane loop, in [0, loop length)
+        d: lateral offset from the lane center, positive value means on the right of the lane direction
+        lane: index of the lane loop, 0 is the leftmost lane of the route
+    """
+
+    def __init__(self, global_planner):
+        loops = [loop for loop in global_planner.get_route_loops() if len(loop) > 1]
+        # order the lane loops from left to right, lane -1 is the leftmost driving lane
+        loops.sort(key=lambda loop: -Counter(wp.lane_id for wp in loop).most_common(1)[0][0])
+
+        xyz, yaw, width, road_id, lane_id, lane, s = [], [], [], [], [], [], []
+        self.loop_start = []
+        self.loop_length = []
+        for i, loop in enumerate(loops):
+            loc = np.array([[wp.transform.location.x, wp.transform.location.y, wp.transform.location.z] for wp in loop])
+            seg = np.linalg.norm(np.diff(np.vstack((loc, loc[:1])), axis=0)[:, :2], axis=1)
+            self.loop_start.append(sum(len(l) for l in loops[:i]))
+            self.loop_length.append(seg.sum())
+            xyz.append(loc)
+            s.append(np.concatenate(([0.0], np.cumsum(seg[:-1]))))
+            yaw.append([wp.transform.rotation.yaw for wp in loop])
+            width.append([wp.lane_width for wp in loop])
+            road_id.append([wp.road_id for wp in loop])
+            lane_id.append([wp.lane_id for wp in loop])
+            lane.append(np.full(len(loop), i))
+
+        self.waypoints = [wp for loop in loops for wp in loop]
+        self.xyz = np.concatenate(xyz)
+        self.s = np.concatenate(s)
+        self.yaw = np.radians(np.concatenate(yaw))
+        self.width = np.concatenate(width)
+        self.road_id = np.concatenate(road_id).astype(np.int64)
+        self.lane_id = np.concatenate(lane_id).astype(np.int64)
+        self.lane = np.concatenate(lane).astype(np.int64)
+        self.loop_start = np.array(self.loop_start, dtype=np.int64)
+        self.loop_size = np.array([len(loop) for loop in loops], dtype=np.int64)
+        self.loop_length = np.array(self.loop_length)
+        self.num_lanes = len(loops)
+
+        self._tree = cKDTree(self.xyz[:, :2])
+        self._lane_trees = [cKDTree(self.xyz[start:start + size, :2])
+                            for start, size in zip(self.loop_start, self.loop_size)]
+
+    def nearest(self, points, lane=None):
+        """Index of the nearest route sample of each point, restricted to one lane loop if lane is given"""
+        points = np.asarray(points, dtype=np.float64).reshape((-1, np.shape(points)[-1]))[:, :2]
+        if lane is None:
+            return self._tree.query(points)[1]
+        return self._lane_trees[lane].query(points)[1] + self.loop_start[lane]
+
+    def to_frenet(self, points, lane=None):
+        """
+        Convert world positions to the route frame
+        :param points: array like (N, 2) or (N, 3) of world locations
+        :param lane: project all points onto this lane loop, otherwise onto their nearest lane
+        :return: s, d, lane arrays of shape (N,)
+        """
+        s, d, idx = self._project(points, lane)
+        return s, d, self.lane[idx]
+
+    def heading_error(self, points, yaw):
+        """Heading error in degrees between yaw (degrees, array like) and the route direction at the points, in [-180, 180)"""
+        idx = self.nearest(points)
+        diff = np.asarray(yaw, dtype=np.float64) - np.degrees(self.yaw[idx])
+        return np.mod(diff + 180.0, 360.0) - 180.0
+
+    def lane_center_error(self, points):
+        """Lateral offset to the nearest lane center normalized by half lane width, 1 means on the lane border"""
+        _, d, idx = self._project(points)
+        return d / (self.width[idx] / 2)
+
+    def _project(self, points, lane=None):
+        points = np.asarray(points, dtype=np.float64).reshape((-1, np.shape(points)[-1]))[:, :2]
+        idx = self.nearest(points, lane)
+        delta = points - self.xyz[idx, :2]
+        cos, sin = np.cos(self.yaw[idx]), np.sin(self.yaw[idx])
+        # project onto the tangent and the right normal of the nearest sample
+        s = np.mod(self.s[idx] + delta[:, 0] * cos + delta[:, 1] * sin, self.loop_length[self.lane[idx]])
+        d = -delta[:, 0] * sin + delta[:, 1] * cos
+        return s, d, idx
+
+    def longitudinal_gap(self, s_from, s_to, lane):
+        """Signed arc length from s_from to s_to on the lane loop, wrapped into [-length/2, length/2)"""
+        length = self.loop_length[lane]
+        return np.mod(np.asarray(s_to) - np.asarray(s_from) + length / 2, length) - length / 2
+
+    def gaps(self, ego_point, points, ego_lane=None):
+        """
+        Longitudinal gaps and lane offsets of all points relative to ego vehicle.
+        All points are projected onto the ego lane loop so that gaps on neighbour lanes are comparable.
+        :return: gap (positive means in front of ego vehicle), lane offset (negative means left lane) arrays
+        """
+        ego_s, _, lane = self.to_frenet(ego_point, ego_lane)
+        lane = int(lane[0])
+        s, _, _ = self.to_frenet(points, lane)
+        _, _, point_lane = self.to_frenet(points)
+        return self.longitudinal_gap(ego_s[0], s, lane), point_lane - lane
+
+
+def time_to_collision(gap, rear_speed, front_speed):
+    """Time before the rear vehicle reaches the front one, inf if they are not closing, element-wise on arrays"""
+    gap = np.asarray(gap, dtype=np.float64)
+    closing = np.asarray(rear_speed, dtype=np.float64) - np.asarray(front_speed, dtype=np.float64)
+    ttc = np.full(np.broadcast(gap, closing).shape, math.inf)
+    mask = np.broadcast_to(closing > 1e-7, ttc.shape)
+    ttc[mask] = np.broadcast_to(gap, ttc.shape)[mask] / np.broadcast_to(closing, ttc.shape)[mask]
+    return ttc
@@ -8,15 +8,29 @@ from enum import Enum
 from queue import Queue
 from collections import deque
 #from gym_carla.env.agent.basic_agent import BasicAgent
-from gym_carla.env.agent.local_planner import LocalPlanner
+from gym_carla.env.agent.local_planner import LocalPlanner, lookahead_offsets
 from gym_carla.env.agent.global_planner import GlobalPlanner,RoadOption
+from gym_carla.env.agent.route_frame import RouteFrame, time_to_collision
+from gym_carla.env.agent.lane_store import LanePolylineStore
+from gym_carla.env.agent.lane_cache import LaneAssignmentCache
+from gym_carla.env.agent.projection import ProjectionService
+from gym_carla.env.agent.lane_graph import get_lane_graph
 from gym_carla.env.agent.basic_lanechanging_agent import Basic_Lanechanging_Agent
-from gym_carla.env.util.sensor import CollisionSensor, LaneInvasionSensor, SemanticTags
+from gym_carla.env.util.sensor import CollisionSensor, LaneInvasionSensor, SemanticTags, \
+    GeometricCollisionDetector, LaneDepartureDetector
+from gym_carla.env.util.spatial import SpatialHash
+from gym_carla.env.util.render import BirdeyeRender
+from gym_carla.env.util.reward import vehicle_gap, vehicle_length, ttc_rewards
+from gym_carla.env.util.scenario import ScenarioBank, capture_snapshot, snapshot_commands
+from gym_carla.env.util.governor import TickGovernor
+from gym_carla.env.util.command import CommandCollector
+from gym_carla.env.settings import GOVERNOR_LOG_PATH
 from gym_carla.env.util.wrapper import WaypointWrapper,VehicleWrapper,Action,SpeedState,Truncated,process_lane_wp,process_veh, \
     process_steer,recover_steer,fill_action_param,ttc_reward,comfort,pdqn_lane_center,calculate_guide_lane_center
 from gym_carla.env.util.misc import draw_waypoints, get_speed, get_acceleration, test_waypoint, \
-    compute_distance, get_actor_polygons, get_lane_center, remove_unnecessary_objects, get_yaw_diff, \
-    get_trafficlight_trigger_location, is_within_distance, get_sign,is_within_distance_ahead,get_projection
+    compute_distance, get_actor_polygons, get_actor_polygons_batch, get_lane_center, remove_unnecessary_objects, get_yaw_diff, \
+    get_trafficlight_trigger_location, is_within_distance, get_sign,is_within_distance_ahead,get_projection, \
+    load_world_cache, save_world_cache
 
 class CarlaEnv:
     def __init__(self, args, train_pdqn=False, modify_change_steer=False) -> None:
@@ -27,19 +41,32 @@ class CarlaEnv:
         self.sync = args.sync
         self.fps = args.fps
         self.no_rendering = args.no_rendering
+        self.birdeye = args.birdeye
+        self.geometric_sensors = args.geometric_sensors
+        self.pixels_per_meter = args.pixels_per_meter
         self.ego_filter = args.filter
         self.loop = args.loop
         self.agent = args.agent
         self.behavior = args.behavior
         self.res = args.res
         self.num_of_vehicles = args.num_of_vehicles
+        self.settle_ticks = args.settle_ticks
         self.sampling_resolution = args.sampling_resolution
         self.min_distance = args.min_distance
         self.vehicle_proximity = args.vehicle_proximity
         self.traffic_light_proximity = args.traffic_light_proximity
+        self.planner_workers = args.planner_workers
+        self.reuse_windows = args.reuse_windows
+        self.front_offsets = lookahead_offsets(args.lookahead, args.buffer_size)
+        # local planner outputs computed every step, the others are computed only when read
+        # the traffic light is returned by run_step and read by the env state on every step
+        self.planner_features = args.planner_features.split(',') + ['lights'] if args.planner_features else None
         self.hybrid = args.hybrid
+        self.hybrid_radius = args.hybrid_radius
         self.auto_lanechange = args.auto_lane_change
         self.guide_change = args.guide_change
+        # TTC and lane center reward terms from the route frame arrays instead of the lane center waypoint
+        self.route_frame_reward = args.route_frame_reward
         self.stride = args.stride
         self.buffer_size = args.buffer_size
         self.pre_train_steps = args.pre_train_steps
@@ -57,16 +84,29 @@ class CarlaEnv:
         self.ignore_traffic_light = args.ignore_traffic_light
 
         logging.info('listening to server %s:%s', args.host, args.port)
+        # time cost of each startup phase, seconds
+        self.startup_time = {}
+        start = time.time()
         self.client = carla.Client(self.host, self.port)
         self.client.set_timeout(10.0)
-        self.world = self.client.load_world(args.map)
-        remove_unnecessary_objects(self.world)
-        self.map = self.world.get_map()
+        self.startup_time['connect'] = time.time() - start
+        self.world, self.map = self._prepare_world(args.map, args.reuse_world)
         self.origin_settings = self.world.get_settings()
+        # controls and autopilot changes of a step are submitted together with the world tick
+        self.commands = CommandCollector(self.client, self.world)
+        # frame id of the last step tick
+        self.frame = None
         self.traffic_manager = None
         self.speed_state = SpeedState.START
+        start = time.time()
         self._set_traffic_manager()
+        self.startup_time['traffic_manager'] = time.time() - start
         logging.info('Carla server connected')
+        # keep the target steps per second by adjusting the simulation load
+        self.governor = None
+        if args.tick_budget > 0:
+            self.governor = TickGovernor(args.tick_budget, self.num_of_vehicles, self.hybrid_radius,
+                                         max_radius=max(self.hybrid_radius, 100.0), log_path=GOVERNOR_LOG_PATH)
 
         # Record the time of total steps
         self.reset_step = 0
@@ -90,9 +130,29 @@ class CarlaEnv:
         self.calculate_impact = None
 
         # generate ego vehicle spawn points on chosen route
+        start = time.time()
         self.global_planner = GlobalPlanner(self.map, self.sampling_resolution)
+        # Frenet coordinate engine of the chosen route
+        self.route_frame = RouteFrame(self.global_planner)
+        # arc length indexed lane polylines, the local planner slices its waypoint windows from them
+        self.lane_store = LanePolylineStore(self.route_frame) if args.lane_store else None
+        # batch map projection over the lanes beside the route, the server is only asked outside of them
+        self.projection = ProjectionService(self.map, self.route_frame.waypoints) if args.projection else None
+        # compiled left/right/successor/predecessor arrays of the lanes beside the route, loaded from disk if saved
+        self.lane_graph = get_lane_graph(self.map, self.route_frame.waypoints, self.sampling_resolution) \
+            if args.lane_graph else None
+        # lane membership of the companion vehicles, recomputed only when they move across lanes or roads
+        self.lane_cache = LaneAssignmentCache(self.map, self.route_frame, projection=self.projection) \
+            if args.lane_cache else None
+        self.startup_time['global_planner'] = time.time() - start
+        # the route is only rasterized when the birdeye view is used, render() creates the renderer on first request
+        self.birdeye_render = None
+        if self.birdeye:
+            self._init_renderer()
         self.local_planner = None
         self.spawn_points = self.global_planner.get_spawn_points()
+        # settled traffic snapshots, restored on reset instead of spawning new traffic
+        self.scenario_bank = ScenarioBank(self.map.name) if args.scenario_bank else None
         # for p in self.spawn_points:
         #     print(p.lane_id)
         self.ego_spawn_point = None
@@ -112,13 +172,20 @@ class CarlaEnv:
         self.vel_buffer=deque(maxlen=10)
         self.rear_vel_deque = deque(maxlen=2)
         self.step_info = None
+        # states saved by save_state, keyed by token
+        self._saved_states = {}
+        self._state_token = 0
 
         if self.debug:
             # draw_waypoints(self.world,self.global_panner.get_route())
             random.seed(self.seed)
 
         # Set fixed simulation step for synchronous mode
+        start = time.time()
         self._set_synchronous_mode()
+        self.startup_time['synchronous_mode'] = time.time() - start
+        logging.info('startup time: %s, total %.2fs',
+                     ', '.join('%s %.2fs' % (k, v) for k, v in self.startup_time.items()), sum(self.startup_time.values()))
 
         # Set weather
         # self.world.set_weather(carla.WeatherParamertes.ClearNoon)
@@ -126,6 +193,16 @@ class CarlaEnv:
         self.companion_vehicles = []
         self.vehicle_polygons = []
         self.ego_vehicle = None
+        # spatial hash of companion vehicle centers, rebuilt on every reset
+        self.occupancy = None
+        # soft reset keeps companion traffic running and only respawns ego vehicle
+        self.soft_reset = args.soft_reset
+        self.full_reset_interval = args.full_reset_interval
+        self.episodes_since_rebuild = 0
+        # ids of the actors destroyed by the last soft reset
+        self.destroyed_ids = []
+        # ego vehicle spawn point should be free of companion vehicles within this distance, meters
+        self.spawn_free_distance = 8.0
 
         # Collision sensor
         self.collision_sensor = None
@@ -141,15 +218,32 @@ class CarlaEnv:
         self.world.apply_settings(self.origin_settings)
         self._clear_actors(['vehicle.*', 'sensor.other.collison', 'sensor.camera.rgb', 'sensor.other.lane_invasion'])
 
-    def reset(self):
+    def reset(self, full_rebuild=False):
+        """
+        Reset the episode. With soft_reset, only ego vehicle and its sensors and controllers are respawned,
+        companion traffic keeps running, the whole world is rebuilt every full_reset_interval episodes
+        :param full_rebuild: True to rebuild the whole world now
+        """
+        soft = self.soft_reset and not full_rebuild and self.ego_vehicle is not None and \
+            self.episodes_since_rebuild < self.full_reset_interval
         if self.ego_vehicle is not None:
             # self.world.apply_settings(self.origin_settings)
             # self._set_synchronous_mode()
-            self._clear_actors(
-                ['*vehicle.*', 'sensor.other.collison', 'sensor.camera.rgb', 'sensor.other.lane_invasion'])
+            if soft:
+                self._destroy_ego()
+            else:
+                self._clear_actors(
+                    ['*vehicle.*', 'sensor.other.collison', 'sensor.camera.rgb', 'sensor.other.lane_invasion'])
+                self.companion_vehicles.clear()
+                if self.lane_cache is not None:
+                    self.lane_cache.clear()
+            if self.lane_cache is not None:
+                logging.info('lane cache: %s', self.lane_cache.stats())
+                self.lane_cache.reset_stats()
             self.ego_vehicle = None
+            self.commands.clear()
+            self._saved_states.clear()
             self.vehicle_polygons.clear()
-            self.companion_vehicles.clear()
             self.collision_sensor = None
             self.lane_invasion_sensor = None
             self.camera = None
@@ -157,28 +251,55 @@ class CarlaEnv:
             while (self.sensor_queue.empty() is False):
                 self.sensor_queue.get(block=False)
 
-        # Spawn surrounding vehicles
-        self._spawn_companion_vehicles()
+        if soft:
+            self.episodes_since_rebuild += 1
+        else:
+            self.episodes_since_rebuild = 0
+            # Spawn surrounding vehicles, restore a settled traffic snapshot if there is one
+            num_of_vehicles = random.choice(self.governor.allowed_vehicles(self.num_of_vehicles)
+                                            if self.governor is not None else self.num_of_vehicles)
+            snapshot = self.scenario_bank.sample(num_of_vehicles) if self.scenario_bank is not None else None
+            if snapshot is not None:
+                self._restore_scenario(snapshot)
+            else:
+                self._spawn_companion_vehicles(num_of_vehicles)
         self.calculate_impact = 0
         self.rear_vel_deque.append(-1)
         self.rear_vel_deque.append(-1)
-        # Get actors polygon list
-        vehicle_poly_dict = get_actor_polygons(self.world, 'vehicle.*')
-        self.vehicle_polygons.append(vehicle_poly_dict)
-                #set traffic light elpse time
-        lights_list=self.world.get_actors().filter("*traffic_light*")
-        for light in lights_list:
-            light.set_green_time(10)
-            light.set_red_time(5)
-            light.set_yellow_time(0)
+        # Get actors polygon list, the destroyed ego vehicle may stay in the actor list until the next tick
+        vehicle_ids, vehicle_polys = get_actor_polygons_batch(self.world, 'vehicle.*')
+        alive = ~np.isin(vehicle_ids, self.destroyed_ids)
+        vehicle_ids, vehicle_polys = vehicle_ids[alive], vehicle_polys[alive]
+        self.destroyed_ids = []
+        self.vehicle_polygons.append(dict(zip(vehicle_ids.tolist(), vehicle_polys)))
+        # Index the companion vehicle centers once, then only spawn ego vehicle on free spawn points
+        self.occupancy = SpatialHash(vehicle_polys.mean(axis=1), self.spawn_free_distance, vehicle_ids)
+        free_spawn_points = [p for p in self.spawn_points
+                             if self.occupancy.is_free(p.location.x, p.location.y, self.spawn_free_distance)]
+        if not soft:
+            #set traffic light elpse time, the lights keep their timing through soft resets
+            lights_list=self.world.get_actors().filter("*traffic_light*")
+            for light in lights_list:
+                light.set_green_time(10)
+                light.set_red_time(5)
+                light.set_yellow_time(0)
 
         # try to spawn ego vehicle
+        if not free_spawn_points:
+            logging.warning('no free spawn point for ego vehicle')
+            free_spawn_points = list(self.spawn_points)
         while self.ego_vehicle is None:
-            self.ego_spawn_point = random.choice(self.spawn_points)
+            self.ego_spawn_point = random.choice(free_spawn_points)
             self.ego_vehicle = self._try_spawn_ego_vehicle_at(self.ego_spawn_point)
+            if self.ego_vehicle is None and len(free_spawn_points) > 1:
+                free_spawn_points.remove(self.ego_spawn_point)
         # self.ego_vehicle.set_simulate_physics(False)
-        self.collision_sensor = CollisionSensor(self.ego_vehicle)
-        self.lane_invasion_sensor = LaneInvasionSensor(self.ego_vehicle)
+        if self.geometric_sensors:
+            self.collision_sensor = GeometricCollisionDetector(self.ego_vehicle)
+            self.lane_invasion_sensor = LaneDepartureDetector(self.ego_vehicle, self.map)
+        else:
+            self.collision_sensor = CollisionSensor(self.ego_vehicle)
+            self.lane_invasion_sensor = LaneInvasionSensor(self.ego_vehicle)
         # friction_bp=self.world.get_blueprint_library().find('static.trigger.friction')
         # bb_extent=self.ego_vehicle.bounding_box.extent
         # friction_bp.set_attribute('friction',str(0.0))
@@ -208,7 +329,14 @@ class CarlaEnv:
         self.local_planner = LocalPlanner(self.ego_vehicle, {'sampling_resolution': self.sampling_resolution,
                                                              'buffer_size': self.buffer_size,
                                                              'vehicle_proximity': self.vehicle_proximity,
-                                                             'traffic_light_proximity':self.traffic_light_proximity})
+                                                             'traffic_light_proximity':self.traffic_light_proximity,
+                                                             'num_workers': self.planner_workers,
+                                                             'lane_store': self.lane_store,
+                                                             'reuse_windows': self.reuse_windows,
+                                                             'lane_cache': self.lane_cache,
+                                                             'front_offsets': self.front_offsets,
+                                                             'features': self.planner_features,
+                                                             'lane_graph': self.lane_graph})
         # self.local_planner.set_global_plan(self.global_planner.get_route(
         #      self.map.get_waypoint(self.ego_vehicle.get_location())))
         self.current_lane=get_lane_center(self.map,self.ego_vehicle.get_location()).lane_id
@@ -267,11 +395,15 @@ class CarlaEnv:
         return self._get_state()
 
     def step(self, a_index, action):
-        self.autopilot_controller.set_info({'left_wps': self.wps_info.left_front_wps, 
+        step_start = time.time()
+        tick_time = 0
+        info = {'left_wps': self.wps_info.left_front_wps, 
                 'center_wps': self.wps_info.center_front_wps,'right_wps': self.wps_info.right_front_wps, 
-                'left_rear_wps': self.wps_info.left_rear_wps,'center_rear_wps': self.wps_info.center_rear_wps, 
-                'right_rear_wps': self.wps_info.right_rear_wps,
-                'vehs_info': self.vehs_info})
+                'vehs_info': self.vehs_info}
+        if 'rear_waypoints' in self.local_planner.features:
+            info.update({'left_rear_wps': self.wps_info.left_rear_wps,'center_rear_wps': self.wps_info.center_rear_wps, 
+                         'right_rear_wps': self.wps_info.right_rear_wps})
+        self.autopilot_controller.set_info(info)
         self.step_info = None
         self.lights_info=None
         self.control.steer,self.control.throttle,self.control.brake,self.control.gear=0.0, 0.0, 0.0, 1
@@ -355,7 +487,7 @@ class CarlaEnv:
                         self.control.throttle = 0
                         self.control.brake = abs(throttle_brake)
                 if self.is_effective_action():
-                    self.ego_vehicle.apply_control(self.control)
+                    self.commands.add(carla.command.ApplyVehicleControl(self.ego_vehicle, self.control))
             else:
                 #control.steer = np.clip(np.random.normal(control.steer,self.control_sigma['Steer']),-self.steer_bound,self.steer_bound)
                 if self.control.throttle > 0:
@@ -369,11 +501,16 @@ class CarlaEnv:
                 else:
                     self.control.throttle = 0
                     self.control.brake = abs(throttle_brake)
-                self.ego_vehicle.apply_control(self.control)
+                self.commands.add(carla.command.ApplyVehicleControl(self.ego_vehicle, self.control))
 
             # print(self.map.get_waypoint(self.ego_vehicle.get_location(),False),self.ego_vehicle.get_transform(),sep='\n')
             # print(self.world.get_snapshot().timestamp)
-            self.world.tick()
+            tick_start = time.time()
+            # the controls of this step are applied before the tick, frame is the first frame after them
+            self.frame = self.commands.flush(tick=True)
+            tick_time = time.time() - tick_start
+            self.collision_sensor.update()
+            self.lane_invasion_sensor.update()
             """Attention: the server's tick function only returns after it ran a fixed_delta_seconds, so the client need not to wait for
             the server, the world snapshot of tick returned already include the next state after the uploaded action."""
             # print(self.map.get_waypoint(self.ego_vehicle.get_location(),False),self.ego_vehicle.get_transform(),sep='\n')
@@ -396,16 +533,14 @@ class CarlaEnv:
                 self.last_lane, self.current_lane, self.last_target_lane, self.current_target_lane, self.last_action.value,self.current_action.value)
             print("Actual Control, change: ", self.control, self.current_action)
 
+            # only the declared windows are drawn, drawing the others would compute them
+            declared_wps = [wp for key in self.local_planner.declared_windows() for wp in getattr(self.wps_info, key)]
             if self.debug:
                 # draw_waypoints(self.world, [self.next_wps[0]], 60, z=1)
-                draw_waypoints(self.world, self.wps_info.center_front_wps+self.wps_info.center_rear_wps+\
-                    self.wps_info.left_front_wps+self.wps_info.left_rear_wps+self.wps_info.right_front_wps+self.wps_info.right_rear_wps, 
-                    1.0 / self.fps + 0.001, z=1)
+                draw_waypoints(self.world, declared_wps, 1.0 / self.fps + 0.001, z=1)
                 self.control = None
             else:
-                draw_waypoints(self.world, self.wps_info.center_front_wps+self.wps_info.center_rear_wps+\
-                    self.wps_info.left_front_wps+self.wps_info.left_rear_wps+self.wps_info.right_front_wps+self.wps_info.right_rear_wps, 
-                    1.0 / self.fps + 0.001, z=1)
+                draw_waypoints(self.world, declared_wps, 1.0 / self.fps + 0.001, z=1)
 
             spectator = self.world.get_spectator()
             transform = self.ego_vehicle.get_transform()
@@ -413,20 +548,9 @@ class CarlaEnv:
                                                     carla.Rotation(pitch=-90)))
             camera_data = self.sensor_queue.get(block=True)
 
-            temp = []
-            if self.vehs_info.left_rear_veh is not None:
-                temp.append(get_speed(self.vehs_info.left_rear_veh, False))
-            else:
-                temp.append(-1)
-            if self.vehs_info.center_rear_veh is not None:
-                temp.append(get_speed(self.vehs_info.center_rear_veh, False))
-            else:
-                temp.append(-1)
-            if self.vehs_info.right_rear_veh is not None:
-                temp.append(get_speed(self.vehs_info.right_rear_veh, False))
-            else:
-                temp.append(-1)
-            self.rear_vel_deque.append(temp)
+            # the impact reward only needs the speed of the center rear vehicle
+            center_rear_veh = self.vehs_info.center_rear_veh
+            self.rear_vel_deque.append(get_speed(center_rear_veh, False) if center_rear_veh is not None else -1)
 
             """Attention: The sequence of following code is pivotal, do not recklessly change their execution order"""
             state = self._get_state()
@@ -448,11 +572,16 @@ class CarlaEnv:
             else:
                 self.last_light_state=None
         else:
+            self.commands.flush()
             temp = self.world.wait_for_tick()
             self.world.on_tick(lambda _: {})
             time.sleep(1.0 / self.fps)
             reward,state,truncated,done,control_info=None,None,None,None,None
 
+        if self.governor is not None:
+            decision = self.governor.record(tick_time, time.time() - step_start)
+            if decision is not None and decision['kind'] == 'radius' and self.hybrid:
+                self.traffic_manager.set_hybrid_physics_radius(decision['new'])
         if self.debug:
             print(f"Speed:{get_speed(self.ego_vehicle, False)}, Acc:{get_acceleration(self.ego_vehicle, False)}")
         print(f"Current State:{self.speed_state}, RL In Control:{self.RL_switch}")
@@ -505,13 +634,150 @@ class CarlaEnv:
     def seed(self, seed=None):
         return
 
-    def render(self, mode):
-        pass
+    def render(self, mode='rgb_array'):
+        """Return the birdeye view image of ego vehicle, only rgb_array mode is supported"""
+        if mode != 'rgb_array':
+            return None
+        if self.birdeye_render is None:
+            self._init_renderer()
+        vehicle_ids, vehicle_polys = get_actor_polygons_batch(self.world, 'vehicle.*')
+        is_ego = vehicle_ids == self.ego_vehicle.id
+        route_wps = (self.wps_info.center_rear_wps or [])[::-1] + (self.wps_info.center_front_wps or [])
+        route = [[wp.transform.location.x, wp.transform.location.y] for wp in route_wps]
+        lights = None
+        if self.lights_info:
+            lights = [(str(self.lights_info.state), [(wp.transform.location.x, wp.transform.location.y,
+                                                      wp.transform.rotation.yaw, wp.lane_width)
+                                                     for wp in self.local_planner.get_stop_waypoints(self.lights_info)])]
+        return self.birdeye_render.render(self.ego_vehicle.get_transform(), vehicle_polys[~is_ego],
+                                          vehicle_polys[is_ego][0] if is_ego.any() else None, route, lights)
 
     def get_ego_lane(self):
         lane_center = get_lane_center(self.map, self.ego_vehicle.get_location())
         return lane_center.lane_id
 
+    def get_route_frame_info(self, vehicles=None):
+        """Route frame (Frenet) information of ego vehicle and the other vehicles, computed in bulk.
+        Gaps are measured between vehicle centers along the ego lane loop, positive means in front of ego vehicle,
+        lane_offset is relative to the ego lane, negative means left lane.
+        TTC is computed between ego vehicle and each vehicle along the gap direction, inf means not closing.
+
+        Args:
+            vehicles: the vehicles to include, all the other vehicles if None
+
+        Returns:
+            dict of arrays, keys: id, s, d, lane, gap, lane_offset, speed, ttc, and the ego_* values of ego vehicle
+        """
+        if vehicles is None:
+            vehicles = [v for v in self.world.get_actors().filter('*vehicle*') if v.id != self.ego_vehicle.id]
+        locations = [v.get_location() for v in vehicles]
+        points = np.array([[loc.x, loc.y] for loc in locations]).reshape((-1, 2))
+        speed = np.array([get_speed(v, False) for v in vehicles])
+        ego_location = self.ego_vehicle.get_location()
+        ego_point = [ego_location.x, ego_location.y]
+        ego_speed = get_speed(self.ego_vehicle, False)
+
+        ego_s, ego_d, ego_lane = self.route_frame.to_frenet(ego_point)
+        s, d, lane = self.route_frame.to_frenet(points)
+        gap, lane_offset = self.route_frame.gaps(ego_point, points)
+        ttc = np.where(gap >= 0, time_to_collision(gap, ego_speed, speed), time_to_collision(-gap, speed, ego_speed))
+        return {'id': np.array([v.id for v in vehicles], dtype=np.int64), 's': s, 'd': d, 'lane': lane,
+                'gap': gap, 'lane_offset': lane_offset, 'speed': speed, 'ttc': ttc,
+                'ego_s': ego_s[0], 'ego_d': ego_d[0], 'ego_lane': ego_lane[0], 'ego_speed': ego_speed,
+                'ego_lane_width': self.route_frame.width[self.route_frame.nearest(ego_point)[0]],
+                'ego_heading_error': self.route_frame.heading_error(ego_point, [self.ego_vehicle.get_transform().rotation.yaw])[0]}
+
+    def save_state(self):
+        """
+        Save the current world state and the episode bookkeeping, so that several rollouts can branch from it.
+        Only available in synchronous mode, the state is kept in memory until drop_state is called.
+        :return: token of the saved state, passed to restore_state
+        """
+        snapshot = self.world.get_snapshot()
+        vehicles = []
+        for vehicle in self.world.get_actors().filter('vehicle.*'):
+            actor_snapshot = snapshot.find(vehicle.id)
+            if actor_snapshot is None:
+                continue
+            transform = actor_snapshot.get_transform()
+            control = vehicle.get_control()
+            vehicles.append({'id': vehicle.id,
+                             'transform': carla.Transform(transform.location, transform.rotation),
+                             'velocity': actor_snapshot.get_velocity(),
+                             'angular_velocity': actor_snapshot.get_angular_velocity(),
+                             'control': carla.VehicleControl(throttle=control.throttle, steer=control.steer,
+                                                             brake=control.brake, hand_brake=control.hand_brake,
+                                                             reverse=control.reverse,
+                                                             manual_gear_shift=control.manual_gear_shift,
+                                                             gear=control.gear)})
+        lights = [(light, light.get_state(), light.get_green_time(), light.get_red_time(), light.get_yellow_time())
+                  for light in self.world.get_actors().filter('*traffic_light*')]
+        bookkeeping = {'time_step': self.time_step, 'speed_state': self.speed_state, 'RL_switch': self.RL_switch,
+                       'last_lane': self.last_lane, 'current_lane': self.current_lane,
+                       'last_target_lane': self.last_target_lane, 'current_target_lane': self.current_target_lane,
+                       'last_action': self.last_action, 'current_action': self.current_action,
+                       'last_light_state': self.last_light_state, 'last_acc': self.last_acc,
+                       'last_yaw': carla.Vector3D(self.last_yaw.x, self.last_yaw.y, self.last_yaw.z),
+                       'vel_buffer': list(self.vel_buffer), 'rear_vel_deque': copy.deepcopy(list(self.rear_vel_deque)),
+                       'calculate_impact': self.calculate_impact, 'control_sigma': dict(self.control_sigma)}
+        self._state_token += 1
+        self._saved_states[self._state_token] = {'frame': snapshot.frame, 'ego_id': self.ego_vehicle.id,
+                                                 'vehicles': vehicles, 'lights': lights, 'bookkeeping': bookkeeping}
+        return self._state_token
+
+    def restore_state(self, token):
+        """
+        Restore a state saved by save_state within the same episode, all vehicles are restored in one batch with a tick.
+        Traffic light phases restart from the beginning of the saved phase, the internal route intentions of the
+        traffic manager are not part of the state.
+        :return: the observation of the restored state
+        """
+        saved = self._saved_states[token]
+        if self.ego_vehicle is None or self.ego_vehicle.id != saved['ego_id']:
+            raise ValueError('state %s was saved in another episode' % token)
+        alive = set(actor.id for actor in self.world.get_actors().filter('vehicle.*'))
+        self.commands.clear()
+        for record in saved['vehicles']:
+            if record['id'] not in alive:
+                logging.warning('vehicle %s of saved state %s is destroyed', record['id'], token)
+                continue
+            self.commands.add(carla.command.ApplyTransform(record['id'], record['transform']))
+            self.commands.add(carla.command.ApplyTargetVelocity(record['id'], record['velocity']))
+            self.commands.add(carla.command.ApplyTargetAngularVelocity(record['id'], record['angular_velocity']))
+            self.commands.add(carla.command.ApplyVehicleControl(record['id'], record['control']))
+        for light, state, green_time, red_time, yellow_time in saved['lights']:
+            self.commands.defer(light.set_green_time, green_time)
+            self.commands.defer(light.set_red_time, red_time)
+            self.commands.defer(light.set_yellow_time, yellow_time)
+            self.commands.defer(light.set_state, state)
+        self.commands.flush(tick=True)
+        # drop the camera frames of the abandoned branch, keep the frame of the restore tick for the next step
+        camera_data = self.sensor_queue.get(block=True)
+        while not self.sensor_queue.empty():
+            camera_data = self.sensor_queue.get(block=False)
+        self.collision_sensor.clear_history()
+        self.collision_sensor.update()
+        self.lane_invasion_sensor.update()
+
+        bookkeeping = saved['bookkeeping']
+        for key in ('time_step', 'speed_state', 'RL_switch', 'last_lane', 'current_lane', 'last_target_lane',
+                    'current_target_lane', 'last_action', 'current_action', 'last_light_state', 'last_acc',
+                    'calculate_impact'):
+            setattr(self, key, bookkeeping[key])
+        self.last_yaw = carla.Vector3D(bookkeeping['last_yaw'].x, bookkeeping['last_yaw'].y, bookkeeping['last_yaw'].z)
+        self.control_sigma = dict(bookkeeping['control_sigma'])
+        self.vel_buffer.clear()
+        self.vel_buffer.extend(bookkeeping['vel_buffer'])
+        self.rear_vel_deque.clear()
+        self.rear_vel_deque.extend(copy.deepcopy(bookkeeping['rear_vel_deque']))
+        self.control = self.ego_vehicle.get_control()
+        self.wps_info, self.lights_info, self.vehs_info = self.local_planner.run_step()
+        return self._get_state()
+
+    def drop_state(self, token):
+        """Release the memory of a saved state"""
+        self._saved_states.pop(token, None)
+
     def _get_state(self):
         """return a tuple: the first element is next waypoints, the second element is vehicle_front information"""
 
@@ -519,31 +785,36 @@ class CarlaEnv:
         center_wps=self.wps_info.center_front_wps
         right_wps=self.wps_info.right_front_wps
 
-        lane_center = get_lane_center(self.map, self.ego_vehicle.get_location())
-        right_lane_dis = lane_center.get_right_lane().transform.location.distance(self.ego_vehicle.get_location())
+        lane_center = get_lane_center(self.map, self.ego_vehicle.get_location(), self.lane_graph)
+        if self.lane_graph is not None:
+            right_location, right_width = self.lane_graph.lateral_location(lane_center, 1)
+        else:
+            right_lane = lane_center.get_right_lane()
+            right_location, right_width = right_lane.transform.location, right_lane.lane_width
+        right_lane_dis = right_location.distance(self.ego_vehicle.get_location())
         if self.train_pdqn:
             t, fLcen = pdqn_lane_center(lane_center, self.ego_vehicle.get_location())
-            ego_t= lane_center.lane_width / 2 + lane_center.get_right_lane().lane_width / 2 - right_lane_dis
+            ego_t= lane_center.lane_width / 2 + right_width / 2 - right_lane_dis
         else:
-            t = lane_center.lane_width / 2 + lane_center.get_right_lane().lane_width / 2 - right_lane_dis
+            t = lane_center.lane_width / 2 + right_width / 2 - right_lane_dis
             ego_t=t
 
         ego_vehicle_z = lane_center.transform.location.z
         ego_forward_vector = self.ego_vehicle.get_transform().get_forward_vector()
         my_sample_ratio = self.buffer_size // 10
-        center_wps_processed = process_lane_wp(center_wps, ego_vehicle_z, ego_forward_vector, my_sample_ratio, 0)
+        center_wps_processed = process_lane_wp(center_wps, ego_vehicle_z, ego_forward_vector, my_sample_ratio, 0, self.front_offsets)
         if len(left_wps) == 0:
             left_wps_processed = center_wps_processed.copy()
             for left_wp in left_wps_processed:
                 left_wp[2] = -1
         else:
-            left_wps_processed = process_lane_wp(left_wps, ego_vehicle_z, ego_forward_vector, my_sample_ratio, -1)
+            left_wps_processed = process_lane_wp(left_wps, ego_vehicle_z, ego_forward_vector, my_sample_ratio, -1, self.front_offsets)
         if len(right_wps) == 0:
             right_wps_processed = center_wps_processed.copy()
             for right_wp in right_wps_processed:
                 right_wp[2] = 1
         else:
-            right_wps_processed = process_lane_wp(right_wps, ego_vehicle_z, ego_forward_vector, my_sample_ratio, 1)
+            right_wps_processed = process_lane_wp(right_wps, ego_vehicle_z, ego_forward_vector, my_sample_ratio, 1, self.front_offsets)
 
         left_wall = False
         if len(left_wps) == 0:
@@ -564,7 +835,7 @@ class CarlaEnv:
         a_s,a_t=get_projection(a_3d,yaw_forward)
 
         if self.lights_info:
-            wps=self.lights_info.get_stop_waypoints()
+            wps=self.local_planner.get_stop_waypoints(self.lights_info)
             stop_dis=1.0
             for wp in wps:
                 if wp.road_id==lane_center.road_id and wp.lane_id==lane_center.lane_id:
@@ -581,10 +852,13 @@ class CarlaEnv:
         """Attention:
         Upon initializing, there are some bugs in the theta_v and theta_a, which could be greater than 90,
         this might be caused by carla."""
-        return {'left_waypoints': left_wps_processed, 'center_waypoints': center_wps_processed,
+        state = {'left_waypoints': left_wps_processed, 'center_waypoints': center_wps_processed,
                 'right_waypoints': right_wps_processed, 'vehicle_info': vehicle_inlane_processed,
                 'ego_vehicle': [v_s/10, v_t/10, a_s/3, a_t/3, ego_t, yaw_diff_ego/90],
-                'light':light}  
+                'light':light}
+        if self.birdeye:
+            state['birdeye'] = self.render('rgb_array')
+        return state
 
     def _get_reward(self):
         """Calculate the step reward:
@@ -593,15 +867,27 @@ class CarlaEnv:
         Com: Ego vehicle comfort, ego vehicle acceration change rate
         Lcen: Distance between ego vehicle location and lane center
         """
-        fTTC=ttc_reward(self.ego_vehicle,self.vehs_info.center_front_veh,self.min_distance,self.TTC_THRESHOLD)
+        front_veh = self.vehs_info.center_front_veh
+        route_info = None
+        if self.route_frame_reward:
+            route_info = self.get_route_frame_info([front_veh] if front_veh else [])
+            # arc length gap along the ego lane loop minus the vehicle sizes, as ttc_reward does with the distance
+            front_gap = route_info['gap'][0] - vehicle_length(self.ego_vehicle, front_veh) if front_veh else float('inf')
+            fTTC = float(ttc_rewards(front_gap, route_info['ego_speed'], route_info['speed'][0] if front_veh else 0.0,
+                                     self.min_distance, self.TTC_THRESHOLD))
+        else:
+            front_gap = vehicle_gap(self.ego_vehicle, front_veh) if front_veh else float('inf')
+            fTTC=ttc_reward(self.ego_vehicle,front_veh,self.min_distance,self.TTC_THRESHOLD)
 
         lane_center = get_lane_center(self.map, self.ego_vehicle.get_location())
         yaw_forward = lane_center.transform.get_forward_vector().make_unit_vector()
         v_3d = self.ego_vehicle.get_velocity()
         v_s,v_t=get_projection(v_3d,yaw_forward)
         max_speed=self.speed_limit
+        light_distance = float('inf')
         if self.lights_info and self.lights_info.state!=carla.TrafficLightState.Green:
             dis=self.ego_vehicle.get_location().distance(self.lights_info.get_location())
+            light_distance = dis
             if dis<self.traffic_light_proximity:
                 max_speed=(dis+0.0001)/self.traffic_light_proximity*self.speed_limit
         if v_s * 3.6 > max_speed:
@@ -625,6 +911,10 @@ class CarlaEnv:
             if self.guide_change:
                 Lcen, fLcen = calculate_guide_lane_center(self.ego_vehicle.get_location(),lane_center, self.ego_vehicle.get_location(), 
                     self.vehs_info.distance_to_front_vehicles,self.vehs_info.distance_to_rear_vehicles)
+            elif route_info is not None:
+                Lcen = abs(route_info['ego_d'])
+                half_width = route_info['ego_lane_width'] / 2
+                fLcen = -2 if not test_waypoint(lane_center, True) or Lcen > half_width + 0.1 else -Lcen / half_width
             else:
                 Lcen = lane_center.transform.location.distance(self.ego_vehicle.get_location())
                 # print(
@@ -641,8 +931,8 @@ class CarlaEnv:
 
         impact = 0
         if self.calculate_impact != 0:
-            last_rear_vel = self.rear_vel_deque[0][1]
-            current_rear_vel = self.rear_vel_deque[1][1]
+            last_rear_vel = self.rear_vel_deque[0]
+            current_rear_vel = self.rear_vel_deque[1]
             if last_rear_vel == -1 or current_rear_vel == -1:
                 impact = 0
             else:
@@ -663,8 +953,20 @@ class CarlaEnv:
                           'Efficiency': fEff, 'Lane_center': fLcen, 'Yaw': fYaw, 'last_acc': self.last_acc,
                           'cur_acc': cur_acc, 'yaw_change': yaw_change, 'lane_changing_reward': lane_changing_reward,
                           'impact': impact, 'change_in_lane_follow': change_in_lane_follow, 'Abandon': False}
-        
+
         truncated=self._truncated()
+        # record the kinematics needed to recompute the reward offline, see gym_carla.env.util.reward
+        history, tags = self.collision_sensor.get_collision_history()
+        self.step_info.update({'episode': self.reset_step, 'time_step': self.time_step,
+                               'speed': get_speed(self.ego_vehicle, False),
+                               'front_gap': front_gap,
+                               'front_speed': get_speed(front_veh, False) if front_veh else 0.0,
+                               'light_distance': light_distance, 'lane_width': lane_center.lane_width,
+                               'on_lane': test_waypoint(lane_center, True), 'on_route': test_waypoint(lane_center),
+                               'lane_change': self.current_lane - self.last_lane, 'action': self.current_action.value,
+                               'front_distances': list(self.vehs_info.distance_to_front_vehicles),
+                               'truncated': truncated.value, 'collision': len(history) != 0,
+                               'vehicle_collision': SemanticTags.Vehicles in tags})
         if truncated!=Truncated.FALSE:
             if truncated==Truncated.CHANGE_LANE_IN_LANE_FOLLOW:
                 return -self.lane_penalty
@@ -750,7 +1052,7 @@ class CarlaEnv:
             return Truncated.NORMAL
         if self.lights_info and self.lights_info.state!=carla.TrafficLightState.Green:
             self.world.debug.draw_point(self.lights_info.get_location(),size=0.3,life_time=0)
-            wps=self.lights_info.get_stop_waypoints()
+            wps=self.local_planner.get_stop_waypoints(self.lights_info)
             for wp in wps:
                 self.world.debug.draw_point(wp.transform.location,size=0.1,life_time=0)
                 if is_within_distance_ahead(self.ego_vehicle.get_location(),wp.transform.location, wp.transform, self.min_distance):
@@ -878,9 +1180,14 @@ class CarlaEnv:
             return self.step_info
 
     def _ego_autopilot(self, setting=True):
-        # Use traffic manager to control ego vehicle
-        self.ego_vehicle.set_autopilot(setting, self.tm_port)
+        # Use traffic manager to control ego vehicle, submitted with the next world tick
+        self.commands.add_sync(carla.command.SetAutopilot(self.ego_vehicle, setting, self.tm_port))
         if setting:
+            self.commands.defer(self._set_ego_traffic_manager, self.speed_state == SpeedState.RUNNING)
+
+    def _set_ego_traffic_manager(self, running):
+        """Traffic manager settings of ego vehicle under autopilot, running: the speed state when autopilot was set"""
+        if self.ego_vehicle is not None:
             speed_diff = (30 - self.speed_limit) / 30 * 100
             self.traffic_manager.distance_to_leading_vehicle(self.ego_vehicle, self.min_distance)
             if self.ignore_traffic_light:
@@ -889,7 +1196,7 @@ class CarlaEnv:
             self.traffic_manager.ignore_signs_percentage(self.ego_vehicle, 100)
             self.traffic_manager.ignore_vehicles_percentage(self.ego_vehicle, 0)
             self.traffic_manager.vehicle_percentage_speed_difference(self.ego_vehicle, speed_diff)
-            if self.auto_lanechange and self.speed_state == SpeedState.RUNNING:
+            if self.auto_lanechange and running:
                 self.traffic_manager.auto_lane_change(self.ego_vehicle, True)
                 self.traffic_manager.random_left_lanechange_percentage(self.ego_vehicle, 100)
                 self.traffic_manager.random_right_lanechange_percentage(self.ego_vehicle, 100)
@@ -948,8 +1255,50 @@ class CarlaEnv:
         return bp
 
     def _init_renderer(self):
-        """Initialize the birdeye view renderer."""
-        pass
+        """Initialize the birdeye view renderer, the static layer of the route is rasterized once per map."""
+        start = time.time()
+        self.birdeye_render = BirdeyeRender(self.route_frame, self.map.name, self.pixels_per_meter)
+        self.startup_time['renderer'] = time.time() - start
+
+    def _prepare_world(self, map_name, reuse=True):
+        """Get the world with the requested map loaded and the unnecessary objects removed.
+        Carla can't query which map layers are loaded, so the world id (changed by every load_world or reload_world)
+        is recorded after preparing the world. If the server still runs the same world, it is reused directly.
+        The disabled environment object ids are cached per map to avoid searching them by labels again.
+
+        Returns:
+            world, map: carla.World and its carla.Map
+        """
+        start = time.time()
+        world = self.client.get_world()
+        carla_map = world.get_map()
+        self.startup_time['get_map'] = time.time() - start
+
+        cache = load_world_cache()
+        record = cache.get(map_name, {})
+        loaded = carla_map.name.split('/')[-1] == map_name
+        if reuse and loaded and record.get('world_id') == world.id:
+            logging.info('map %s already loaded and prepared, reuse world %d', map_name, world.id)
+            return world, carla_map
+
+        start = time.time()
+        if not reuse or not loaded:
+            world = self.client.load_world(map_name)
+            carla_map = None
+        self.startup_time['load_world'] = time.time() - start
+
+        start = time.time()
+        objs = record.get('disabled_objects')
+        objs = remove_unnecessary_objects(world, set(objs) if objs is not None else None)
+        self.startup_time['remove_objects'] = time.time() - start
+        cache[map_name] = {'world_id': world.id, 'disabled_objects': sorted(objs)}
+        save_world_cache(cache)
+
+        if carla_map is None:
+            start = time.time()
+            carla_map = world.get_map()
+            self.startup_time['get_map'] += time.time() - start
+        return world, carla_map
 
     def _set_synchronous_mode(self):
         """Set whether to use the synchronous mode."""
@@ -969,7 +1318,7 @@ class CarlaEnv:
         # Set physical mode only for cars around ego vehicle to save computation
         if self.hybrid:
             self.traffic_manager.set_hybrid_physics_mode(True)
-            self.traffic_manager.set_hybrid_physics_radius(100.0)
+            self.traffic_manager.set_hybrid_physics_radius(self.hybrid_radius)
 
         """The default global speed limit is 30 m/s
         Vehicles' target speed is 70% of their current speed limit unless any other value is set."""
@@ -978,6 +1327,19 @@ class CarlaEnv:
         self.traffic_manager.global_percentage_speed_difference(-100)
         self.traffic_manager.set_synchronous_mode(self.sync)
 
+    def _destroy_ego(self):
+        """Destroy ego vehicle and the sensors attached to it in one batch, companion vehicles are kept"""
+        actors = [self.camera, getattr(self.collision_sensor, 'sensor', None),
+                  getattr(self.lane_invasion_sensor, 'sensor', None)]
+        actors = [actor for actor in actors if actor is not None]
+        for sensor in actors:
+            sensor.stop()
+        actors.append(self.ego_vehicle)
+        self.destroyed_ids = [actor.id for actor in actors]
+        for response in self.client.apply_batch_sync([carla.command.DestroyActor(actor) for actor in actors]):
+            if response.has_error():
+                logging.warning('destroy ego error: %s', response.error)
+
     def _try_spawn_ego_vehicle_at(self, transform):
         """Try to spawn a  vehicle at specific transform
         Args:
@@ -988,16 +1350,7 @@ class CarlaEnv:
         """
         vehicle = None
         # Check if ego position overlaps with surrounding vehicles
-        overlap = False
-        for idx, poly in self.vehicle_polygons[-1].items():
-            poly_center = np.mean(poly, axis=0)
-            ego_center = np.array([transform.location.x, transform.location.y])
-            dis = np.linalg.norm(poly_center - ego_center)
-            if dis > 8:
-                continue
-            else:
-                overlap = True
-                break
+        overlap = not self.occupancy.is_free(transform.location.x, transform.location.y, self.spawn_free_distance)
 
         if not overlap:
             ego_bp = self._create_vehicle_blueprint(self.ego_filter, ego=True, color='0,255,0')
@@ -1010,7 +1363,64 @@ class CarlaEnv:
 
         return vehicle
 
-    def _spawn_companion_vehicles(self):
+    def generate_scenarios(self, num_per_density=10):
+        """
+        Generate settled traffic snapshots for every number of vehicles in num_of_vehicles and save them into the scenario bank.
+        The traffic runs settle_ticks ticks before each snapshot is captured.
+        Should be called before reset, all vehicles in the world are destroyed.
+        """
+        if self.scenario_bank is None:
+            self.scenario_bank = ScenarioBank(self.map.name)
+        for num_of_vehicles in self.num_of_vehicles:
+            for i in range(num_per_density):
+                self._clear_actors(['*vehicle.*'])
+                self.companion_vehicles.clear()
+                self._spawn_companion_vehicles(num_of_vehicles)
+                for _ in range(self.settle_ticks):
+                    if self.sync:
+                        self.world.tick()
+                    else:
+                        self.world.wait_for_tick()
+                self.scenario_bank.add(num_of_vehicles, capture_snapshot(self.companion_vehicles,
+                                                                         self._companion_tm_settings()))
+                logging.info('scenario snapshot %d/%d with %d vehicles generated', i + 1, num_per_density, num_of_vehicles)
+        self._clear_actors(['*vehicle.*'])
+        self.companion_vehicles.clear()
+        self.scenario_bank.save()
+
+    def _restore_scenario(self, snapshot):
+        """Spawn the companion vehicles of a settled traffic snapshot with their velocities in one batch"""
+        command_batch = snapshot_commands(self.world, snapshot, self.tm_port)
+        for response in self.client.apply_batch_sync(command_batch, self.sync):
+            if response.has_error():
+                logging.warn(response.error)
+            else:
+                vehicle = self.world.get_actor(response.actor_id)
+                self.companion_vehicles.append(vehicle)
+                self._set_companion_traffic_manager(vehicle, snapshot['tm_settings'])
+        logging.info('restore scenario snapshot, requested %d vehicles, generate %d vehicles',
+                     snapshot['num_of_vehicles'], len(self.companion_vehicles))
+
+    def _companion_tm_settings(self):
+        """Traffic manager settings of each companion vehicle"""
+        return {'ignore_lights': self.ignore_traffic_light, 'auto_lane_change': False,
+                'random_left_lanechange_percentage': 50, 'random_right_lanechange_percentage': 50}
+
+    def _set_companion_traffic_manager(self, vehicle, settings):
+        if settings['ignore_lights']:
+            self.traffic_manager.ignore_lights_percentage(vehicle, 100)
+            self.traffic_manager.ignore_walkers_percentage(vehicle, 100)
+        self.traffic_manager.ignore_signs_percentage(vehicle, 100)
+        self.traffic_manager.auto_lane_change(vehicle, settings['auto_lane_change'])
+        # modify change probability
+        self.traffic_manager.random_left_lanechange_percentage(vehicle, settings['random_left_lanechange_percentage'])
+        self.traffic_manager.random_right_lanechange_percentage(vehicle, settings['random_right_lanechange_percentage'])
+
+        self.traffic_manager.set_route(vehicle,
+                                       ['Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight'])
+        self.traffic_manager.update_vehicle_lights(vehicle, True)
+
+    def _spawn_companion_vehicles(self, num_of_vehicles):
         """
         Spawn surrounding vehcles of this simulation
         each vehicle is set to autopilot mode and controled by Traffic Maneger
@@ -1022,7 +1432,6 @@ class CarlaEnv:
         # spawn_points_=[x.transform for x in self.ego_spawn_waypoints]
 
         num_of_spawn_points = len(spawn_points_)
-        num_of_vehicles=random.choice(self.num_of_vehicles)
 
         if num_of_vehicles < num_of_spawn_points:
             random.shuffle(spawn_points_)
@@ -1048,31 +1457,15 @@ class CarlaEnv:
                                  then(SetAutopilot(FutureActor, True, self.tm_port)))
 
         # execute the command batch
+        tm_settings = self._companion_tm_settings()
         for (i, response) in enumerate(self.client.apply_batch_sync(command_batch, self.sync)):
             if response.has_error():
                 logging.warn(response.error)
             else:
                 # print("Future Actor",response.actor_id)
-                self.companion_vehicles.append(self.world.get_actor(response.actor_id))
-                if self.ignore_traffic_light:
-                    self.traffic_manager.ignore_lights_percentage(
-                        self.world.get_actor(response.actor_id), 100)
-                    self.traffic_manager.ignore_walkers_percentage(
-                        self.world.get_actor(response.actor_id), 100)
-                self.traffic_manager.ignore_signs_percentage(
-                        self.world.get_actor(response.actor_id), 100)
-                self.traffic_manager.auto_lane_change(
-                    self.world.get_actor(response.actor_id), False)
-                # modify change probability
-                self.traffic_manager.random_left_lanechange_percentage(
-                    self.world.get_actor(response.actor_id), 50)
-                self.traffic_manager.random_right_lanechange_percentage(
-                    self.world.get_actor(response.actor_id), 50)
-                
-                self.traffic_manager.set_route(self.world.get_actor(response.actor_id),
-                                               ['Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight', 'Straight'])
-                self.traffic_manager.update_vehicle_lights(
-                    self.world.get_actor(response.actor_id), True)
+                vehicle = self.world.get_actor(response.actor_id)
+                self.companion_vehicles.append(vehicle)
+                self._set_companion_traffic_manager(vehicle, tm_settings)
                 # print(self.world.get_actor(response.actor_id).attributes)
 
         msg = 'requested %d vehicles, generate %d vehicles, press Ctrl+C to exit.'
@@ -2,6 +2,14 @@
 import argparse
 
 CARLA_PATH = 'D:\ProgramFiles\Carla\WindowsNoEditor'
+# record of the prepared world on carla server, used to skip reloading the same map
+WORLD_CACHE_PATH = './out/world_cache.json'
+# settled traffic snapshots used to reset the companion vehicles
+SCENARIO_BANK_PATH = './out/scenario_bank.json'
+# decisions of the tick budget governor
+GOVERNOR_LOG_PATH = './out/governor_log.jsonl'
+# compiled lane graph of the chosen route, formatted with the map name
+LANE_GRAPH_PATH = './out/lane_graph_{}.npz'
 # the following road id sets define the chosen route
 ROADS = set()
 DISTURB_ROADS = set()
@@ -92,10 +100,29 @@ ARGS.add_argument(
     choices=['Town05', 'Town05_Opt'],
     help='Choose one of the possible world maps',
     default='Town05_Opt')
+ARGS.add_argument(
+    '--reuse_world', action='store_true',
+    default=True,
+    help='Reuse the world on server if the requested map is already loaded and prepared')
+ARGS.add_argument(
+    '--no_reuse_world', dest='reuse_world', action='store_false',
+    help='Always reload the map and prepare the world on startup')
 ARGS.add_argument(
     '-n', '--num_of_vehicles', type=list,
     help='Total vehicles number which run in simulation',
     default=[10*3, 15*3, 20*3])
+ARGS.add_argument(
+    '--scenario_bank', action='store_true',
+    help='Restore companion vehicles from settled traffic snapshots on reset, if the scenario bank has any, '
+    'fill the bank with generate_scenarios.py, otherwise the companion vehicles are spawned as usual')
+ARGS.add_argument(
+    '--settle_ticks', type=int,
+    default=200,
+    help='Number of ticks the traffic runs before a scenario snapshot is captured')
+ARGS.add_argument(
+    '--generate_scenarios', type=int,
+    default=10,
+    help='Number of scenario snapshots generated by generate_scenarios.py for each number of vehicles')
 ARGS.add_argument(
     '-sa', '--sampling_resolution', type=float,
     help='Distance between generated two waypoints',
@@ -111,6 +138,14 @@ ARGS.add_argument(
     action='store_true',
     default=True,
     help='Activate hybrid mode for Traffic Manager')
+ARGS.add_argument(
+    '--hybrid_radius', type=float,
+    default=100.0,
+    help='Hybrid physics radius around ego vehicle for Traffic Manager, meters')
+ARGS.add_argument(
+    '--tick_budget', type=float,
+    default=0.0,
+    help='Target steps per second held by adjusting hybrid physics radius and vehicle number, 0 disables the governor')
 ARGS.add_argument(
     '--auto_lane_change',
     action='store_true',
@@ -121,6 +156,23 @@ ARGS.add_argument(
     action='store_true',
     default=False,
     help='Activate no rendering mode')
+ARGS.add_argument(
+    '--geometric_sensors', action='store_true',
+    help='Detect collision and lane invasion geometrically on the client instead of spawning carla sensors')
+ARGS.add_argument(
+    '--soft_reset', action='store_true',
+    help='Only respawn ego vehicle on reset and keep companion traffic running')
+ARGS.add_argument(
+    '--full_reset_interval', type=int,
+    default=10,
+    help='Number of soft resets between two full rebuilds of the world')
+ARGS.add_argument(
+    '--birdeye', action='store_true',
+    help='Add the numpy rendered birdeye view image of ego vehicle into the state')
+ARGS.add_argument(
+    '--pixels_per_meter', type=int,
+    default=4,
+    help='Resolution of the birdeye view image')
 ARGS.add_argument(
     '--stride', type=int,
     default=10,
@@ -174,6 +226,10 @@ ARGS.add_argument(
     '--pre_train_steps', type=int,
     default=10000,
     help='Let the RL controller and PID controller alternatively take control every 500 steps')
+ARGS.add_argument(
+    '--obs_norm', action='store_true',
+    help='Normalize the DDPG observations with running mean and std in the actor and critic, '
+    'saved with the checkpoint')
 ARGS.add_argument(
     '--vehicle_proximity', type=float,
     default=50.0,
@@ -183,6 +239,40 @@ ARGS.add_argument(
     default=30.0,
     help='Distance for searching traffic light in front of ego vehicle, unit -- meters,'
     'attention: this value is tricky')
+ARGS.add_argument(
+    '--planner_workers', type=int,
+    default=0,
+    help='Threads running the lane queries of local planner concurrently, 0 runs them sequentially')
+ARGS.add_argument(
+    '--lane_store', action='store_true',
+    help='Slice the local planner waypoint windows from precomputed route lane polylines instead of querying the map')
+ARGS.add_argument(
+    '--reuse_windows', action='store_true',
+    help='Advance the local planner waypoint windows of the last step instead of regenerating them, '
+    'the window samples are then up to half a sampling resolution away from the regenerated ones')
+ARGS.add_argument(
+    '--lookahead', type=str,
+    default='',
+    help='Sample spacing of the front waypoint windows as step:until pairs in sampling resolutions, e.g. 1:15,5:50, '
+    'empty for a sample every sampling resolution up to buffer_size')
+ARGS.add_argument(
+    '--planner_features', type=str,
+    default='',
+    help='Local planner outputs computed every step, comma separated names of front_waypoints, rear_waypoints, '
+    'lights and vehicles, the others are computed on first access, empty for all')
+ARGS.add_argument(
+    '--lane_graph', action='store_true',
+    help='Navigate the lanes beside the route with a compiled lane graph instead of get_left_lane/get_right_lane')
+ARGS.add_argument(
+    '--lane_cache', action='store_true',
+    help='Cache the lane membership of the other vehicles until they move across lanes or roads')
+ARGS.add_argument(
+    '--route_frame_reward', action='store_true',
+    help='Compute the TTC and lane center reward terms from the route frame arrays, the front gap is the arc length '
+    'along the ego lane loop instead of the straight distance')
+ARGS.add_argument(
+    '--projection', action='store_true',
+    help='Project points onto the lanes beside the route with a client side KD-tree instead of querying the map')
 ARGS.add_argument(
     '--min_distance',type=float,
     default=5.0,
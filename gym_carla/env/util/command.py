@@ -0,0 +1,77 @@
+""" Module with the per tick command collector, which submits the commands of one step in a single batch. """
+import logging
+
+
+class CommandCollector:
+    """
+    Gather the carla.command objects produced during a step (vehicle controls, autopilot toggles, ...)
+    and submit them in one apply_batch just before the world tick.
+    SetAutopilot only (un)registers the vehicle with the traffic manager when it goes through apply_batch_sync,
+    so the autopilot toggles are submitted first with apply_batch_sync.
+    Traffic manager per vehicle settings have no batch command, these calls are deferred
+    and run in order after the autopilot toggles and before the batch, so they still take effect on the same tick.
+    """
+
+    def __init__(self, client, world):
+        self.client = client
+        self.world = world
+        self.commands = []
+        self.sync_commands = []
+        self.deferred = []
+        # number of commands and round-trips submitted, for profiling
+        self.num_commands = 0
+        self.num_flushes = 0
+
+    def __len__(self):
+        return len(self.commands) + len(self.sync_commands) + len(self.deferred)
+
+    def add(self, command):
+        """Add a carla.command object"""
+        self.commands.append(command)
+
+    def add_sync(self, command):
+        """Add a carla.command object which needs apply_batch_sync, e.g. SetAutopilot"""
+        self.sync_commands.append(command)
+
+    def defer(self, func, *args):
+        """Defer a call which can't be expressed as a batch command until the next flush"""
+        self.deferred.append((func, args))
+
+    def clear(self):
+        """Drop all pending commands, e.g. when their actors are destroyed"""
+        self.commands.clear()
+        self.sync_commands.clear()
+        self.deferred.clear()
+
+    def flush(self, tick=False):
+        """
+        Submit the autopilot toggles with apply_batch_sync, run the deferred calls, submit the other commands
+        with one apply_batch, then tick the world if required.
+        All go through the same client connection and the server runs them in order,
+        so the commands take effect on the tick and the returned frame is the first frame after them.
+        :param tick: True to tick the world after the batch, the world is ticked even without any pending command
+        :return: frame id of the tick, None if the world is not ticked
+        """
+        if self.sync_commands:
+            commands, self.sync_commands = self.sync_commands, []
+            self.num_commands += len(commands)
+            self.num_flushes += 1
+            for response in self.client.apply_batch_sync(commands, False):
+                if response.has_error():
+                    logging.warning('command batch error: %s', response.error)
+        for func, args in self.deferred:
+            func(*args)
+        self.deferred.clear()
+        if self.commands:
+            commands, self.commands = self.commands, []
+            self.num_commands += len(commands)
+            self.num_flushes += 1
+            # apply_batch doesn't wait for responses, failed commands are only reported by the server log
+            self.client.apply_batch(commands)
+        if not tick:
+            return None
+        frame = self.world.tick()
+        snapshot_frame = self.world.get_snapshot().frame
+        if snapshot_frame != frame:
+            logging.warning('tick returned frame %d but the world snapshot is frame %d', frame, snapshot_frame)
+        return frame
@@ -0,0 +1,94 @@
+""" Module with the tick budget governor, which keeps the simulation speed at a target steps per second. """
+import os, json
+import time
+import logging
+from collections import deque
+
+
+class TickGovernor:
+    """
+    Measure the server tick time and the client step time, and every window steps adjust the load of the simulation:
+        too slow: shrink the hybrid physics radius first, then lower the number of companion vehicles
+        fast enough with margin: restore the number of companion vehicles first, then grow the hybrid physics radius
+    Every decision is logged and kept in self.decisions, so that experiments with the governor stay comparable.
+    """
+
+    def __init__(self, target_fps, num_of_vehicles, radius=100.0, min_radius=30.0, max_radius=100.0, radius_step=10.0,
+                 window=50, tolerance=0.1, log_path=None):
+        """
+        :param target_fps: target client steps per second
+        :param num_of_vehicles: list of the allowed numbers of companion vehicles
+        :param radius: current hybrid physics radius of traffic manager, meters
+        :param window: number of steps measured before each decision
+        :param tolerance: relative dead band around target_fps without any decision
+        :param log_path: optional json lines file, each decision is appended to it
+        """
+        self.target_fps = target_fps
+        self.vehicle_levels = sorted(num_of_vehicles)
+        self.level = len(self.vehicle_levels) - 1
+        self.radius = radius
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.radius_step = radius_step
+        self.tolerance = tolerance
+        self.log_path = log_path
+        self.tick_times = deque(maxlen=window)
+        self.step_times = deque(maxlen=window)
+        self.decisions = []
+
+    @property
+    def max_vehicles(self):
+        """The largest number of companion vehicles currently allowed"""
+        return self.vehicle_levels[self.level]
+
+    def allowed_vehicles(self, num_of_vehicles):
+        """Filter the numbers of companion vehicles allowed by the governor"""
+        allowed = [n for n in num_of_vehicles if n <= self.max_vehicles]
+        return allowed if allowed else [min(num_of_vehicles)]
+
+    def record(self, tick_time, step_time):
+        """
+        Record the time cost of one step, seconds
+        :return: the decision dict if the load should be changed, otherwise None
+        """
+        self.tick_times.append(tick_time)
+        self.step_times.append(step_time)
+        if len(self.step_times) < self.step_times.maxlen:
+            return None
+        fps = len(self.step_times) / sum(self.step_times)
+        tick_time = sum(self.tick_times) / len(self.tick_times)
+        decision = None
+        if fps < self.target_fps * (1 - self.tolerance):
+            if self.radius > self.min_radius:
+                decision = self._decide('radius', max(self.radius - self.radius_step, self.min_radius), fps, tick_time)
+            elif self.level > 0:
+                decision = self._decide('vehicles', self.level - 1, fps, tick_time)
+        elif fps > self.target_fps * (1 + self.tolerance):
+            if self.level < len(self.vehicle_levels) - 1:
+                decision = self._decide('vehicles', self.level + 1, fps, tick_time)
+            elif self.radius < self.max_radius:
+                decision = self._decide('radius', min(self.radius + self.radius_step, self.max_radius), fps, tick_time)
+        if decision is not None:
+            # measure the new load from scratch
+            self.tick_times.clear()
+            self.step_times.clear()
+        return decision
+
+    def _decide(self, kind, value, fps, tick_time):
+        if kind == 'radius':
+            old, self.radius = self.radius, value
+        else:
+            old, self.level = self.vehicle_levels[self.level], value
+            value = self.vehicle_levels[value]
+        decision = {'time': time.time(), 'kind': kind, 'old': old, 'new': value,
+                    'fps': fps, 'tick_time': tick_time, 'target_fps': self.target_fps}
+        self.decisions.append(decision)
+        logging.info('tick governor: %.1f steps/s (tick %.3fs), target %.1f, %s %s -> %s',
+                     fps, tick_time, self.target_fps, kind, old, value)
+        if self.log_path:
+            dir_name = os.path.dirname(self.log_path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(decision) + '\n')
+        return decision
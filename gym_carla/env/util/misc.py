@@ -1,4 +1,6 @@
 """ Module with auxiliary functions. """
+import os
+import json
 import logging
 import math
 import numpy as np
@@ -6,28 +8,47 @@ import carla
 from gym_carla.env.settings import *
 from enum import Enum
 
-def remove_unnecessary_objects(world):
-    """Remove unuseful objects in the world"""
-    def remove_object(world,objs,obj):
-        for ob in world.get_environment_objects(obj):
-            objs.add(ob.id)
-    world.unload_map_layer(carla.MapLayer.StreetLights)
-    world.unload_map_layer(carla.MapLayer.Buildings)
-    world.unload_map_layer(carla.MapLayer.Decals)
-    world.unload_map_layer(carla.MapLayer.Walls)
-    world.unload_map_layer(carla.MapLayer.Foliage)
-    world.unload_map_layer(carla.MapLayer.ParkedVehicles)
+# map layers which are unloaded by remove_unnecessary_objects
+UNNECESSARY_LAYERS = [carla.MapLayer.StreetLights, carla.MapLayer.Buildings, carla.MapLayer.Decals,
+    carla.MapLayer.Walls, carla.MapLayer.Foliage, carla.MapLayer.ParkedVehicles, carla.MapLayer.Ground]
+
+def remove_unnecessary_objects(world, objs=None):
+    """Remove unuseful objects in the world
+    :param objs: environment object ids to disable, searched by object labels if None
+    :return: the disabled environment object ids, which are the same for every world of one map
+    """
+    for layer in UNNECESSARY_LAYERS:
+        world.unload_map_layer(layer)
     # world.unload_map_layer(carla.MapLayer.Particles)
-    world.unload_map_layer(carla.MapLayer.Ground)
-    labels=[carla.CityObjectLabel.TrafficSigns,carla.CityObjectLabel.Other,
-        carla.CityObjectLabel.Poles, carla.CityObjectLabel.Static,carla.CityObjectLabel.Dynamic,carla.CityObjectLabel.Buildings,
-        carla.CityObjectLabel.Fences, carla.CityObjectLabel.Walls,carla.CityObjectLabel.Vegetation,carla.CityObjectLabel.Ground]
-    objs = set()
-    for label in labels:
-        for obj in world.get_environment_objects(label):
-            objs.add(obj.id)
+    if objs is None:
+        labels=[carla.CityObjectLabel.TrafficSigns,carla.CityObjectLabel.Other,
+            carla.CityObjectLabel.Poles, carla.CityObjectLabel.Static,carla.CityObjectLabel.Dynamic,carla.CityObjectLabel.Buildings,
+            carla.CityObjectLabel.Fences, carla.CityObjectLabel.Walls,carla.CityObjectLabel.Vegetation,carla.CityObjectLabel.Ground]
+        objs = set()
+        for label in labels:
+            for obj in world.get_environment_objects(label):
+                objs.add(obj.id)
     world.enable_environment_objects(objs, False)
     # world.unload_map_layer(carla.MapLayer.Props)
+    return objs
+
+def load_world_cache(path=WORLD_CACHE_PATH):
+    """Load the prepared world record, {map name: {'world_id': id, 'disabled_objects': [ids]}}"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logging.warning('world cache %s broken, ignore it', path)
+        return {}
+
+def save_world_cache(cache, path=WORLD_CACHE_PATH):
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(path, 'w') as f:
+        json.dump(cache, f)
 
 def test_waypoint(waypoint, ego=False):
     """
@@ -65,8 +86,18 @@ def draw_waypoints(world, waypoints, life_time=0.0, z=0.5):
         end = begin + carla.Location(x=math.cos(angle), y=math.sin(angle))
         world.debug.draw_arrow(begin, end, arrow_size=0.3, life_time=life_time)
 
-def get_lane_center(map, location):
-    """Project current loction to its lane center, return lane center waypoint"""
+def _left_lanes(waypoint, count, lane_graph=None):
+    """The waypoint count lanes to the left of waypoint"""
+    if lane_graph is not None:
+        # the lane center location is measured against, keep the same s
+        return lane_graph.lateral(waypoint, -count, exact=True)
+    for _ in range(count):
+        waypoint = waypoint.get_left_lane()
+    return waypoint
+
+def get_lane_center(map, location, lane_graph=None):
+    """Project current loction to its lane center, return lane center waypoint
+    lane_graph: optional LaneGraph, replaces the get_left_lane chains of the shoulder and sidewalk fallbacks"""
     # test code for junction lane invasion bug
     # if lane_center.is_junction:
     #     test=self.map.get_waypoint(self.ego_vehicle.get_location(),project_to_road=True,lane_type=carla.LaneType.Shoulder)
@@ -119,20 +150,20 @@ def get_lane_center(map, location):
                 lane_Sidewalk = map.get_waypoint(location, project_to_road=True, lane_type=carla.LaneType.Sidewalk)
                 if lane_Sidewalk.lane_id == -5:
                     # print('lane_shoulder.lane_id == -5')
-                    lane_center = lane_Sidewalk.get_left_lane().get_left_lane().get_left_lane().get_left_lane()
+                    lane_center = _left_lanes(lane_Sidewalk, 4, lane_graph)
                 elif lane_Sidewalk.lane_id == -6:
                     # print('lane_shoulder.lane_id == -6')
-                    lane_center = lane_Sidewalk.get_left_lane().get_left_lane().get_left_lane().get_left_lane().get_left_lane()
+                    lane_center = _left_lanes(lane_Sidewalk, 5, lane_graph)
             elif lane_center_left is not None and lane_center_left.lane_id == -1:
                 lane_center = lane_center_left
             elif lane_center_right is not None and lane_center_right.lane_id == -1:
                 lane_center = lane_center_right
         elif lane_shoulder.lane_id == -5:
             # print('lane_shoulder.lane_id == -5')
-            lane_center = lane_shoulder.get_left_lane().get_left_lane().get_left_lane().get_left_lane()
+            lane_center = _left_lanes(lane_shoulder, 4, lane_graph)
         elif lane_shoulder.lane_id == -6:
             # print('lane_shoulder.lane_id == -6')
-            lane_center = lane_shoulder.get_left_lane().get_left_lane().get_left_lane().get_left_lane().get_left_lane()
+            lane_center = _left_lanes(lane_shoulder, 5, lane_graph)
     # print('lane_center.road_id: ', lane_center.road_id)
     return lane_center
 
@@ -226,25 +257,38 @@ def get_actor_polygons(world, filt):
     Returns:
         actor_poly_dict: a dictionary containing the bounding boxes of specific actors.
     """
-    actor_poly_dict = {}
-    for actor in world.get_actors().filter(filt):
-        # Get x, y and yaw of the actor
+    ids, polys = get_actor_polygons_batch(world, filt)
+    return dict(zip(ids.tolist(), polys))
+
+
+def get_actor_polygons_batch(world, filt):
+    """Get the bounding box polygons of all actors at once.
+    Args:
+        filt: the filter indicating what type of actors we'll look at.
+        world: carla.world
+    Returns:
+        ids: (N,) array of actor ids
+        polys: (N,4,2) array of bounding box corners in world coordinate, the same corner order as get_actor_polygons
+    """
+    actors = world.get_actors().filter(filt)
+    ids = np.zeros(len(actors), dtype=np.int64)
+    # x, y, yaw, half length, half width of each actor
+    states = np.zeros((len(actors), 5))
+    for i, actor in enumerate(actors):
         trans = actor.get_transform()
-        x = trans.location.x
-        y = trans.location.y
-        yaw = trans.rotation.yaw / 180 * np.pi
-        # Get length and width
-        bb = actor.bounding_box
-        l = bb.extent.x
-        w = bb.extent.y
-        # Get bounding box polygon in the actor's local coordinate
-        poly_local = np.array([[l, w], [l, -w], [-l, -w], [-l, w]]).transpose()
-        # Get rotation matrix to transform to global coordinate
-        R = np.array([[np.cos(yaw), -np.sin(yaw)], [np.sin(yaw), np.cos(yaw)]])
-        # Get global bounding box polygon
-        poly = np.matmul(R, poly_local).transpose() + np.repeat([[x, y]], 4, axis=0)
-        actor_poly_dict[actor.id] = poly
-    return actor_poly_dict
+        extent = actor.bounding_box.extent
+        ids[i] = actor.id
+        states[i] = [trans.location.x, trans.location.y, trans.rotation.yaw, extent.x, extent.y]
+    return ids, compute_polygons(states[:, 0], states[:, 1], np.radians(states[:, 2]), states[:, 3], states[:, 4])
+
+
+def compute_polygons(x, y, yaw, l, w):
+    """Compute (N,4,2) bounding box corners from (N,) arrays of center, yaw in radians, half length and half width"""
+    # corners in the actor's local coordinate, (N,4,2)
+    local = np.array([[1, 1], [1, -1], [-1, -1], [-1, 1]]) * np.stack((l, w), axis=-1)[:, None, :]
+    cos, sin = np.cos(yaw)[:, None], np.sin(yaw)[:, None]
+    return np.stack((cos * local[..., 0] - sin * local[..., 1] + np.asarray(x)[:, None],
+                     sin * local[..., 0] + cos * local[..., 1] + np.asarray(y)[:, None]), axis=-1)
 
 
 def get_trafficlight_trigger_location(traffic_light):
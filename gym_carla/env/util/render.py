@@ -0,0 +1,165 @@
+""" Module with numpy birdeye view renderer, no camera sensor of carla server is needed. """
+import math
+import numpy as np
+
+# static layer classes
+BACKGROUND, ROAD, LANE_MARKING = 0, 1, 2
+# rgb colors of static layer classes, indexed by class
+STATIC_PALETTE = np.array([[0, 0, 0], [80, 80, 80], [230, 230, 230]], dtype=np.uint8)
+# rgb colors of dynamic layer
+EGO_COLOR = (0, 200, 0)
+VEHICLE_COLOR = (0, 120, 255)
+ROUTE_COLOR = (200, 0, 200)
+LIGHT_COLORS = {'Red': (255, 0, 0), 'Yellow': (255, 200, 0), 'Green': (0, 255, 0)}
+
+# static layers rasterized in this process, keyed by (map name, pixels per meter)
+_STATIC_LAYERS = {}
+
+
+def rasterize_static_layer(route_frame, pixels_per_meter=4, margin=10.0, marking_width=0.3, chunk_rows=256):
+    """
+    Rasterize the road and lane layout of the chosen route into a class map.
+    Each pixel center is projected onto its nearest route sample, it belongs to the road
+    if its lateral offset is within half lane width, and to the lane marking if it lies on the lane border.
+
+    :param route_frame: RouteFrame of the chosen route
+    :param pixels_per_meter: raster resolution
+    :param margin: extra space around the route, meters
+    :param marking_width: width of lane markings, meters
+    :param chunk_rows: number of pixel rows projected at once, to bound the memory
+    :return: dict with the uint8 class map 'layer' (row is y, column is x), its 'origin' (x_min, y_min) and 'pixels_per_meter'
+    """
+    x_min, y_min = route_frame.xyz[:, :2].min(axis=0) - margin
+    x_max, y_max = route_frame.xyz[:, :2].max(axis=0) + margin
+    height = int(math.ceil((y_max - y_min) * pixels_per_meter))
+    width = int(math.ceil((x_max - x_min) * pixels_per_meter))
+    layer = np.zeros((height, width), dtype=np.uint8)
+    xs = x_min + (np.arange(width) + 0.5) / pixels_per_meter
+    max_width = route_frame.width.max()
+    for row in range(0, height, chunk_rows):
+        ys = y_min + (np.arange(row, min(row + chunk_rows, height)) + 0.5) / pixels_per_meter
+        points = np.stack(np.meshgrid(xs, ys), axis=-1).reshape((-1, 2))
+        # pixels far from every route sample are background, skip their projection
+        dis, idx = route_frame._tree.query(points, distance_upper_bound=max_width)
+        near = np.isfinite(dis)
+        idx = idx[near]
+        delta = points[near] - route_frame.xyz[idx, :2]
+        yaw = route_frame.yaw[idx]
+        d = np.abs(-delta[:, 0] * np.sin(yaw) + delta[:, 1] * np.cos(yaw))
+        half = route_frame.width[idx] / 2
+        cls = np.zeros(len(points), dtype=np.uint8)
+        cls[near] = np.where(d <= half - marking_width / 2, ROAD,
+                             np.where(d <= half + marking_width / 2, LANE_MARKING, BACKGROUND))
+        layer[row:row + len(ys)] = cls.reshape((len(ys), width))
+    return {'layer': layer, 'origin': (x_min, y_min), 'pixels_per_meter': pixels_per_meter}
+
+
+def fill_convex(image, corners, color):
+    """Fill a convex polygon given by its (row, column) corners in pixel coordinates, in place"""
+    corners = np.asarray(corners, dtype=np.float64)
+    r0, c0 = np.maximum(np.floor(corners.min(axis=0)).astype(int), 0)
+    r1 = min(int(math.ceil(corners[:, 0].max())), image.shape[0] - 1)
+    c1 = min(int(math.ceil(corners[:, 1].max())), image.shape[1] - 1)
+    if r0 > r1 or c0 > c1:
+        return
+    rows, cols = np.mgrid[r0:r1 + 1, c0:c1 + 1] + 0.5
+    edges = np.roll(corners, -1, axis=0) - corners
+    # sign of the cross product between each edge and the vector from its start corner to the pixel
+    cross = edges[:, 0, None, None] * (cols - corners[:, 1, None, None]) - \
+        edges[:, 1, None, None] * (rows - corners[:, 0, None, None])
+    inside = np.all(cross >= 0, axis=0) | np.all(cross <= 0, axis=0)
+    image[r0:r1 + 1, c0:c1 + 1][inside] = color
+
+
+class BirdeyeRender:
+    """
+    Birdeye view renderer of the chosen route, the image is centered on ego vehicle and ego vehicle heads up.
+    The static layer is rasterized only once per map and shared by all renderers in the process,
+    each frame only gathers the ego centered crop from it and draws the dynamic layer
+    (vehicle polygons, route waypoints and traffic light stop lines) on the crop.
+    """
+
+    def __init__(self, route_frame, map_name, pixels_per_meter=4, obs_range=32.0, back_range=16.0):
+        """
+        :param route_frame: RouteFrame of the chosen route
+        :param map_name: name of the carla map, key of the static layer cache
+        :param pixels_per_meter: image resolution
+        :param obs_range: visible distance in front of ego vehicle, meters
+        :param back_range: visible distance behind ego vehicle, meters, the image is square
+        """
+        key = (map_name, pixels_per_meter)
+        if key not in _STATIC_LAYERS:
+            _STATIC_LAYERS[key] = rasterize_static_layer(route_frame, pixels_per_meter)
+        self.static = _STATIC_LAYERS[key]
+        self.pixels_per_meter = pixels_per_meter
+        self.obs_range = obs_range
+        self.side_range = (obs_range + back_range) / 2
+        self.obs_size = int(round((obs_range + back_range) * pixels_per_meter))
+        # ego frame coordinates (forward, right) of every image pixel center
+        centers = (np.arange(self.obs_size) + 0.5) / pixels_per_meter
+        self._forward = np.repeat((obs_range - centers)[:, None], self.obs_size, axis=1)
+        self._right = np.repeat((centers - self.side_range)[None, :], self.obs_size, axis=0)
+
+    def to_pixel(self, points, ego_x, ego_y, ego_yaw):
+        """Convert world (x, y) points to (row, column) image coordinates, ego_yaw in radians"""
+        delta = np.asarray(points, dtype=np.float64)[..., :2] - np.array([ego_x, ego_y])
+        cos, sin = math.cos(ego_yaw), math.sin(ego_yaw)
+        forward = delta[..., 0] * cos + delta[..., 1] * sin
+        right = -delta[..., 0] * sin + delta[..., 1] * cos
+        return np.stack(((self.obs_range - forward) * self.pixels_per_meter,
+                         (right + self.side_range) * self.pixels_per_meter), axis=-1)
+
+    def crop_static(self, ego_x, ego_y, ego_yaw):
+        """Gather the ego centered crop of the static layer, return rgb image"""
+        cos, sin = math.cos(ego_yaw), math.sin(ego_yaw)
+        xs = ego_x + self._forward * cos - self._right * sin
+        ys = ego_y + self._forward * sin + self._right * cos
+        layer = self.static['layer']
+        x0, y0 = self.static['origin']
+        cols = np.floor((xs - x0) * self.pixels_per_meter).astype(np.int64)
+        rows = np.floor((ys - y0) * self.pixels_per_meter).astype(np.int64)
+        valid = (rows >= 0) & (rows < layer.shape[0]) & (cols >= 0) & (cols < layer.shape[1])
+        cls = np.full(xs.shape, BACKGROUND, dtype=np.uint8)
+        cls[valid] = layer[rows[valid], cols[valid]]
+        return STATIC_PALETTE[cls]
+
+    def render(self, ego_transform, vehicle_polygons, ego_polygon=None, route=None, lights=None):
+        """
+        Render one birdeye view frame
+        :param ego_transform: carla.Transform of ego vehicle
+        :param vehicle_polygons: array like (N, 4, 2), bounding box corners of the other vehicles
+        :param ego_polygon: array like (4, 2), bounding box corners of ego vehicle
+        :param route: array like (M, 2), route waypoint locations to draw
+        :param lights: list of (state name, [(x, y, yaw in degrees, lane width), ...]) of traffic light stop lines
+        :return: uint8 rgb image of shape (obs_size, obs_size, 3)
+        """
+        ego_x, ego_y = ego_transform.location.x, ego_transform.location.y
+        ego_yaw = math.radians(ego_transform.rotation.yaw)
+        image = self.crop_static(ego_x, ego_y, ego_yaw)
+
+        if route is not None and len(route) > 0:
+            pixels = np.floor(self.to_pixel(np.reshape(route, (-1, 2)), ego_x, ego_y, ego_yaw)).astype(np.int64)
+            for dr in (-1, 0):
+                for dc in (-1, 0):
+                    rows, cols = pixels[:, 0] + dr, pixels[:, 1] + dc
+                    valid = (rows >= 0) & (rows < self.obs_size) & (cols >= 0) & (cols < self.obs_size)
+                    image[rows[valid], cols[valid]] = ROUTE_COLOR
+
+        for state, stop_lines in lights or []:
+            color = LIGHT_COLORS.get(state)
+            if color is None:
+                continue
+            for x, y, yaw, lane_width in stop_lines:
+                yaw = math.radians(yaw)
+                forward = np.array([math.cos(yaw), math.sin(yaw)]) * 0.5
+                right = np.array([-math.sin(yaw), math.cos(yaw)]) * lane_width / 2
+                center = np.array([x, y])
+                corners = [center + right, center + right + forward, center - right + forward, center - right]
+                fill_convex(image, self.to_pixel(corners, ego_x, ego_y, ego_yaw), color)
+
+        if len(vehicle_polygons) > 0:
+            for corners in self.to_pixel(np.reshape(vehicle_polygons, (-1, 4, 2)), ego_x, ego_y, ego_yaw):
+                fill_convex(image, corners, VEHICLE_COLOR)
+        if ego_polygon is not None:
+            fill_convex(image, self.to_pixel(ego_polygon, ego_x, ego_y, ego_yaw), EGO_COLOR)
+        return image
@@ -0,0 +1,166 @@
+""" Module with vectorized reward functions, used to relabel recorded transitions without the carla server. """
+import math
+import numpy as np
+from gym_carla.env.util.wrapper import Truncated, Action
+
+# per step kinematics recorded into step_info by CarlaEnv._get_reward, enough to recompute the reward
+KINEMATIC_KEYS = ['episode', 'time_step', 'speed', 'velocity', 'front_gap', 'front_speed', 'light_distance',
+                  'last_acc', 'cur_acc', 'yaw_change', 'offlane', 'lane_width', 'on_lane', 'on_route',
+                  'Lane_center', 'lane_change', 'action', 'front_distances', 'truncated', 'collision',
+                  'vehicle_collision', 'impact']
+
+
+def vehicle_length(ego_veh, target_veh):
+    """Sum of the bounding box sizes of two vehicles, subtracted from their distance by ttc_reward"""
+    return max(abs(ego_veh.bounding_box.extent.x), abs(ego_veh.bounding_box.extent.y)) + \
+        max(abs(target_veh.bounding_box.extent.x), abs(target_veh.bounding_box.extent.y))
+
+
+def vehicle_gap(ego_veh, target_veh):
+    """Distance between two vehicles minus their bounding box sizes, the same distance used by ttc_reward"""
+    return ego_veh.get_location().distance(target_veh.get_location()) - vehicle_length(ego_veh, target_veh)
+
+
+def collect_kinematics(infos):
+    """Stack a list of step_info dicts into a dict of arrays with KINEMATIC_KEYS,
+    next_impact is nan for the infos stored without it (see add_patched)"""
+    kin = {}
+    for key in KINEMATIC_KEYS:
+        kin[key] = np.array([info[key] for info in infos], dtype=np.float64)
+    kin['next_impact'] = np.array([info.get('next_impact', np.nan) for info in infos], dtype=np.float64)
+    return kin
+
+
+def add_patched(replay_buffer, transition, next_impact, impact_scale=1 / 9):
+    """
+    Add a transition with the impact of the next step on the rear vehicle added to its reward, None is ignored.
+    next_impact is kept in the stored step info, so impact_patch reproduces the same reward when relabeling.
+    :param transition: [state, action, action_param, reward, next_state, truncated, done, info]
+    :param next_impact: raw impact of the next recorded step of the episode
+    """
+    if transition is None:
+        return
+    state, action, action_param, reward, next_state, truncated, done, info = transition
+    replay_buffer.add(state, action, action_param, reward + next_impact * impact_scale, next_state, truncated, done,
+                      dict(info, next_impact=next_impact))
+
+
+def ttc_rewards(front_gap, ego_speed, front_speed, min_dis, TTC_THRESHOLD):
+    """Vectorized ttc_reward, front_gap is inf if there is no front vehicle"""
+    front_gap, ego_speed, front_speed = np.broadcast_arrays(np.asarray(front_gap, dtype=np.float64),
+                                                            np.asarray(ego_speed, dtype=np.float64),
+                                                            np.asarray(front_speed, dtype=np.float64))
+    TTC = np.full(front_gap.shape, math.inf)
+    rel_speed = ego_speed - front_speed
+    moving = np.abs(rel_speed) > 0.0000001
+    TTC[moving] = (front_gap[moving] - min_dis) / rel_speed[moving]
+    TTC[front_gap < min_dis] = 0.01
+    within = (TTC >= 0) & (TTC <= TTC_THRESHOLD)
+    with np.errstate(divide='ignore'):
+        return np.where(within, np.clip(np.log(np.where(within, TTC, TTC_THRESHOLD) / TTC_THRESHOLD), -1, 0), 0.0)
+
+
+def efficiency_rewards(velocity, light_distance, speed_limit, traffic_light_proximity):
+    """Vectorized efficiency reward, light_distance is the distance to a non-green traffic light, inf if there is none"""
+    velocity = np.asarray(velocity, dtype=np.float64) * 3.6
+    light_distance = np.asarray(light_distance, dtype=np.float64)
+    max_speed = np.where(light_distance < traffic_light_proximity,
+                         (light_distance + 0.0001) / traffic_light_proximity * speed_limit, speed_limit)
+    with np.errstate(over='ignore'):
+        return np.where(velocity > max_speed, np.exp(np.minimum(max_speed - velocity, 0)) - 1, velocity / max_speed - 1)
+
+
+def comfort_rewards(fps, last_acc, cur_acc, yaw_change):
+    """Vectorized comfort reward, yaw_change is in degrees"""
+    acc_jerk = -((np.asarray(cur_acc) - np.asarray(last_acc)) * fps) ** 2 / ((6 * fps) ** 2)
+    yaw_jerk = -np.abs(yaw_change) / 90
+    return np.clip(acc_jerk * 0.5 + yaw_jerk, -1, 0)
+
+
+def lane_center_rewards(offlane, lane_width, on_lane, train_pdqn=True):
+    """Vectorized lane center reward of pdqn_lane_center (train_pdqn) or of the plain lane center distance"""
+    offlane = np.abs(np.asarray(offlane, dtype=np.float64))
+    half_width = np.asarray(lane_width, dtype=np.float64) / 2
+    off_road = ~np.asarray(on_lane, dtype=bool)
+    if not train_pdqn:
+        off_road |= offlane > half_width + 0.1
+    return np.where(off_road, -2.0, -offlane / half_width)
+
+
+def lane_change_rewards(lane_change, action, front_distances, on_route, lane_change_reward, train_pdqn=True):
+    """
+    Vectorized CarlaEnv._lane_change_reward
+    :param lane_change: current lane id minus last lane id, -1 means change right and 1 means change left
+    :param action: value of the current Action
+    :param front_distances: array (N, 3) of distance_to_front_vehicles of the last step
+    """
+    lane_change = np.asarray(lane_change)
+    front_distances = np.asarray(front_distances, dtype=np.float64).reshape((-1, 3))
+    center = np.where(lane_change == -1, front_distances[:, 0], front_distances[:, 2])
+    side = front_distances[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reward = np.clip((side / center - 1) * lane_change_reward, -lane_change_reward, lane_change_reward)
+    changed = (np.abs(lane_change) == 1) & np.asarray(on_route, dtype=bool)
+    if train_pdqn:
+        changed &= np.asarray(action) != Action.LANE_FOLLOW.value
+    return np.where(changed, np.nan_to_num(reward), 0.0)
+
+
+def compute_rewards(kin, fps=10, min_distance=5.0, TTC_THRESHOLD=4.001, speed_limit=90.0, traffic_light_proximity=30.0,
+                    lane_change_reward=20.0, penalty=30.0, lane_penalty=20.0, train_pdqn=True, guide_change=True):
+    """
+    Recompute the step rewards of CarlaEnv._get_reward from recorded kinematics, the arguments mirror the env settings.
+    The guided lane center reward depends on the neighbour lane geometry, so the recorded Lane_center is reused for it.
+    :param kin: dict of arrays with KINEMATIC_KEYS
+    :return: reward array and dict of reward term arrays
+    """
+    fTTC = ttc_rewards(kin['front_gap'], kin['speed'], kin['front_speed'], min_distance, TTC_THRESHOLD)
+    fEff = efficiency_rewards(kin['velocity'], kin['light_distance'], speed_limit, traffic_light_proximity)
+    fCom = comfort_rewards(fps, kin['last_acc'], kin['cur_acc'], kin['yaw_change'])
+    if train_pdqn or not guide_change:
+        fLcen = lane_center_rewards(kin['offlane'], kin['lane_width'], kin['on_lane'], train_pdqn)
+    else:
+        fLcen = np.asarray(kin['Lane_center'], dtype=np.float64)
+    lane_changing = lane_change_rewards(kin['lane_change'], kin['action'], kin['front_distances'], kin['on_route'],
+                                        lane_change_reward, train_pdqn)
+    reward = fTTC + fEff + fCom + fLcen + lane_changing
+
+    truncated = np.asarray(kin['truncated'])
+    # collisions with other objects than vehicles are abandoned by the train loop, their reward is kept
+    abandon = (truncated == Truncated.NORMAL.value) & np.asarray(kin['collision'], dtype=bool) & \
+        ~np.asarray(kin['vehicle_collision'], dtype=bool)
+    reward = np.where(truncated == Truncated.CHANGE_LANE_IN_LANE_FOLLOW.value, -lane_penalty,
+                      np.where((truncated == Truncated.NORMAL.value) & ~abandon, -penalty, reward))
+    return reward, {'TTC': fTTC, 'Efficiency': fEff, 'Comfort': fCom, 'Lane_center': fLcen,
+                    'lane_changing_reward': lane_changing}
+
+
+def impact_patch(reward, kin, impact_scale=1 / 9):
+    """
+    Add the impact of each step on the rear vehicle to the reward of its former step, as the train loop does.
+    The steps stored by add_patched carry the impact of their next step (next_impact) and use it directly.
+    For the other steps, the former step gets the impact of the next recorded step of the same episode
+    if neither is truncated. The train loop stores truncated steps without any impact, and never stores the step
+    before a truncated step nor the last step of an episode, their rewards are returned unpatched.
+    """
+    reward = np.array(reward, dtype=np.float64)
+    next_impact = np.asarray(kin.get('next_impact', np.full(len(reward), np.nan)), dtype=np.float64)
+    recorded = ~np.isnan(next_impact)
+    if recorded.all():
+        return reward + next_impact * impact_scale
+    episode, time_step = np.asarray(kin['episode']), np.asarray(kin['time_step'])
+    order = np.lexsort((time_step, episode))
+    cur, nxt = order[:-1], order[1:]
+    follow = (episode[cur] == episode[nxt]) & \
+             (np.asarray(kin['truncated'])[nxt] == Truncated.FALSE.value) & \
+             (np.asarray(kin['truncated'])[cur] == Truncated.FALSE.value)
+    follow &= ~recorded[cur]
+    reward[cur[follow]] += np.asarray(kin['impact'], dtype=np.float64)[nxt[follow]] * impact_scale
+    reward[recorded] += next_impact[recorded] * impact_scale
+    return reward
+
+
+def relabel(kin, impact_scale=1 / 9, **reward_args):
+    """Recompute the rewards of a whole recorded dataset, including the impact patch, return the reward array"""
+    reward, _ = compute_rewards(kin, **reward_args)
+    return impact_patch(reward, kin, impact_scale)
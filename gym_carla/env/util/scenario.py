@@ -0,0 +1,90 @@
+""" Module with the bank of settled traffic scenario snapshots, used to reset the traffic without warm up. """
+import os, json
+import random
+import logging
+import carla
+from gym_carla.env.settings import SCENARIO_BANK_PATH
+
+
+def capture_snapshot(vehicles, tm_settings):
+    """
+    Capture the state of companion vehicles after the traffic settled
+    :param vehicles: list of carla.Vehicle, their state received during the last tick is used
+    :param tm_settings: dict of the traffic manager settings applied to each vehicle
+    :return: json serializable snapshot dict
+    """
+    records = []
+    for vehicle in vehicles:
+        transform = vehicle.get_transform()
+        velocity = vehicle.get_velocity()
+        records.append({'blueprint': vehicle.type_id,
+                        'color': vehicle.attributes.get('color'),
+                        'transform': [transform.location.x, transform.location.y, transform.location.z,
+                                      transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll],
+                        'velocity': [velocity.x, velocity.y, velocity.z]})
+    return {'num_of_vehicles': len(records), 'tm_settings': dict(tm_settings), 'vehicles': records}
+
+
+def snapshot_commands(world, snapshot, tm_port, z_offset=0.1):
+    """Build the batch commands spawning the snapshot vehicles with autopilot and their settled velocity"""
+    SpawnActor = carla.command.SpawnActor
+    SetAutopilot = carla.command.SetAutopilot
+    ApplyTargetVelocity = carla.command.ApplyTargetVelocity
+    FutureActor = carla.command.FutureActor
+    blueprint_library = world.get_blueprint_library()
+    command_batch = []
+    for record in snapshot['vehicles']:
+        blueprint = blueprint_library.find(record['blueprint'])
+        if record['color'] is not None and blueprint.has_attribute('color'):
+            blueprint.set_attribute('color', record['color'])
+        blueprint.set_attribute('role_name', 'autopilot')
+        x, y, z, pitch, yaw, roll = record['transform']
+        # lift the vehicle a little bit to avoid collision with the road upon spawning
+        transform = carla.Transform(carla.Location(x, y, z + z_offset), carla.Rotation(pitch, yaw, roll))
+        command_batch.append(SpawnActor(blueprint, transform)
+                             .then(SetAutopilot(FutureActor, True, tm_port))
+                             .then(ApplyTargetVelocity(FutureActor, carla.Vector3D(*record['velocity']))))
+    return command_batch
+
+
+class ScenarioBank:
+    """
+    Settled traffic snapshots stored on disk, grouped by map name and number of vehicles:
+        {map name: {number of vehicles: [snapshot, ...]}}
+    """
+
+    def __init__(self, map_name, path=SCENARIO_BANK_PATH):
+        self.map_name = map_name.split('/')[-1]
+        self.path = path
+        self._bank = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._bank = json.load(f)
+            except (OSError, ValueError):
+                logging.warning('scenario bank %s broken, ignore it', path)
+
+    def __len__(self):
+        return sum(len(snapshots) for snapshots in self._bank.get(self.map_name, {}).values())
+
+    def count(self, num_of_vehicles):
+        """Number of snapshots with num_of_vehicles requested vehicles"""
+        return len(self._bank.get(self.map_name, {}).get(str(num_of_vehicles), []))
+
+    def add(self, num_of_vehicles, snapshot):
+        """Add snapshot generated for num_of_vehicles requested vehicles, call save to write it to disk"""
+        self._bank.setdefault(self.map_name, {}).setdefault(str(num_of_vehicles), []).append(snapshot)
+
+    def sample(self, num_of_vehicles):
+        """Return a random snapshot generated for num_of_vehicles requested vehicles, None if there is none"""
+        snapshots = self._bank.get(self.map_name, {}).get(str(num_of_vehicles))
+        if not snapshots:
+            return None
+        return random.choice(snapshots)
+
+    def save(self):
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        with open(self.path, 'w') as f:
+            json.dump(self._bank, f)
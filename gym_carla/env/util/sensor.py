@@ -2,6 +2,7 @@ import collections
 import logging
 import weakref, math
 import carla, time
+import numpy as np
 from enum import Enum
 
 
@@ -68,6 +69,10 @@ class CollisionSensor(object):
     def clear_history(self):
         self.history.clear()
 
+    def update(self):
+        """Collision events arrive by sensor callback, nothing to do on tick"""
+        pass
+
     @staticmethod
     def _on_collision(weak_self, event):
         """On collision method"""
@@ -106,6 +111,10 @@ class LaneInvasionSensor(object):
     def get_invasion_count(self):
         return self.count
 
+    def update(self):
+        """Invasion events arrive by sensor callback, nothing to do on tick"""
+        pass
+
     @staticmethod
     def _on_invasion(weak_self, event):
         """On invasion method"""
@@ -116,3 +125,157 @@ class LaneInvasionSensor(object):
         lane_type = set(x.type for x in event.crossed_lane_markings)
         text = ['%r' % str(x).split()[-1] for x in lane_type]
         # logging.info('Crossed line %s' % ' and '.join(text))
+
+
+def obb_overlap(center, yaw, extent, centers, yaws, extents):
+    """
+    Separating axis test between one 2D oriented bounding box and N others, vectorized over the N boxes
+    :param center, yaw, extent: (2,) center, yaw in radians and (2,) half extents of the box
+    :param centers, yaws, extents: (N, 2), (N,) and (N, 2) arrays of the other boxes
+    :return: bool array (N,), True if the boxes overlap
+    """
+    centers, yaws, extents = np.reshape(centers, (-1, 2)), np.ravel(yaws), np.reshape(extents, (-1, 2))
+    # unit axes of the box and of the other boxes, (2, 2) and (N, 2, 2)
+    axes = np.array([[math.cos(yaw), math.sin(yaw)], [-math.sin(yaw), math.cos(yaw)]])
+    other_axes = np.stack((np.stack((np.cos(yaws), np.sin(yaws)), axis=1),
+                           np.stack((-np.sin(yaws), np.cos(yaws)), axis=1)), axis=1)
+    # the four candidate separating axes of each pair, (N, 4, 2)
+    test_axes = np.concatenate((np.broadcast_to(axes, other_axes.shape), other_axes), axis=1)
+    distance = np.abs(np.einsum('nkd,nd->nk', test_axes, centers - np.asarray(center)))
+    radius = np.abs(np.einsum('nkd,jd->nkj', test_axes, axes)) @ np.asarray(extent) + \
+        np.einsum('nkj,nj->nk', np.abs(np.einsum('nkd,njd->nkj', test_axes, other_axes)), extents)
+    return np.all(distance <= radius, axis=1)
+
+
+class GeometricCollisionDetector(object):
+    """
+    Client side replacement of CollisionSensor, no sensor actor is spawned on the server.
+    On every tick the ego bounding box is tested against the boxes of nearby vehicles and static obstacles
+    (poles, traffic lights and traffic signs) with the separating axis test, using the actor states of the world snapshot.
+    The intensity of a collision is the relative speed instead of the normal impulse.
+    """
+
+    # static obstacles which are tested, carla.CityObjectLabel name -> SemanticTags
+    STATIC_LABELS = {'Poles': SemanticTags.Pole, 'TrafficLight': SemanticTags.TrafficLight,
+                     'TrafficSigns': SemanticTags.TrafficSign}
+
+    def __init__(self, parent_actor, radius=10.0) -> None:
+        self.history = []
+        self.radius = radius
+        self._parent = parent_actor
+        self._world = self._parent.get_world()
+        extent = self._parent.bounding_box.extent
+        self._extent = np.array([extent.x, extent.y])
+        # vehicle id -> half extents, refreshed when the number of actors changes
+        self._vehicles = {}
+        self._num_actors = -1
+        centers, yaws, extents, tags = [], [], [], []
+        for name, tag in self.STATIC_LABELS.items():
+            for bb in self._world.get_level_bbs(getattr(carla.CityObjectLabel, name)):
+                centers.append([bb.location.x, bb.location.y])
+                yaws.append(math.radians(bb.rotation.yaw))
+                extents.append([bb.extent.x, bb.extent.y])
+                tags.append(tag)
+        self._static = (np.array(centers).reshape((-1, 2)), np.array(yaws), np.array(extents).reshape((-1, 2)), tags)
+
+    def __del__(self):
+        self.history.clear()
+
+    def get_collision_history(self):
+        """Get the histroy of collisions"""
+        history = collections.defaultdict(int)
+        tags = set()
+        for tag, frame, intensity in self.history:
+            history[frame] += intensity
+            tags.add(tag)
+        return history, tags
+
+    def clear_history(self):
+        self.history.clear()
+
+    def update(self):
+        """Test the ego bounding box against nearby boxes, should be called once after every tick"""
+        snapshot = self._world.get_snapshot()
+        ego = snapshot.find(self._parent.id)
+        if ego is None:
+            return
+        if len(snapshot) != self._num_actors:
+            self._num_actors = len(snapshot)
+            self._vehicles = {actor.id: np.array([actor.bounding_box.extent.x, actor.bounding_box.extent.y])
+                              for actor in self._world.get_actors().filter('*vehicle*') if actor.id != self._parent.id}
+        transform = ego.get_transform()
+        center = np.array([transform.location.x, transform.location.y])
+        yaw = math.radians(transform.rotation.yaw)
+        ego_velocity = ego.get_velocity()
+
+        ids, centers, yaws, extents, speeds = [], [], [], [], []
+        for actor_id, extent in self._vehicles.items():
+            actor = snapshot.find(actor_id)
+            if actor is None:
+                continue
+            actor_transform = actor.get_transform()
+            velocity = actor.get_velocity()
+            ids.append(actor_id)
+            centers.append([actor_transform.location.x, actor_transform.location.y])
+            yaws.append(math.radians(actor_transform.rotation.yaw))
+            extents.append(extent)
+            speeds.append(math.hypot(velocity.x - ego_velocity.x, velocity.y - ego_velocity.y))
+        tags = [SemanticTags.Vehicles] * len(ids)
+        static_centers, static_yaws, static_extents, static_tags = self._static
+        ego_speed = math.hypot(ego_velocity.x, ego_velocity.y)
+        centers = np.concatenate((np.array(centers).reshape((-1, 2)), static_centers))
+        yaws = np.concatenate((np.array(yaws), static_yaws))
+        extents = np.concatenate((np.array(extents).reshape((-1, 2)), static_extents))
+        tags = tags + static_tags
+        speeds = np.concatenate((np.array(speeds), np.full(len(static_tags), ego_speed)))
+
+        near = np.linalg.norm(centers - center, axis=1) <= self.radius + np.linalg.norm(extents, axis=1)
+        if not np.any(near):
+            return
+        hit = np.flatnonzero(near)[obb_overlap(center, yaw, self._extent, centers[near], yaws[near], extents[near])]
+        for i in hit:
+            logging.info('Collision with %r', tags[i].name)
+            self.history.append((tags[i], snapshot.frame, speeds[i]))
+        if len(self.history) > 4000:
+            self.history = self.history[-4000:]
+
+
+class LaneDepartureDetector(object):
+    """
+    Client side replacement of LaneInvasionSensor, no sensor actor is spawned on the server.
+    A lane invasion is counted each time the ego bounding box starts to cross the border of its nearest driving lane,
+    computed from the lateral offset to the lane center on the client side map.
+    """
+
+    def __init__(self, parent_actor, carla_map=None) -> None:
+        self._parent = parent_actor
+        self._map = carla_map if carla_map is not None else self._parent.get_world().get_map()
+        self.count = 0
+        self.invading = False
+        # lateral offset of ego vehicle center to the lane center, positive means right of the lane direction
+        self.offset = 0.0
+
+    def __del__(self):
+        self.count = 0
+
+    def get_invasion_count(self):
+        return self.count
+
+    def update(self):
+        """Check the lane departure, should be called once after every tick"""
+        transform = self._parent.get_transform()
+        location = transform.location
+        lane_center = self._map.get_waypoint(location)
+        if lane_center is None:
+            return
+        center = lane_center.transform.location
+        yaw = math.radians(lane_center.transform.rotation.yaw)
+        self.offset = -(location.x - center.x) * math.sin(yaw) + (location.y - center.y) * math.cos(yaw)
+        # the lateral half size of ego vehicle body relative to the lane direction
+        heading = math.radians(transform.rotation.yaw) - yaw
+        extent = self._parent.bounding_box.extent
+        half_size = abs(extent.x * math.sin(heading)) + abs(extent.y * math.cos(heading))
+        invading = abs(self.offset) + half_size > lane_center.lane_width / 2
+        if invading and not self.invading:
+            self.count += 1
+        self.invading = invading
@@ -0,0 +1,138 @@
+""" Module with spatial index for fast neighbour queries on (x, y) points. """
+import math
+import numpy as np
+
+
+class SpatialHash:
+    """
+    Uniform grid over 2D points, the points are bucketed into square cells of cell_size.
+    A radius query only visits the cells overlapped by the query circle,
+    so a query with radius no larger than cell_size checks at most 3*3 cells, O(1) for bounded point density.
+    """
+
+    def __init__(self, points, cell_size=8.0, ids=None):
+        """
+        :param points: array like (N, 2), x and y of the indexed points
+        :param cell_size: grid cell size in meters, should be close to the common query radius
+        :param ids: optional identifiers of the points, returned by the queries instead of indexes
+        """
+        self.cell_size = cell_size
+        self.points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+        self.ids = list(ids) if ids is not None else list(range(len(self.points)))
+        self._cells = {}
+        keys = np.floor(self.points / self.cell_size).astype(np.int64)
+        for i, (cx, cy) in enumerate(keys):
+            self._cells.setdefault((cx, cy), []).append(i)
+        if len(self.points):
+            self._low, self._high = self.points.min(axis=0), self.points.max(axis=0)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _candidates(self, x, y, radius):
+        """Indexes of the points in the cells overlapped by the query circle"""
+        cx, cy = int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+        r = int(math.ceil(radius / self.cell_size))
+        candidates = []
+        for i in range(cx - r, cx + r + 1):
+            for j in range(cy - r, cy + r + 1):
+                cell = self._cells.get((i, j))
+                if cell:
+                    candidates.extend(cell)
+        return candidates
+
+    def query_radius(self, x, y, radius):
+        """Return the ids of points within radius of (x, y), sorted by distance"""
+        candidates = self._candidates(x, y, radius)
+        if not candidates:
+            return []
+        candidates = np.array(candidates)
+        dis = np.linalg.norm(self.points[candidates] - np.array([x, y]), axis=1)
+        order = np.argsort(dis, kind='stable')
+        return [self.ids[candidates[k]] for k in order if dis[k] <= radius]
+
+    def is_free(self, x, y, radius):
+        """Return True if no point is within radius of (x, y)"""
+        candidates = self._candidates(x, y, radius)
+        if not candidates:
+            return True
+        dis = np.linalg.norm(self.points[candidates] - np.array([x, y]), axis=1)
+        return not np.any(dis <= radius)
+
+    def query_knn(self, x, y, k, max_radius=None):
+        """Return the ids of the k points nearest to (x, y), sorted by distance, optionally only within max_radius"""
+        if k <= 0 or len(self.points) == 0:
+            return []
+        # the farthest corner of the occupied cells bounds the search radius
+        reach = math.hypot(max(abs(x - self._low[0]), abs(x - self._high[0])),
+                           max(abs(y - self._low[1]), abs(y - self._high[1])))
+        limit = reach if max_radius is None else min(max_radius, reach)
+        radius = self.cell_size
+        while True:
+            radius = min(radius, limit)
+            ids = self.query_radius(x, y, radius)
+            if len(ids) >= k or radius >= limit:
+                return ids[:k]
+            radius *= 2
+
+
+# upper bound of the half length of the vehicle blueprints, meters
+MAX_VEHICLE_EXTENT = 10.0
+
+# vehicle indexes keyed by world id, shared by the local planner and the agents
+_VEHICLE_INDEXES = {}
+
+
+def get_vehicle_index(world):
+    """Return the vehicle index shared by all consumers of world, refreshed on its first use in each tick"""
+    index = _VEHICLE_INDEXES.get(world.id)
+    if index is None:
+        index = _VEHICLE_INDEXES[world.id] = VehicleIndex(world)
+    index.update()
+    return index
+
+
+class VehicleIndex:
+    """
+    Spatial index of all vehicles of the world, built once per tick.
+    The vehicle actors are enumerated only when the world snapshot frame changes,
+    radius and k nearest queries then run on a SpatialHash of the vehicle locations.
+    """
+
+    def __init__(self, world, cell_size=20.0):
+        self.world = world
+        self.cell_size = cell_size
+        self.frame = None
+        self._vehicles = []
+        self._actors = {}
+        self._hash = SpatialHash(np.zeros((0, 2)), cell_size)
+
+    def update(self):
+        """Rebuild the index if the world ticked since the last build"""
+        frame = self.world.get_snapshot().frame
+        if frame == self.frame:
+            return
+        self.frame = frame
+        self._vehicles = list(self.world.get_actors().filter('*vehicle*'))
+        self._actors = {vehicle.id: vehicle for vehicle in self._vehicles}
+        points = []
+        for vehicle in self._vehicles:
+            location = vehicle.get_location()
+            points.append((location.x, location.y))
+        self._hash = SpatialHash(np.array(points).reshape((-1, 2)), self.cell_size, list(self._actors))
+
+    def __len__(self):
+        return len(self._vehicles)
+
+    def vehicles(self, exclude=None):
+        """All vehicle actors, except the actor with id exclude"""
+        return [vehicle for vehicle in self._vehicles if vehicle.id != exclude]
+
+    def query_radius(self, location, radius, exclude=None):
+        """Vehicle actors within radius of a carla.Location, sorted by distance, except the actor with id exclude"""
+        return [self._actors[i] for i in self._hash.query_radius(location.x, location.y, radius) if i != exclude]
+
+    def query_knn(self, location, k, max_radius=None, exclude=None):
+        """The k vehicle actors nearest to a carla.Location, sorted by distance, except the actor with id exclude"""
+        ids = self._hash.query_knn(location.x, location.y, k + (exclude is not None), max_radius)
+        return [self._actors[i] for i in ids if i != exclude][:k]
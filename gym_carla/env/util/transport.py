@@ -0,0 +1,247 @@
+""" Module with the shared memory transport of CarlaEnv worker processes, observations are written in place without pickling. """
+import logging
+import traceback
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+# the same layout as CarlaEnv.get_observation_space
+OBS_SPACE = {'waypoints': 10, 'ego_vehicle': 6, 'conventional_vehicle': 3, 'light': 3}
+# scalar entries of the step info record, entries missing from an info dict are nan, bools are stored as 0/1
+INFO_KEYS = ['Reward', 'TTC', 'Comfort', 'Efficiency', 'Lane_center', 'Yaw', 'velocity', 'offlane', 'impact',
+             'change_in_lane_follow', 'Abandon', 'Steer', 'Throttle', 'Brake', 'Change', 'control_state',
+             'effective', 'ego_lane', 'total_step', 'rl_control_step', 'RL_switch']
+INFO_DTYPE = np.dtype([(key, np.float64) for key in INFO_KEYS])
+# worker commands
+CLOSE, STEP, RESET = 0, 1, 2
+# seconds between two liveness checks of a worker while waiting for its response
+POLL_INTERVAL = 1.0
+
+
+def observation_schema(obs_space=OBS_SPACE):
+    """Shape and dtype of each observation entry of a single env"""
+    waypoints = (obs_space['waypoints'], 3)
+    return {'left_waypoints': (waypoints, np.float32),
+            'center_waypoints': (waypoints, np.float32),
+            'right_waypoints': (waypoints, np.float32),
+            'vehicle_info': ((6, obs_space['conventional_vehicle']), np.float32),
+            'ego_vehicle': ((obs_space['ego_vehicle'],), np.float32),
+            'light': ((obs_space['light'],), np.float32)}
+
+
+def transport_schema(action_shape, obs_space=OBS_SPACE):
+    """Shape and dtype of every shared array of a single env, observations are prefixed by 'obs/'"""
+    schema = {'obs/' + key: value for key, value in observation_schema(obs_space).items()}
+    schema.update({'reward': ((), np.float64), 'truncated': ((), np.bool_), 'done': ((), np.bool_),
+                   'info': ((), INFO_DTYPE), 'a_index': ((), np.int64), 'action': (tuple(action_shape), np.float64),
+                   'command': ((), np.int64), 'error': ((), np.bool_)})
+    return schema
+
+
+class SharedArrays:
+    """Numpy arrays with a leading env axis, all placed in one shared memory block"""
+
+    def __init__(self, num_envs, schema, name=None):
+        """
+        :param schema: dict of key -> (shape of a single env, dtype)
+        :param name: name of an existing block to attach to, None to create a new one
+        """
+        offsets, size = {}, 0
+        for key, (shape, dtype) in schema.items():
+            dtype = np.dtype(dtype)
+            # align every array to 64 bytes
+            size = (size + 63) // 64 * 64
+            offsets[key] = size
+            size += int(np.prod(shape, dtype=np.int64)) * dtype.itemsize * num_envs
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.arrays = {key: np.ndarray((num_envs,) + tuple(shape), dtype=dtype, buffer=self.shm.buf, offset=offsets[key])
+                       for key, (shape, dtype) in schema.items()}
+        if self.owner:
+            for array in self.arrays.values():
+                array.fill(0)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def write_step(arrays, index, state, reward=None, truncated=False, done=False, info=None, env=None):
+    """Write the outputs of CarlaEnv.reset or CarlaEnv.step of env index into the shared arrays in place"""
+    if state is not None:
+        unknown = [key for key in state if 'obs/' + key not in arrays.arrays]
+        if unknown:
+            raise ValueError('state entries %s are not in the transport schema' % unknown)
+        for key, value in state.items():
+            arrays['obs/' + key][index] = value
+    arrays['reward'][index] = np.nan if reward is None else reward
+    arrays['truncated'][index] = bool(truncated)
+    arrays['done'][index] = bool(done)
+    record = arrays['info'][index]
+    info = info if info is not None else {}
+    for key in INFO_KEYS:
+        value = info.get(key)
+        record[key] = np.nan if value is None else float(value)
+    if env is not None:
+        record['effective'] = env.is_effective_action()
+        record['ego_lane'] = env.get_ego_lane()
+        record['total_step'] = env.total_step
+        record['rl_control_step'] = env.rl_control_step
+        record['RL_switch'] = env.RL_switch
+
+
+def _worker(index, env_args, env_kwargs, shm_name, num_envs, schema, request, response):
+    # import here so that the trainer process doesn't need a carla client
+    from gym_carla.env.carla_env import CarlaEnv
+    arrays = SharedArrays(num_envs, schema, shm_name)
+    env = None
+    try:
+        env = CarlaEnv(env_args, **env_kwargs)
+        while True:
+            request.acquire()
+            command = int(arrays['command'][index])
+            if command == CLOSE:
+                break
+            try:
+                if command == RESET:
+                    write_step(arrays, index, env.reset(), env=env)
+                else:
+                    state, reward, truncated, done, info = env.step(int(arrays['a_index'][index]),
+                                                                    arrays['action'][index].copy())
+                    write_step(arrays, index, state, reward, truncated, done, info, env)
+                arrays['error'][index] = False
+            except Exception:
+                logging.error('env worker %d failed:\n%s', index, traceback.format_exc())
+                arrays['error'][index] = True
+            response.release()
+    finally:
+        if env is None:
+            # the env failed to start, report it to the pending request
+            arrays['error'][index] = True
+        else:
+            env.__del__()
+        response.release()
+        arrays.close()
+
+
+class SharedMemoryEnvs:
+    """
+    CarlaEnv instances running in worker processes. The observations, rewards, done and truncated flags and a fixed
+    schema info record of every env live in one shared memory block, workers write them in place and signal the
+    trainer with a semaphore, only the command code crosses the process boundary.
+    The trainer gets stacked numpy views with the env axis first, the views are overwritten by the next reset or step,
+    copy them (e.g. observation(i)) before storing them in a replay buffer.
+    """
+
+    def __init__(self, env_args, env_kwargs=None, action_shape=(1, 2), obs_space=OBS_SPACE, timeout=None):
+        """
+        :param env_args: list of parsed settings.ARGS, one per worker, each worker should connect to its own carla server
+        :param env_kwargs: extra keyword arguments of CarlaEnv, e.g. train_pdqn
+        :param action_shape: shape of the action array passed to CarlaEnv.step
+        :param timeout: max seconds to wait for the response of a worker, None to wait as long as the worker is alive
+        """
+        self.num_envs = len(env_args)
+        self.timeout = timeout
+        schema = transport_schema(action_shape, obs_space)
+        self.arrays = SharedArrays(self.num_envs, schema)
+        ctx = mp.get_context('spawn')
+        self.requests = [ctx.Semaphore(0) for _ in range(self.num_envs)]
+        self.responses = [ctx.Semaphore(0) for _ in range(self.num_envs)]
+        self.processes = []
+        for i, args in enumerate(env_args):
+            process = ctx.Process(target=_worker, daemon=True,
+                                  args=(i, args, env_kwargs or {}, self.arrays.name, self.num_envs, schema,
+                                        self.requests[i], self.responses[i]))
+            process.start()
+            self.processes.append(process)
+        self.obs = {key[len('obs/'):]: array for key, array in self.arrays.arrays.items() if key.startswith('obs/')}
+        self.reward, self.truncated, self.done = self.arrays['reward'], self.arrays['truncated'], self.arrays['done']
+        self.info = self.arrays['info']
+        self._pending = []
+
+    def __len__(self):
+        return self.num_envs
+
+    def _indices(self, indices):
+        return range(self.num_envs) if indices is None else indices
+
+    def _send(self, command, indices):
+        for i in self._indices(indices):
+            self.arrays['command'][i] = command
+            self._pending.append(i)
+            self.requests[i].release()
+
+    def wait(self):
+        """
+        Wait for the pending workers, return the stacked views (obs, reward, truncated, done, info).
+        Raise RuntimeError if a worker failed, exited without responding or exceeded the timeout.
+        """
+        pending, self._pending = self._pending, []
+        failed = []
+        for i in pending:
+            if not self._acquire(i):
+                failed.append(i)
+        failed += [i for i in pending if i not in failed and self.arrays['error'][i]]
+        if failed:
+            raise RuntimeError('env workers %s failed' % sorted(failed))
+        return self.obs, self.reward, self.truncated, self.done, self.info
+
+    def _acquire(self, index):
+        """Wait for the response of worker index, False if it exited without responding or timed out"""
+        waited = 0.0
+        while not self.responses[index].acquire(timeout=POLL_INTERVAL):
+            waited += POLL_INTERVAL
+            if not self.processes[index].is_alive():
+                # the worker may have responded just before exiting
+                if self.responses[index].acquire(False):
+                    return True
+                logging.error('env worker %d exited with code %s', index, self.processes[index].exitcode)
+                return False
+            if self.timeout is not None and waited >= self.timeout:
+                logging.error('env worker %d did not respond in %.1f seconds', index, waited)
+                return False
+        return True
+
+    def reset(self, indices=None):
+        """Reset the envs of indices, None for all, return the stacked observation views"""
+        self._send(RESET, indices)
+        return self.wait()[0]
+
+    def step_async(self, a_index, actions, indices=None):
+        """Write the actions of the envs of indices and start their steps without waiting"""
+        indices = list(self._indices(indices))
+        a_index = np.broadcast_to(a_index, (len(indices),))
+        for k, i in enumerate(indices):
+            self.arrays['a_index'][i] = a_index[k]
+            self.arrays['action'][i] = actions[k]
+        self._send(STEP, indices)
+
+    def step(self, a_index, actions, indices=None):
+        """Step the envs of indices with their actions, return the stacked views (obs, reward, truncated, done, info)"""
+        self.step_async(a_index, actions, indices)
+        return self.wait()
+
+    def observation(self, index):
+        """Copy the observation of env index into a dict, the same format as CarlaEnv returns"""
+        return {key: array[index].copy() for key, array in self.obs.items()}
+
+    def close(self):
+        if self._pending:
+            try:
+                self.wait()
+            except RuntimeError:
+                logging.warning('closing the env workers after a failure')
+        self._send(CLOSE, [i for i, process in enumerate(self.processes) if process.is_alive()])
+        self._pending = []
+        for process in self.processes:
+            process.join(timeout=30)
+        self.arrays.close()
@@ -36,6 +36,23 @@ class WaypointWrapper:
                 WaypointWrapper.right_rear_wps=opt['right_rear_wps']
 
 
+class LazyWaypointWrapper(WaypointWrapper):
+    """
+    The six waypoint windows of one LocalPlanner step, each window is computed on first access during that step.
+    The windows are kept in the outputs of the step, so they don't change in the later steps.
+    """
+    left_front_wps=property(lambda self: self._planner.get_window('left_front_wps', self._outputs))
+    left_rear_wps=property(lambda self: self._planner.get_window('left_rear_wps', self._outputs))
+    center_front_wps=property(lambda self: self._planner.get_window('center_front_wps', self._outputs))
+    center_rear_wps=property(lambda self: self._planner.get_window('center_rear_wps', self._outputs))
+    right_front_wps=property(lambda self: self._planner.get_window('right_front_wps', self._outputs))
+    right_rear_wps=property(lambda self: self._planner.get_window('right_rear_wps', self._outputs))
+
+    def __init__(self, planner, outputs) -> None:
+        self._planner = planner
+        self._outputs = outputs
+
+
 class VehicleWrapper:
     """The location left, right, center is allocated according to the lane of ego vehicle"""
     left_front_veh=None
@@ -78,6 +95,25 @@ class VehicleWrapper:
             if 'dis_to_rear_vehs' in opt:
                 VehicleWrapper.distance_to_rear_vehicles=opt['dis_to_rear_vehs']
 
+
+class LazyVehicleWrapper(VehicleWrapper):
+    """
+    The neighbour vehicles of one LocalPlanner step, computed on first access during that step.
+    The vehicles are kept in the outputs of the step, so they don't change in the later steps.
+    """
+    left_front_veh=property(lambda self: self._planner.get_vehicles(self._outputs)['left_front_veh'])
+    left_rear_veh=property(lambda self: self._planner.get_vehicles(self._outputs)['left_rear_veh'])
+    center_front_veh=property(lambda self: self._planner.get_vehicles(self._outputs)['center_front_veh'])
+    center_rear_veh=property(lambda self: self._planner.get_vehicles(self._outputs)['center_rear_veh'])
+    right_front_veh=property(lambda self: self._planner.get_vehicles(self._outputs)['right_front_veh'])
+    right_rear_veh=property(lambda self: self._planner.get_vehicles(self._outputs)['right_rear_veh'])
+    distance_to_front_vehicles=property(lambda self: self._planner.get_vehicles(self._outputs)['dis_to_front_vehs'])
+    distance_to_rear_vehicles=property(lambda self: self._planner.get_vehicles(self._outputs)['dis_to_rear_vehs'])
+
+    def __init__(self, planner, outputs) -> None:
+        self._planner = planner
+        self._outputs = outputs
+
 class Truncated(Enum):
     """Different truncate situations"""
     FALSE=-1
@@ -102,17 +138,20 @@ class Action(Enum):
     LANE_CHANGE_RIGHT=1
     STOP=2
 
-def process_lane_wp(wps_list, ego_vehicle_z, ego_forward_vector, my_sample_ratio, lane_offset):
+def process_lane_wp(wps_list, ego_vehicle_z, ego_forward_vector, my_sample_ratio, lane_offset, offsets=None):
+    """offsets: sample offsets of wps_list in multiples of sampling resolution, None for a uniform list"""
     wps = []
     idx = 0
 
     for wp in wps_list:
+        offset = idx + 1 if offsets is None else offsets[idx]
+        idx = idx + 1
+        if offset % my_sample_ratio != 0:
+            continue
         delta_z = wp.transform.location.z - ego_vehicle_z
         yaw_diff = math.degrees(get_yaw_diff(wp.transform.get_forward_vector(), ego_forward_vector))
         yaw_diff = yaw_diff / 90
-        if idx % my_sample_ratio == my_sample_ratio-1:
-            wps.append([delta_z/3, yaw_diff, lane_offset])
-        idx = idx + 1
+        wps.append([delta_z/3, yaw_diff, lane_offset])
     return np.array(wps)
 
 def process_veh(ego_vehicle, vehs_info, left_wall, right_wall,vehicle_proximity):
@@ -0,0 +1,66 @@
+"""Checks of the order in which the command collector submits a step."""
+import pytest
+
+pytest.importorskip('gym')
+from gym_carla.env.util.command import CommandCollector
+
+
+class _Response:
+    error = ''
+
+    def has_error(self):
+        return False
+
+
+class _Client:
+    def __init__(self, log):
+        self.log = log
+
+    def apply_batch(self, commands):
+        self.log.append(('apply_batch', list(commands)))
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        self.log.append(('apply_batch_sync', list(commands), do_tick))
+        return [_Response() for _ in commands]
+
+
+class _Snapshot:
+    def __init__(self, frame):
+        self.frame = frame
+
+
+class _World:
+    def __init__(self, log):
+        self.log = log
+        self.frame = 0
+
+    def tick(self):
+        self.frame += 1
+        self.log.append(('tick', self.frame))
+        return self.frame
+
+    def get_snapshot(self):
+        return _Snapshot(self.frame)
+
+
+def test_autopilot_toggle_runs_before_the_traffic_manager_settings_and_the_tick():
+    log = []
+    collector = CommandCollector(_Client(log), _World(log))
+    collector.add('control')
+    collector.add_sync('autopilot')
+    collector.defer(log.append, 'traffic manager')
+    assert len(collector) == 3
+    assert collector.flush(tick=True) == 1
+    assert log == [('apply_batch_sync', ['autopilot'], False), 'traffic manager',
+                   ('apply_batch', ['control']), ('tick', 1)]
+    assert len(collector) == 0
+
+
+def test_flush_without_tick():
+    log = []
+    collector = CommandCollector(_Client(log), _World(log))
+    assert collector.flush() is None
+    collector.add('control')
+    assert collector.flush() is None
+    assert log == [('apply_batch', ['control'])]
+    assert collector.flush(tick=True) == 1
@@ -0,0 +1,58 @@
+"""save_net/load_net round trips of DDPG with and without observation normalization."""
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+from algs.ddpg import DDPG
+
+
+def _agent(obs_norm):
+    torch.manual_seed(0)
+    s_dim = {'waypoints': 10, 'ego_vehicle': 6, 'conventional_vehicle': 3, 'light': 3}
+    a_bound = {'steer': 0.3, 'throttle': 0.8, 'brake': 0.8}
+    return DDPG(s_dim, 2, a_bound, 0.9, 0.01, 0.5, 0.05, 0.5, 100, 16, 1e-4, 1e-4, 10, torch.device('cpu'),
+                obs_norm=obs_norm)
+
+
+def _state_dicts(agent):
+    return {name: {key: value.clone() for key, value in getattr(agent, name).state_dict().items()}
+            for name in ('actor', 'actor_target', 'critic', 'critic_target')}
+
+
+def _assert_same(first, second):
+    assert first.keys() == second.keys()
+    for name in first:
+        assert first[name].keys() == second[name].keys()
+        for key in first[name]:
+            assert torch.equal(first[name][key], second[name][key]), (name, key)
+
+
+@pytest.mark.parametrize('obs_norm', [False, True])
+def test_round_trip(tmp_path, obs_norm):
+    agent = _agent(obs_norm)
+    if obs_norm:
+        agent.obs_rms.update(np.random.default_rng(0).normal(2.0, 3.0, (64, agent.obs_rms.mean.shape[0])))
+    path = str(tmp_path / 'ddpg.pth')
+    agent.save_net(path)
+    other = _agent(obs_norm)
+    for param in other.actor.parameters():
+        param.data.add_(1.0)
+    other.load_net(torch.load(path))
+    _assert_same(_state_dicts(agent), _state_dicts(other))
+    assert (other.obs_rms is None) == (not obs_norm)
+
+
+def test_raw_checkpoint_turns_off_normalization(tmp_path):
+    path = str(tmp_path / 'raw.pth')
+    _agent(False).save_net(path)
+    agent = _agent(True)
+    agent.load_net(torch.load(path))
+    assert agent.obs_rms is None and agent.replay_buffer.obs_rms is None
+    assert all(net.obs_rms is None for net in (agent.actor, agent.actor_target, agent.critic, agent.critic_target))
+
+
+def test_normalized_checkpoint_needs_normalization(tmp_path):
+    path = str(tmp_path / 'norm.pth')
+    _agent(True).save_net(path)
+    with pytest.raises(ValueError):
+        _agent(False).load_net(torch.load(path))
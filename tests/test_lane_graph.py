@@ -0,0 +1,98 @@
+"""Checks of the lane graph navigation with straight stand-in lanes, no carla server is needed."""
+import numpy as np
+import pytest
+
+pytest.importorskip('carla')
+pytest.importorskip('scipy')
+import carla
+from gym_carla.env.agent.lane_graph import LaneGraph, get_lane_graph
+
+ROAD_ID = 7
+LANE_WIDTH = 3.0
+
+
+class _Waypoint:
+    """A waypoint of a straight road along the x axis, lane 1 is the other direction, lanes -4 to -6 the roadside"""
+
+    calls = 0
+
+    def __init__(self, s, lane_id):
+        self.s = float(s)
+        self.lane_id = lane_id
+        self.road_id = ROAD_ID
+        self.lane_width = LANE_WIDTH
+        self.lane_type = 2  # int(carla.LaneType.Driving)
+        y = LANE_WIDTH * (-lane_id - 1) if lane_id < 0 else -LANE_WIDTH * lane_id
+        self.transform = carla.Transform(carla.Location(x=self.s, y=y, z=0.0), carla.Rotation())
+
+    def get_left_lane(self):
+        _Waypoint.calls += 1
+        if self.lane_id == 1:
+            return None
+        return _Waypoint(self.s, self.lane_id + 1 if self.lane_id < -1 else 1)
+
+    def get_right_lane(self):
+        _Waypoint.calls += 1
+        if self.lane_id == 1:
+            return _Waypoint(self.s, -1)
+        return _Waypoint(self.s, self.lane_id - 1) if self.lane_id > -6 else None
+
+    def next(self, distance):
+        return [_Waypoint(self.s + distance, self.lane_id)] if self.s + distance <= 20 else []
+
+    def previous(self, distance):
+        return [_Waypoint(self.s - distance, self.lane_id)] if self.s - distance >= 0 else []
+
+
+class _Map:
+    name = 'Carla/Maps/Town05'
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_waypoint_xodr(self, road_id, lane_id, s):
+        self.calls += 1
+        return _Waypoint(s, lane_id)
+
+
+@pytest.fixture
+def route():
+    return [_Waypoint(s, lane_id) for lane_id in (-1, -2, -3) for s in range(21)]
+
+
+def _chain(waypoint, offset):
+    for _ in range(abs(offset)):
+        waypoint = waypoint.get_right_lane() if offset > 0 else waypoint.get_left_lane()
+        if waypoint is None:
+            return None
+    return waypoint
+
+
+def test_lateral_matches_the_lane_chain_without_map_queries(route):
+    carla_map = _Map()
+    graph = LaneGraph.build(carla_map, route, 1.0)
+    for s in np.linspace(0.0, 20.0, 41):
+        for lane_id in (-1, -2, -3, -6, 1):
+            waypoint = _Waypoint(s, lane_id)
+            for offset in (-5, -2, -1, 1, 2, 3):
+                expected = _chain(waypoint, offset)
+                calls = _Waypoint.calls, carla_map.calls
+                lane_wp = graph.lateral(waypoint, offset)
+                if expected is None:
+                    assert lane_wp is None
+                    continue
+                assert (_Waypoint.calls, carla_map.calls) == calls
+                assert lane_wp.lane_id == expected.lane_id
+                assert abs(lane_wp.s - s) <= graph.resolution / 2
+                assert graph.lateral(waypoint, offset, exact=True).s == s
+                location, width = graph.lateral_location(waypoint, offset)
+                assert location.distance(expected.transform.location) < 1e-9 and width == expected.lane_width
+
+
+def test_saved_graph_is_reloaded(route, tmp_path):
+    path = str(tmp_path / 'lane_graph_{}.npz')
+    built = get_lane_graph(_Map(), route, 1.0, path)
+    loaded = get_lane_graph(_Map(), route, 1.0, path)
+    assert all(np.array_equal(getattr(built, field), getattr(loaded, field)) for field in LaneGraph.FIELDS)
+    assert loaded.lateral(_Waypoint(5.2, -1), 2).lane_id == -3
+    assert LaneGraph.load(_Map(), route[:-1], 1.0, path.format('Town05')) is None
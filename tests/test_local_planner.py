@@ -0,0 +1,109 @@
+"""Checks of the local planner waypoint windows with a straight stand-in lane, no carla server is needed."""
+from collections import deque
+import numpy as np
+import pytest
+
+pytest.importorskip('carla')
+pytest.importorskip('shapely')
+pytest.importorskip('networkx')
+import carla
+from gym_carla.env.agent.local_planner import LocalPlanner
+
+
+class _Waypoint:
+    """A waypoint on a straight lane along the x axis"""
+
+    def __init__(self, x):
+        self.x = x
+        self.id = hash(x)
+        self.road_id = 12
+        self.lane_id = -2
+        self.transform = carla.Transform(carla.Location(x=x, y=0.0, z=0.0), carla.Rotation())
+
+    def next(self, distance):
+        return [_Waypoint(self.x + distance)]
+
+    def previous(self, distance):
+        return [_Waypoint(self.x - distance)]
+
+
+def _planner(buffer_size=10, sampling_radius=1.0):
+    planner = object.__new__(LocalPlanner)
+    planner._buffer_size = buffer_size
+    planner._sampling_radius = sampling_radius
+    planner._waypoints_queue = deque(maxlen=600)
+    planner._lane_grids = {}
+    planner.front_offsets = np.arange(1, buffer_size + 1)
+    planner._uniform_front = True
+    return planner
+
+
+def test_reused_windows_are_quantized_to_half_a_resolution():
+    planner = _planner()
+    rng = np.random.default_rng(0)
+    x = 0.0
+    for _ in range(200):
+        x += rng.uniform(0.0, 2.5)
+        ego = _Waypoint(x)
+        front, rear = planner._advance_lane_grid('center', ego)
+        old_front = planner._get_waypoints_one_lane(ego, True)
+        old_rear = planner._get_waypoints_one_lane(ego, False)
+        assert len(front) == len(old_front) and len(rear) == len(old_rear)
+        np.testing.assert_array_less(np.abs([wp.x - old.x for wp, old in zip(front + rear, old_front + old_rear)]),
+                                     planner._sampling_radius / 2 + 1e-9)
+
+
+def test_reused_windows_match_on_the_grid():
+    planner = _planner()
+    for x in (0.0, 1.0, 3.0, 4.0, 20.0):
+        ego = _Waypoint(x)
+        front, rear = planner._advance_lane_grid('center', ego)
+        assert [wp.x for wp in front] == [wp.x for wp in planner._get_waypoints_one_lane(ego, True)]
+        assert [wp.x for wp in rear] == [wp.x for wp in planner._get_waypoints_one_lane(ego, False)]
+
+
+def test_lazy_outputs_are_snapshots_of_their_step():
+    planner = _planner()
+    planner.features = {'front_waypoints', 'vehicles'}
+    planner._reuse_windows = False
+    planner._lane_store = None
+    steps = iter(range(100))
+    planner._get_waypoints = lambda directions, offsets=None: {
+        key: [next(steps)] for key in ('left_rear_wps', 'center_rear_wps', 'right_rear_wps',
+                                       'left_front_wps', 'center_front_wps', 'right_front_wps')[3 * directions[0]:][:3]}
+    planner._get_vehicles = lambda: {'center_rear_veh': next(steps)}
+    planner.step_latency = deque()
+    planner._outputs = {}
+
+    wps_info, _, vehs_info = planner.run_step()
+    front, rear, vehicle = wps_info.center_front_wps, wps_info.center_rear_wps, vehs_info.center_rear_veh
+    wps_info_next, _, vehs_info_next = planner.run_step()
+    assert (wps_info.center_front_wps, wps_info.center_rear_wps, vehs_info.center_rear_veh) == (front, rear, vehicle)
+    assert wps_info_next.center_front_wps != front and vehs_info_next.center_rear_veh != vehicle
+    # an undeclared output that was not read during its step can't be computed later
+    assert planner.declared_windows() == ['left_front_wps', 'center_front_wps', 'right_front_wps']
+    planner.run_step()
+    with pytest.raises(RuntimeError):
+        wps_info_next.left_rear_wps
+
+
+class _Vehicle:
+    def __init__(self, x):
+        self.location = carla.Location(x=x, y=0.0, z=0.0)
+
+    def get_location(self):
+        return self.location
+
+
+def test_chained_windows_give_the_predecessor_gap_distances():
+    planner = _planner()
+    planner._predecessors = {}
+    planner.vehicle_proximity = 50
+    origins = (_Waypoint(10.3), _Waypoint(10.3), None)
+    slots = []
+    for direction, vehicle in ((True, _Vehicle(30.0)), (False, _Vehicle(2.0))):
+        for origin in origins:
+            wps = [] if origin is None else planner._get_waypoints_one_lane(origin, direction)
+            slots.append((wps, vehicle if origin is origins[0] else None))
+    assert planner._caculate_dis(slots, origins) == pytest.approx(planner._caculate_dis(slots))
+    assert planner._caculate_dis(slots, origins) == pytest.approx([19.7, 50, 0, 6.3, 50, 0])
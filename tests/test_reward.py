@@ -0,0 +1,86 @@
+"""Checks of the vectorized reward engine against the per step reward functions of the env."""
+import math
+from collections import deque
+import numpy as np
+import pytest
+
+pytest.importorskip('carla')
+from types import SimpleNamespace
+from gym_carla.env.util.reward import ttc_rewards, vehicle_gap, impact_patch, add_patched, collect_kinematics, \
+    KINEMATIC_KEYS
+from gym_carla.env.util.wrapper import ttc_reward, get_speed, Truncated
+
+
+class _Location(SimpleNamespace):
+    def distance(self, other):
+        return math.hypot(self.x - other.x, self.y - other.y)
+
+
+class _Vehicle:
+    def __init__(self, x, y, vx, vy, extent_x, extent_y):
+        self._location = _Location(x=x, y=y)
+        self._velocity = SimpleNamespace(x=vx, y=vy, z=0.0)
+        self.bounding_box = SimpleNamespace(extent=SimpleNamespace(x=extent_x, y=extent_y))
+
+    def get_location(self):
+        return self._location
+
+    def get_velocity(self):
+        return self._velocity
+
+
+class _Buffer:
+    def __init__(self):
+        self.transitions = []
+
+    def add(self, *transition):
+        self.transitions.append(transition)
+
+
+def test_ttc_rewards_match_ttc_reward():
+    rng = np.random.default_rng(0)
+    min_dis, threshold = 5.0, 4.0
+    expected, gaps, ego_speeds, front_speeds = [], [], [], []
+    for _ in range(2000):
+        ego = _Vehicle(0.0, 0.0, rng.uniform(0, 20), rng.uniform(-1, 1), rng.uniform(1, 3), rng.uniform(0.5, 1.5))
+        front = _Vehicle(rng.uniform(-5, 60), rng.uniform(-2, 2), rng.uniform(0, 20), 0.0,
+                         rng.uniform(1, 3), rng.uniform(0.5, 1.5))
+        expected.append(ttc_reward(ego, front, min_dis, threshold))
+        gaps.append(vehicle_gap(ego, front))
+        ego_speeds.append(get_speed(ego, False))
+        front_speeds.append(get_speed(front, False))
+    np.testing.assert_allclose(ttc_rewards(gaps, ego_speeds, front_speeds, min_dis, threshold), expected, atol=1e-9)
+
+
+def _info(episode, time_step, impact, truncated=Truncated.FALSE.value):
+    info = {key: 0.0 for key in KINEMATIC_KEYS}
+    info.update(episode=episode, time_step=time_step, impact=impact, truncated=truncated)
+    return info
+
+
+def test_add_patched_relabels_the_stored_rewards():
+    # the train loop stores each transition with the impact of the next one and truncated transitions as they are,
+    # the transition before a truncated one and the last one of an episode are not stored
+    buffer = _Buffer()
+    episodes = [[(0, 1.0, 0.3), (1, 2.0, 0.6), (4, 3.0, 0.9), (5, 4.0, 1.2)], [(0, 5.0, 1.5), (3, 6.0, 1.8)]]
+    for episode, steps in enumerate(episodes):
+        impact_deque = deque(maxlen=2)
+        for i, (time_step, reward, impact) in enumerate(steps):
+            truncated = episode == 0 and i == len(steps) - 1
+            info = _info(episode, time_step, impact, Truncated.NORMAL.value if truncated else Truncated.FALSE.value)
+            if truncated:
+                buffer.add(None, 0, None, reward, None, truncated, False, info)
+            else:
+                impact_deque.append([None, 0, None, reward, None, truncated, False, info])
+                if len(impact_deque) == 2:
+                    add_patched(buffer, impact_deque[0], impact)
+    rewards = np.array([transition[3] for transition in buffer.transitions])
+    np.testing.assert_allclose(rewards, [1.0 + 0.6 / 9, 2.0 + 0.9 / 9, 4.0, 5.0 + 1.8 / 9])
+    kin = collect_kinematics([transition[7] for transition in buffer.transitions])
+    np.testing.assert_allclose(impact_patch([1.0, 2.0, 4.0, 5.0], kin), rewards)
+
+
+def test_impact_patch_without_recorded_impacts():
+    kin = collect_kinematics([_info(0, 0, 0.3), _info(0, 1, 0.6), _info(0, 4, 0.9), _info(0, 5, 1.2, Truncated.NORMAL.value),
+                              _info(1, 0, 1.5)])
+    np.testing.assert_allclose(impact_patch([1.0] * 5, kin), [1.0 + 0.6 / 9, 1.0 + 0.9 / 9, 1.0, 1.0, 1.0])
@@ -0,0 +1,38 @@
+"""Checks of the spatial hash queries against brute force distances."""
+import numpy as np
+import pytest
+
+pytest.importorskip('gym')
+from gym_carla.env.util.spatial import SpatialHash
+
+
+def _brute_force(points, x, y):
+    return np.linalg.norm(points - np.array([x, y]), axis=1)
+
+
+def test_query_radius_matches_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-200, 200, (500, 2))
+    index = SpatialHash(points, cell_size=8.0)
+    for x, y, radius in rng.uniform([-220, -220, 1], [220, 220, 40], (50, 3)):
+        dis = _brute_force(points, x, y)
+        assert sorted(index.query_radius(x, y, radius)) == sorted(np.flatnonzero(dis <= radius).tolist())
+
+
+def test_query_knn_matches_brute_force():
+    rng = np.random.default_rng(1)
+    points = rng.uniform(-200, 200, (300, 2))
+    index = SpatialHash(points, cell_size=8.0)
+    for x, y in rng.uniform(-400, 400, (50, 2)):
+        dis = _brute_force(points, x, y)
+        for k in (1, 5, 300, 400):
+            assert index.query_knn(x, y, k) == np.argsort(dis, kind='stable')[:k].tolist()
+        assert index.query_knn(x, y, 5, max_radius=30.0) == \
+            [i for i in np.argsort(dis, kind='stable')[:5].tolist() if dis[i] <= 30.0]
+
+
+def test_empty_index():
+    index = SpatialHash(np.zeros((0, 2)))
+    assert index.query_radius(0.0, 0.0, 10.0) == []
+    assert index.query_knn(0.0, 0.0, 3) == []
+    assert index.is_free(0.0, 0.0, 10.0)
@@ -0,0 +1,85 @@
+"""Checks of the shared memory transport without carla, the worker processes are replaced by stand-ins."""
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('gym')
+from gym_carla.env.util import transport
+from gym_carla.env.util.transport import SharedArrays, SharedMemoryEnvs, transport_schema, observation_schema, \
+    write_step, STEP
+
+
+@pytest.fixture
+def arrays():
+    arrays = SharedArrays(2, transport_schema((1, 2)))
+    yield arrays
+    arrays.close()
+
+
+def _state(value):
+    return {key: np.full(shape, value, dtype=dtype) for key, (shape, dtype) in observation_schema().items()}
+
+
+def test_write_step_fills_the_env_slot(arrays):
+    attached = SharedArrays(2, transport_schema((1, 2)), arrays.name)
+    try:
+        write_step(arrays, 1, _state(3.0), 0.5, True, False, {'TTC': -0.2, 'Abandon': True})
+        assert np.all(attached['obs/center_waypoints'][1] == 3.0) and np.all(attached['obs/center_waypoints'][0] == 0)
+        assert attached['reward'][1] == 0.5 and attached['truncated'][1] and not attached['done'][1]
+        assert attached['info'][1]['TTC'] == -0.2 and attached['info'][1]['Abandon'] == 1.0
+        assert np.isnan(attached['info'][1]['Comfort'])
+        write_step(arrays, 0, _state(1.0))
+        assert np.isnan(attached['reward'][0])
+    finally:
+        attached.close()
+
+
+def test_write_step_rejects_entries_outside_the_schema(arrays):
+    state = dict(_state(1.0), birdeye=np.zeros((4, 4, 3)))
+    with pytest.raises(ValueError, match='birdeye'):
+        write_step(arrays, 0, state)
+
+
+class _Process:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.exitcode = None if alive else 1
+
+    def is_alive(self):
+        return self.alive
+
+
+def _envs(arrays, processes, timeout=None):
+    envs = object.__new__(SharedMemoryEnvs)
+    envs.num_envs = len(processes)
+    envs.timeout = timeout
+    envs.arrays = arrays
+    envs.requests = [threading.Semaphore(0) for _ in processes]
+    envs.responses = [threading.Semaphore(0) for _ in processes]
+    envs.processes = processes
+    envs.obs, envs.reward, envs.truncated, envs.done, envs.info = {}, arrays['reward'], arrays['truncated'], \
+        arrays['done'], arrays['info']
+    envs._pending = []
+    return envs
+
+
+def test_wait_fails_on_a_dead_worker_instead_of_hanging(arrays, monkeypatch):
+    monkeypatch.setattr(transport, 'POLL_INTERVAL', 0.01)
+    envs = _envs(arrays, [_Process(), _Process(alive=False)])
+    envs._send(STEP, None)
+    envs.responses[0].release()
+    with pytest.raises(RuntimeError, match=r'\[1\]'):
+        envs.wait()
+
+
+def test_wait_timeout(arrays, monkeypatch):
+    monkeypatch.setattr(transport, 'POLL_INTERVAL', 0.01)
+    envs = _envs(arrays, [_Process(), _Process()], timeout=0.05)
+    envs._send(STEP, None)
+    envs.responses[1].release()
+    with pytest.raises(RuntimeError, match=r'\[0\]'):
+        envs.wait()
+    envs._send(STEP, None)
+    envs.responses[0].release()
+    envs.responses[1].release()
+    assert envs.wait()[1] is arrays['reward']
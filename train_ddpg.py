@@ -56,7 +56,7 @@ def main():
 
     for run in [base_name]:
         agent = DDPG(s_dim, a_dim, a_bound, GAMMA, TAU, SIGMA, THETA, EPSILON, BUFFER_SIZE, BATCH_SIZE, LR_ACTOR,
-                     LR_CRITIC, clip_grad, DEVICE)
+                     LR_CRITIC, clip_grad, DEVICE, obs_norm=args.obs_norm)
 
         # training part
         max_rolling_score = np.float('-5')
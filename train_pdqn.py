@@ -9,6 +9,7 @@ from gym_carla.env.settings import ARGS
 from gym_carla.env.carla_env import CarlaEnv
 from process import start_process, kill_process
 from gym_carla.env.util.wrapper import fill_action_param,recover_steer
+from gym_carla.env.util.reward import add_patched
 from collections import deque
 
 # neural network hyper parameters
@@ -95,7 +96,7 @@ def main():
                             if env.is_effective_action() and not info['Abandon']:
                                 if 'Throttle' in info:
                                     control_state = info['control_state']
-                                    impact = info['impact'] / 9
+                                    impact = info['impact']
                                     if control_state:
                                         # under rl control
                                         if truncated:
@@ -105,10 +106,8 @@ def main():
                                             impact_deque.append([state, action, all_action_param, reward, next_state,
                                                                     truncated, done, info])
                                             if len(impact_deque) == 2:
-                                                experience = impact_deque[0]
-                                                agent.replay_buffer.add(experience[0], experience[1], experience[2],
-                                                                        experience[3] + impact, experience[4], experience[5],
-                                                                        experience[6], experience[7])
+                                                # the next impact is kept in the stored info for the reward relabeling
+                                                add_patched(agent.replay_buffer, impact_deque[0], impact)
                                             # agent.replay_buffer.add(state, action, all_action_param, reward, next_state,
                                             #                         truncated, done, info)
                                             print('rl control in replay buffer: ', action, all_action_param)
@@ -127,10 +126,8 @@ def main():
                                             impact_deque.append([state, action, saved_action_param, reward, next_state,
                                                                     truncated, done, info])
                                             if len(impact_deque) == 2:
-                                                experience = impact_deque[0]
-                                                agent.replay_buffer.add(experience[0], experience[1], experience[2],
-                                                                        experience[3] + impact, experience[4], experience[5],
-                                                                        experience[6], experience[7])
+                                                # the next impact is kept in the stored info for the reward relabeling
+                                                add_patched(agent.replay_buffer, impact_deque[0], impact)
                                             # agent.replay_buffer.add(state, action, saved_action_param, reward, next_state,
                                             #                         truncated, done, info)
                                 # else: